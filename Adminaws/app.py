@@ -7,6 +7,7 @@ from flask import Flask, render_template, request, jsonify, redirect, url_for, f
 import boto3
 import os
 import json
+import re
 import uuid
 import random
 import string
@@ -727,25 +728,70 @@ class EnhancedDynamoDBClient:
             logger.error(f"Error getting system monitoring data: {e}")
             return {'nodes': [], 'active_sessions': [], 'device_utilization': 0}
 
+    @staticmethod
+    def canonical_rfid_uid(rfid_uid):
+        """A card UID as the door looks it up (rfid_uid_canonical): uppercase
+        hex without separators or 0x, at least 8 digits; None if invalid"""
+        uid = str(rfid_uid or '').strip()
+        if uid.lower().startswith('0x'):
+            uid = uid[2:]
+        uid = re.sub(r'[:\s\-\.]', '', uid).upper()
+        if not re.fullmatch(r'[0-9A-F]+', uid):
+            return None
+        return uid.zfill(8)
+
     def assign_rfid_to_customer(self, customer_id, rfid_uid):
         """Assign RFID card to customer (admin function)"""
+        canonical_uid = self.canonical_rfid_uid(rfid_uid)
+        if not canonical_uid:
+            logger.error(f"Error assigning RFID: invalid UID '{rfid_uid}'")
+            return False
         try:
-            self.tables['customers'].update_item(
+            response = self.tables['customers'].update_item(
                 Key={'customer_id': customer_id},
-                UpdateExpression='SET rfid_card_uid = :rfid, membership_status = :status, updated_at = :updated',
+                UpdateExpression='SET rfid_card_uid = :rfid, rfid_uid_canonical = :canonical, '
+                                 'membership_status = :status, updated_at = :updated',
                 ExpressionAttributeValues={
                     ':rfid': rfid_uid,
+                    ':canonical': canonical_uid,
                     ':status': 'ACTIVE',
                     ':updated': datetime.utcnow().isoformat()
-                }
+                },
+                ReturnValues='UPDATED_OLD'
             )
             logger.info(
                 f"✅ Assigned RFID {rfid_uid} to customer {customer_id}")
+
+            # The door caches lookups by card; drop both the new card and
+            # the one it replaced
+            previous_uid = response.get('Attributes', {}).get('rfid_card_uid')
+            self.invalidate_door_rfid_cache([rfid_uid, previous_uid])
             return True
         except Exception as e:
             logger.error(f"Error assigning RFID: {e}")
             return False
 
+    def invalidate_door_rfid_cache(self, rfid_uids):
+        """Tell the door to forget its cached lookups for these cards"""
+        try:
+            message = {
+                'command': 'INVALIDATE_RFID',
+                'rfid_uids': [uid for uid in rfid_uids if uid],
+                'timestamp': datetime.utcnow().isoformat(),
+                'sent_by': 'admin_ui'
+            }
+
+            self.iot_client.publish(
+                topic='store/door/001/commands',
+                qos=1,
+                payload=json.dumps(message)
+            )
+            logger.info(f"✅ Invalidated door RFID cache for {message['rfid_uids']}")
+            return True
+        except Exception as e:
+            logger.error(f"Error invalidating door RFID cache: {e}")
+            return False
+
     def send_device_command(self, device_id, command):
         """Send command to IoT device"""
         try:
@@ -1,12 +1,13 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
 from database import DatabaseManager
 from config import Config
+import os
 import json
 import requests
 import threading 
 import time
 from datetime import datetime, timedelta
-from door_mqtt_client import start_mqtt_client_background
+from door_mqtt_client import start_mqtt_client_background, get_mqtt_client
 
 app = Flask(__name__)
 app.secret_key = Config.SECRET_KEY
@@ -150,13 +151,15 @@ def test_mqtt():
         
         if test_type == 'entry':
             # Test entry request
-            success = mqtt_client.process_entry_request(rfid_uid)
-            result_message = f"📤 Entry request sent for {rfid_uid}" if success else "❌ Failed to send entry request"
+            decision = mqtt_client.process_entry_request(rfid_uid)
+            outcome = 'granted' if decision['allowed'] else 'denied'
+            result_message = f"📤 Entry for {rfid_uid} {outcome} ({decision['source']}): {decision.get('message', '')}"
             
         elif test_type == 'exit':
             # Test exit request  
-            success = mqtt_client.process_exit_request(rfid_uid)
-            result_message = f"📤 Exit request sent for {rfid_uid}" if success else "❌ Failed to send exit request"
+            decision = mqtt_client.process_exit_request(rfid_uid)
+            outcome = 'granted' if decision['allowed'] else 'denied'
+            result_message = f"📤 Exit for {rfid_uid} {outcome} ({decision['source']}): {decision.get('message', '')}"
             
         elif test_type == 'status':
             # Test status update
@@ -258,6 +261,8 @@ def delete_user(uid):
     """Delete user"""
     try:
         if db.delete_user(uid):
+            # The door caches lookups by card; drop this one everywhere
+            get_mqtt_client().publish_rfid_invalidation([uid])
             flash("User deleted successfully!", 'success')
         else:
             flash("Error deleting user.", 'error')
@@ -449,8 +454,9 @@ def determine_entry_or_exit(rfid_uid, user_info):
         time_diff = datetime.now() - last_access_time
         
         # If last access was entry and within 4 hours = Exit attempt
+        # (a late cloud answer logs ENTRY_CONFIRMED/ENTRY_REVOKED after a local grant)
         if time_diff.total_seconds() < 14400:  # 4 hours
-            if last_log[2] in ['GRANTED', 'ENTRY_GRANTED']:
+            if last_log[2] in ['GRANTED', 'ENTRY_GRANTED', 'ENTRY_CONFIRMED', 'ENTRY_REVOKED']:
                 return {
                     'action': 'exit',
                     'reason': 'Recent entry detected - exit attempt'
@@ -477,38 +483,13 @@ def process_entry_request(rfid_uid, user_info):
         
         print(f"🚪 Processing ENTRY request for: {user_name}")
         
-        # Try fresh MQTT client first
+        # Decided by the door's MQTT client: the cloud's answer if it comes
+        # within the deadline, otherwise the local users table. The client
+        # logs the decision and queues OPEN_DOOR itself.
         try:
-            print("📡 Creating fresh MQTT connection...")
-            from door_mqtt_client import SmartDoorMQTTClient
-            
-            # Use unique client ID to avoid conflicts
-            client = SmartDoorMQTTClient()
-            client.client_id = f"door-flask-{int(time.time())}"  # Unique ID
-            
-            if client.connect():
-                print(f"✅ Fresh MQTT connected, publishing...")
-                success = client.process_entry_request(rfid_uid)
-                
-                if success:
-                    print(f"✅ MQTT publish successful for {user_name}")
-                    client.disconnect()
-                    
-                    # Log with very short value
-                    db.log_access(rfid_uid, user_name, "CLOUD")  # Super short
-                    
-                    return {
-                        'status': 'processing',
-                        'message': f'Processing entry for {user_name} via cloud',
-                        'action': 'entry',
-                        'user_name': user_name,
-                        'rfid_uid': rfid_uid,
-                        'cloud_processing': True
-                    }
-                else:
-                    client.disconnect()
-            else:
-                print(f"❌ Fresh MQTT failed to connect")
+            decision = get_mqtt_client().process_entry_request(rfid_uid)
+            print(f"✅ Entry {'granted' if decision['allowed'] else 'denied'} for {user_name} ({decision['source']})")
+            return access_result('entry', rfid_uid, user_name, decision)
                 
         except Exception as mqtt_error:
             print(f"❌ MQTT error: {mqtt_error}")
@@ -545,28 +526,11 @@ def process_exit_request(rfid_uid, user_info):
         # Log locally first
         db.log_access(rfid_uid, user_name, "EXIT_PROCESSING")
         
-        # STEP 3: ADD MQTT CLIENT CALL
+        # STEP 3: decided by the door's MQTT client, like entry
         try:
-            from door_mqtt_client import get_mqtt_client
-            mqtt_client = get_mqtt_client()
-            
-            if mqtt_client.connected:
-                print(f"📡 Sending exit request to cloud via MQTT")
-                success = mqtt_client.process_exit_request(rfid_uid)
-                
-                if success:
-                    return {
-                        'status': 'processing',
-                        'message': f'Processing exit for {user_name} via cloud',
-                        'action': 'exit',
-                        'user_name': user_name,
-                        'rfid_uid': rfid_uid,
-                        'cloud_processing': True
-                    }
-                else:
-                    print(f"❌ MQTT publish failed, falling back to local")
-            else:
-                print(f"⚠️ MQTT client not connected, processing locally")
+            decision = get_mqtt_client().process_exit_request(rfid_uid)
+            print(f"✅ Exit {'granted' if decision['allowed'] else 'denied'} for {user_name} ({decision['source']})")
+            return access_result('exit', rfid_uid, user_name, decision)
                 
         except Exception as mqtt_error:
             print(f"❌ MQTT client error: {mqtt_error}")
@@ -590,6 +554,24 @@ def process_exit_request(rfid_uid, user_info):
             'action': 'exit'
         }
 
+def access_result(action, rfid_uid, user_name, decision):
+    """Response for the serial handler from an MQTT client decision"""
+    if decision.get('customer_name') not in (None, 'Unknown'):
+        user_name = decision['customer_name']
+    result = {
+        'status': 'granted' if decision['allowed'] else 'denied',
+        'message': decision.get('message') or f"{action.capitalize()} {'granted' if decision['allowed'] else 'denied'} for {user_name}",
+        'action': action,
+        'user_name': user_name,
+        'rfid_uid': rfid_uid,
+        'cloud_processing': decision['source'] == 'cloud',
+        # The MQTT client has already queued OPEN_DOOR for a granted request
+        'door_command_queued': True
+    }
+    if action == 'entry':
+        result['assigned_cart'] = decision.get('assigned_cart')
+    return result
+
 @app.route('/test_card_scan', methods=['GET', 'POST'])
 def test_card_scan():
     """Test route to simulate CARD_SCANNED message"""
@@ -717,29 +699,23 @@ def test_mqtt_connection():
     try:
         print("🧪 Testing MQTT connection...")
         
-        # Test fresh client approach
-        from door_mqtt_client import SmartDoorMQTTClient
-        
-        client = SmartDoorMQTTClient()
+        # The shared client; a second connection would drop the door's
+        client = get_mqtt_client()
         
         html = "<h2>🧪 MQTT Connection Test</h2>"
         
-        # Try to connect
-        if client.connect():
+        # Wait for the connection
+        if client.wait_connected(10):
             html += "<p>✅ MQTT client connected successfully</p>"
             
-            # Try to publish a test message
-            test_success = client.process_entry_request("TEST123456")
+            # Try an entry request
+            decision = client.process_entry_request("TEST123456")
             
-            if test_success:
-                html += "<p>✅ Test message published successfully</p>"
+            if decision['source'] == 'cloud':
+                html += "<p>✅ Test request answered by the cloud</p>"
                 html += "<p>📊 Check AWS IoT MQTT test client for the message</p>"
             else:
-                html += "<p>❌ Test message failed to publish</p>"
-            
-            # Disconnect
-            client.disconnect()
-            html += "<p>📡 Disconnected from MQTT</p>"
+                html += f"<p>❌ No cloud answer in time, decided locally: {decision.get('message', '')}</p>"
             
         else:
             html += "<p>❌ MQTT client failed to connect</p>"
@@ -792,6 +768,12 @@ if __name__ == '__main__':
     print("⚠️  NOTE: Do NOT run door_mqtt_client.py separately!")
     print("🚀 Initializing integrated MQTT client...")
     
+    # Connect the shared MQTT client now so the first card tap finds it up.
+    # With the debug reloader only the serving child connects; two
+    # connections with the same client id would keep dropping each other.
+    if not Config.DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_mqtt_client_background()
+    
     # Start MQTT client in background
     #mqtt_success = initialize_mqtt_client()
     
@@ -1,5 +1,6 @@
 import serial
 import time
+import queue
 import threading
 import requests
 import json
@@ -9,6 +10,8 @@ import logging
 
 # Import our new DynamoDB manager
 from dynamodb_manager import DynamoDBManager
+from command_bus import CommandBusServer
+from serial_handler import SerialLineReader, arduino_command
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -26,6 +29,10 @@ class CloudDirectArduinoHandler:
         self.running = False
         self.flask_url = "http://localhost:5000"
         
+        # Arduino lines and pushed commands, handled in order by run()
+        self.events = queue.Queue()
+        self.command_bus = CommandBusServer(lambda command: self.events.put(('COMMAND', command)))
+        
         logger.info("🌟 Cloud-Direct Arduino Handler initialized")
         
     def connect(self):
@@ -181,37 +188,26 @@ class CloudDirectArduinoHandler:
                 logger.info("📡 Attempting MQTT cloud processing...")
                 print("📡 Attempting MQTT cloud processing...")
                 
-                from door_mqtt_client import SmartDoorMQTTClient
+                from door_mqtt_client import get_mqtt_client
                 
-                # Create fresh MQTT client
-                mqtt_client = SmartDoorMQTTClient()
-                mqtt_client.client_id = f"door-serial-{int(time.time())}"
+                # The door's shared MQTT connection, which also receives the answer
+                mqtt_client = get_mqtt_client()
                 
-                if mqtt_client.connect():
-                    logger.info("✅ MQTT connected for entry processing")
-                    print("✅ MQTT connected for entry processing")
-                    
-                    success = mqtt_client.process_entry_request(rfid_uid)
+                if mqtt_client.connected:
+                    # Decided by the cloud within the deadline, or locally after it;
+                    # the MQTT client queues the door command either way
+                    decision = mqtt_client.process_entry_request(rfid_uid)
+                    logger.info(f"✅ Entry for {customer_name}: {'granted' if decision['allowed'] else 'denied'} ({decision['source']})")
+                    print(f"✅ Entry for {customer_name}: {'granted' if decision['allowed'] else 'denied'} ({decision['source']})")
                     
-                    if success:
-                        logger.info(f"✅ Entry request sent to cloud for {customer_name}")
-                        print(f"✅ Entry request sent to cloud for {customer_name}")
-                        
-                        # Display processing message
-                        self.send_command(f"DISPLAY:Processing {customer_name}")
-                        
-                        # Wait for cloud response (Lambda will process and respond)
-                        # The MQTT client will handle the response and send MANUAL_OPEN
-                        
-                        mqtt_client.disconnect()
-                        return
+                    if decision['allowed']:
+                        self.send_command(f"DISPLAY:Welcome {customer_name}")
                     else:
-                        logger.warning("❌ MQTT publish failed")
-                        print("❌ MQTT publish failed")
-                        mqtt_client.disconnect()
+                        self.send_command("DISPLAY:Access Denied")
+                    return
                 else:
-                    logger.warning("❌ MQTT connection failed")
-                    print("❌ MQTT connection failed")
+                    logger.warning("❌ MQTT not connected")
+                    print("❌ MQTT not connected")
                     
             except Exception as mqtt_error:
                 logger.error(f"❌ MQTT error: {mqtt_error}")
@@ -259,37 +255,25 @@ class CloudDirectArduinoHandler:
                 logger.info("📡 Attempting MQTT cloud exit processing...")
                 print("📡 Attempting MQTT cloud exit processing...")
                 
-                from door_mqtt_client import SmartDoorMQTTClient
+                from door_mqtt_client import get_mqtt_client
                 
-                # Create fresh MQTT client
-                mqtt_client = SmartDoorMQTTClient()
-                mqtt_client.client_id = f"door-exit-{int(time.time())}"
+                # The door's shared MQTT connection, which also receives the answer
+                mqtt_client = get_mqtt_client()
                 
-                if mqtt_client.connect():
-                    logger.info("✅ MQTT connected for exit processing")
-                    print("✅ MQTT connected for exit processing")
-                    
-                    success = mqtt_client.process_exit_request(rfid_uid)
+                if mqtt_client.connected:
+                    # Decided by the cloud within the deadline, or locally after it
+                    decision = mqtt_client.process_exit_request(rfid_uid)
+                    logger.info(f"✅ Exit for {customer_name}: {'granted' if decision['allowed'] else 'denied'} ({decision['source']})")
+                    print(f"✅ Exit for {customer_name}: {'granted' if decision['allowed'] else 'denied'} ({decision['source']})")
                     
-                    if success:
-                        logger.info(f"✅ Exit request sent to cloud for {customer_name}")
-                        print(f"✅ Exit request sent to cloud for {customer_name}")
-                        
-                        # Display processing message
-                        self.send_command(f"DISPLAY:Checking {customer_name}")
-                        
-                        # Wait for cloud response (Lambda will validate checkout)
-                        # The MQTT client will handle the response
-                        
-                        mqtt_client.disconnect()
-                        return
+                    if decision['allowed']:
+                        self.send_command(f"DISPLAY:Goodbye {customer_name}")
                     else:
-                        logger.warning("❌ MQTT exit publish failed")
-                        print("❌ MQTT exit publish failed")
-                        mqtt_client.disconnect()
+                        self.send_command("DISPLAY:Please checkout")
+                    return
                 else:
-                    logger.warning("❌ MQTT exit connection failed")
-                    print("❌ MQTT exit connection failed")
+                    logger.warning("❌ MQTT not connected for exit")
+                    print("❌ MQTT not connected for exit")
                     
             except Exception as mqtt_error:
                 logger.error(f"❌ MQTT exit error: {mqtt_error}")
@@ -443,9 +427,18 @@ class CloudDirectArduinoHandler:
                 error_details
             )
     
+    def execute_command(self, command):
+        """Send a web/cloud command pushed over the command bus to the Arduino"""
+        logger.info(f"📋 Processing command: {command}")
+        arduino = arduino_command(command)
+        if arduino:
+            self.send_command(arduino)
+        else:
+            logger.warning(f"⚠️ Unknown command: {command}")
+    
     def check_pending_commands(self):
         """Check for pending commands from web interface - REMOVED MySQL dependency"""
-        # Note: This now relies on Flask web interface sending commands directly
+        # Note: Commands are pushed over the command bus instead
         # No need to check database for pending commands
         pass
     
@@ -454,6 +447,17 @@ class CloudDirectArduinoHandler:
             return
         
         self.running = True
+        reader = SerialLineReader(self.serial_conn, self.events)
+        reader.start()
+        self.command_bus.start()
+        
+        # Connect the shared MQTT client now so the first card tap finds it up
+        try:
+            from door_mqtt_client import get_mqtt_client
+            get_mqtt_client()
+        except Exception as e:
+            logger.error(f"❌ Could not start MQTT client: {e}")
+        
         logger.info("🚀 Cloud-Direct Arduino handler started")
         print("🚀 Cloud-Direct Arduino handler started")
         print("☁️  Using DynamoDB for all customer data")
@@ -466,27 +470,31 @@ class CloudDirectArduinoHandler:
         self.send_command("GET_STATUS")
         
         while self.running:
+            # Block until the Arduino says something or a command is pushed
+            kind, payload = self.events.get()
+            
             try:
-                # Check for Arduino messages
-                if self.serial_conn.in_waiting > 0:
-                    message = self.serial_conn.readline().decode('utf-8', errors='ignore')
-                    if message.strip():
-                        self.parse_arduino_message(message)
-                
-                # No longer checking MySQL for pending commands
-                # All commands now come through Flask API directly
-                
-                time.sleep(0.5)  # Check every 500ms
+                if kind == 'LINE':
+                    self.parse_arduino_message(payload)
+                elif kind == 'COMMAND':
+                    self.execute_command(payload)
+                elif kind == 'DISCONNECTED':
+                    logger.error(f"❌ Lost connection to Arduino: {payload}")
+                    print(f"❌ Lost connection to Arduino: {payload}")
+                    self.running = False
                 
             except Exception as e:
                 logger.error(f"Error in main loop: {e}")
                 print(f"Error in main loop: {e}")
-                time.sleep(1)
+        
+        self.command_bus.stop()
+        reader.stop()
         
         self.disconnect()
     
     def stop(self):
         self.running = False
+        self.events.put(('STOP', None))
 
 def main():
     print("🏪 Smart Convenience Store - Cloud-Direct IoT Handler")
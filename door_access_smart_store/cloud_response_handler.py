@@ -44,6 +44,7 @@ class CloudResponseHandler:
                 
                 logger.info(f"📨 Received cloud response on {topic}")
                 print(f"📨 Received cloud response on {topic}")
+                self.mqtt_client.complete_request(topic, payload)
                 
                 if topic == 'store/customers/valid':
                     self.handle_entry_response(payload)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Door Command Bus
+Pushes web and cloud commands (OPEN_DOOR, REGISTER_MODE, ADD_USER:...) from
+the Flask app and the MQTT client straight to the serial handler
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Unix domain socket shared by the command senders (client) and the serial handler (server)
+DOOR_COMMAND_BUS = os.environ.get('DOOR_COMMAND_BUS', '/tmp/smart_door_commands.sock')
+
+CONNECT_TIMEOUT = 0.5   # seconds to reach the serial handler before falling back to the commands table
+
+# Wire format: one JSON object per line in each direction.
+#   Request:  {"command": "OPEN_DOOR"}
+#   Response: {"status": "queued"} once the serial handler has queued it,
+#             {"status": "failed", "reason": "..."} for a malformed request
+
+class CommandBusServer:
+    """Serial-handler side of the command bus.
+
+    Every command received is handed to `submit(command)`, which queues it
+    for the handler's main loop, and acknowledged straight away.
+    """
+
+    def __init__(self, submit, path=DOOR_COMMAND_BUS):
+        self.submit = submit
+        self.path = path
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        # Remove a socket left behind by a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        bus = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    reply = bus._handle_line(line)
+                    self.wfile.write((json.dumps(reply) + "\n").encode())
+                    self.wfile.flush()
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="door-command-bus", daemon=True)
+        self._thread.start()
+        logger.info(f"📬 Door command bus listening on {self.path}")
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _handle_line(self, line):
+        try:
+            command = json.loads(line)['command']
+        except (ValueError, KeyError, TypeError) as e:
+            return {'status': 'failed', 'reason': f"Invalid command message: {e}"}
+
+        self.submit(command)
+        return {'status': 'queued'}
+
+def send_command(command, path=DOOR_COMMAND_BUS):
+    """Push a command to the serial handler.
+
+    Returns True once the serial handler has it, False if the bus is not
+    available (the serial handler is not running or not answering).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(path)
+        sock.sendall((json.dumps({'command': command}) + "\n").encode())
+    except OSError as e:
+        logger.debug(f"Door command bus unavailable for {command}: {e}")
+        sock.close()
+        return False
+
+    # From here on the command has been delivered, so never report the bus as
+    # down - the caller would persist the command and it would run twice
+    try:
+        reply = json.loads(sock.makefile('rb').readline())
+        if reply.get('status') != 'queued':
+            logger.warning(f"⚠️ Door command bus rejected {command}: {reply.get('reason')}")
+            return False
+        return True
+    except (OSError, ValueError) as e:
+        logger.warning(f"⚠️ No acknowledgement from the door command bus for {command}: {e}")
+        return True
+    finally:
+        sock.close()
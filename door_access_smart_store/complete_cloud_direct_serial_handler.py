@@ -1,5 +1,6 @@
 import serial
 import time
+import queue
 import threading
 import requests
 import json
@@ -9,6 +10,8 @@ import logging
 
 # Import our new DynamoDB manager
 from dynamodb_manager import DynamoDBManager
+from command_bus import CommandBusServer
+from serial_handler import SerialLineReader, arduino_command
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,6 +32,10 @@ class CloudDirectArduinoHandler:
         # Response handler will be initialized later
         self.response_handler = None
         
+        # Arduino lines and pushed commands, handled in order by run()
+        self.events = queue.Queue()
+        self.command_bus = CommandBusServer(lambda command: self.events.put(('COMMAND', command)))
+        
         logger.info("🌟 Cloud-Direct Arduino Handler initialized")
         
     def connect(self):
@@ -242,41 +249,36 @@ class CloudDirectArduinoHandler:
             print(f"❌ Error processing exit: {e}")
             self.send_command("DISPLAY:Exit Error")
     
+    def shared_mqtt_client(self):
+        """The response handler's persistent MQTT connection, or None while it is down.
+        
+        Requests are published on the same connection that receives the
+        Lambda's answers, so nothing is connected per card tap.
+        """
+        if self.response_handler and self.response_handler.is_running():
+            return self.response_handler.mqtt_client
+        return None
+    
     def send_mqtt_entry_request(self, rfid_uid):
-        """Send MQTT entry request without maintaining connection"""
+        """Send MQTT entry request over the shared connection"""
         try:
-            from door_mqtt_client import SmartDoorMQTTClient
-            
-            # Create temporary client
-            mqtt_client = SmartDoorMQTTClient()
-            mqtt_client.client_id = f"entry-{int(time.time())}"
-            
-            if mqtt_client.connect():
-                success = mqtt_client.process_entry_request(rfid_uid)
-                mqtt_client.disconnect()
-                return success
-            else:
+            mqtt_client = self.shared_mqtt_client()
+            if mqtt_client is None:
                 return False
+            # The response handler acts on the answer, so only publish
+            return mqtt_client.publish_access_request('entry', rfid_uid)
                 
         except Exception as e:
             logger.error(f"❌ MQTT entry error: {e}")
             return False
     
     def send_mqtt_exit_request(self, rfid_uid):
-        """Send MQTT exit request without maintaining connection"""
+        """Send MQTT exit request over the shared connection"""
         try:
-            from door_mqtt_client import SmartDoorMQTTClient
-            
-            # Create temporary client
-            mqtt_client = SmartDoorMQTTClient()
-            mqtt_client.client_id = f"exit-{int(time.time())}"
-            
-            if mqtt_client.connect():
-                success = mqtt_client.process_exit_request(rfid_uid)
-                mqtt_client.disconnect()
-                return success
-            else:
+            mqtt_client = self.shared_mqtt_client()
+            if mqtt_client is None:
                 return False
+            return mqtt_client.publish_access_request('exit', rfid_uid)
                 
         except Exception as e:
             logger.error(f"❌ MQTT exit error: {e}")
@@ -463,6 +465,15 @@ class CloudDirectArduinoHandler:
             print(f"❌ Error starting response handler: {e}")
             return False
     
+    def execute_command(self, command):
+        """Send a web/cloud command pushed over the command bus to the Arduino"""
+        logger.info(f"📋 Processing command: {command}")
+        arduino = arduino_command(command)
+        if arduino:
+            self.send_command(arduino)
+        else:
+            logger.warning(f"⚠️ Unknown command: {command}")
+    
     def run(self):
         if not self.connect():
             return
@@ -471,6 +482,9 @@ class CloudDirectArduinoHandler:
         response_handler_started = self.start_cloud_response_handler()
         
         self.running = True
+        reader = SerialLineReader(self.serial_conn, self.events)
+        reader.start()
+        self.command_bus.start()
         logger.info("🚀 Cloud-Direct Arduino handler started")
         print("🚀 Cloud-Direct Arduino handler started")
         print("☁️  Using DynamoDB for all customer data")
@@ -489,21 +503,26 @@ class CloudDirectArduinoHandler:
         self.send_command("GET_STATUS")
         
         while self.running:
+            # Block until the Arduino says something or a command is pushed
+            kind, payload = self.events.get()
+            
             try:
-                # Check for Arduino messages
-                if self.serial_conn.in_waiting > 0:
-                    message = self.serial_conn.readline().decode('utf-8', errors='ignore')
-                    if message.strip():
-                        self.parse_arduino_message(message)
-                
-                time.sleep(0.5)  # Check every 500ms
+                if kind == 'LINE':
+                    self.parse_arduino_message(payload)
+                elif kind == 'COMMAND':
+                    self.execute_command(payload)
+                elif kind == 'DISCONNECTED':
+                    logger.error(f"❌ Lost connection to Arduino: {payload}")
+                    print(f"❌ Lost connection to Arduino: {payload}")
+                    self.running = False
                 
             except Exception as e:
                 logger.error(f"Error in main loop: {e}")
                 print(f"Error in main loop: {e}")
-                time.sleep(1)
         
         # Cleanup
+        self.command_bus.stop()
+        reader.stop()
         if self.response_handler:
             self.response_handler.stop()
         
@@ -511,6 +530,7 @@ class CloudDirectArduinoHandler:
     
     def stop(self):
         self.running = False
+        self.events.put(('STOP', None))
 
 def main():
     print("🏪 Smart Convenience Store - Cloud-Direct IoT Handler")
@@ -21,6 +21,17 @@ class Config:
     IOT_ENDPOINT = ''  # Will be filled from AWS Console
     CLIENT_ID = 'iot-convenience-store-door-001-production'
     
+    # How long a card tap waits for the cloud's entry/exit decision before the
+    # door decides from the local users table
+    CLOUD_DEADLINE_MS = int(os.environ.get('DOOR_CLOUD_DEADLINE_MS', '400'))
+    
+    # Customers are looked up with one query on their canonical UID. Cards the
+    # canonical index misses are also tried in the old UID format variants, as
+    # customers written before rfid_uid_canonical have no canonical UID. Set
+    # DOOR_RFID_VARIANT_LOOKUP=false only once
+    # `python uid_normalizer.py --backfill --apply` has run
+    RFID_VARIANT_LOOKUP = os.environ.get('DOOR_RFID_VARIANT_LOOKUP', 'true').lower() in ('1', 'true', 'yes')
+    
     # Certificate paths
     CA_CERT = 'certificates/AmazonRootCA1.pem'
     CERT_FILE = 'certificates/door-certificate.pem.crt'
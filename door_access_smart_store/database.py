@@ -3,6 +3,7 @@ from mysql.connector import Error
 import threading
 from datetime import datetime
 from config import Config
+from command_bus import send_command
 
 class DatabaseManager:
     def __init__(self):
@@ -115,6 +116,12 @@ class DatabaseManager:
                 conn.close()
     
     def add_command(self, command):
+        """Hand a command to the serial handler over the command bus; only
+        while it isn't running is the command persisted to the commands
+        table, which the serial handler drains when it comes back"""
+        if send_command(command):
+            return True
+        
         with self.lock:
             conn = self.get_connection()
             if not conn:
@@ -7,6 +7,7 @@ import uuid
 from datetime import datetime
 import json
 from botocore.exceptions import ClientError, NoCredentialsError
+from uid_normalizer import RFIDUIDNormalizer
 
 class CloudDatabaseManager:
     """
@@ -24,6 +25,9 @@ class CloudDatabaseManager:
             self.access_logs_table = self.dynamodb.Table('iot-convenience-store-access-logs-production')
             self.sessions_table = self.dynamodb.Table('iot-convenience-store-sessions-production')
             
+            # For commands to the door, e.g. dropping cached card lookups
+            self.iot_client = boto3.client('iot-data', region_name='us-east-1')
+            
             print("✅ Cloud database client initialized successfully")
             
         except NoCredentialsError:
@@ -152,16 +156,26 @@ class CloudDatabaseManager:
         Returns:
             dict: Success/error response
         """
+        canonical_uid = RFIDUIDNormalizer.normalize_uid(rfid_card_uid)
+        if not canonical_uid:
+            print(f"❌ Error approving registration: invalid UID '{rfid_card_uid}'")
+            return {
+                'success': False,
+                'error': f"Invalid RFID card UID: {rfid_card_uid}",
+                'message': 'Failed to approve registration.'
+            }
+        
         try:
             timestamp = datetime.utcnow().isoformat()
             
-            # Update customer record
+            # Update customer record; the door looks cards up by rfid_uid_canonical
             response = self.customers_table.update_item(
                 Key={'customer_id': customer_id},
                 UpdateExpression="""
                     SET registration_status = :approved,
                         membership_status = :active,
                         rfid_card_uid = :rfid_uid,
+                        rfid_uid_canonical = :canonical,
                         card_issued_date = :issued_date,
                         access_permissions = :permissions,
                         updated_at = :updated
@@ -170,6 +184,7 @@ class CloudDatabaseManager:
                     ':approved': 'approved',
                     ':active': 'ACTIVE',
                     ':rfid_uid': rfid_card_uid,
+                    ':canonical': canonical_uid,
                     ':issued_date': timestamp,
                     ':permissions': ['store_entry', 'checkout_bypass'],
                     ':updated': timestamp
@@ -179,6 +194,9 @@ class CloudDatabaseManager:
             
             print(f"✅ Customer {customer_id} approved with card {rfid_card_uid}")
             
+            # The door may have cached the card as unregistered
+            self.invalidate_door_rfid_cache([rfid_card_uid])
+            
             return {
                 'success': True,
                 'message': 'Customer approved and card assigned successfully!',
@@ -193,6 +211,28 @@ class CloudDatabaseManager:
                 'message': 'Failed to approve registration.'
             }
 
+    def invalidate_door_rfid_cache(self, rfid_uids):
+        """Tell the door to forget its cached lookups for these cards"""
+        try:
+            message = {
+                'command': 'INVALIDATE_RFID',
+                'rfid_uids': [uid for uid in rfid_uids if uid],
+                'timestamp': datetime.utcnow().isoformat(),
+                'sent_by': 'cloud_database'
+            }
+            
+            self.iot_client.publish(
+                topic='store/door/001/commands',
+                qos=1,
+                payload=json.dumps(message)
+            )
+            print(f"✅ Invalidated door RFID cache for {message['rfid_uids']}")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Error invalidating door RFID cache: {e}")
+            return False
+
     def validate_rfid_access(self, rfid_card_uid):
         """
         Validate RFID card for door access
@@ -43,7 +43,9 @@ COMMENT 'Legacy compatibility - Real access control data in cloud';
 
 -- RFID verification cache (2 minutes max)
 CREATE TABLE temp_rfid_cache (
-    rfid_card_uid VARCHAR(32) PRIMARY KEY,
+    rfid_card_uid VARCHAR(32) PRIMARY KEY,   -- normalized UID
+    customer_id VARCHAR(50),                 -- NULL caches "card not registered"
+    cloud_rfid_uid VARCHAR(32),              -- UID format stored in DynamoDB
     
     -- Cached cloud response (simplified - no JSON)
     customer_name VARCHAR(100),
@@ -262,8 +264,11 @@ ON SCHEDULE EVERY 2 MINUTE
 STARTS CURRENT_TIMESTAMP
 DO
 BEGIN
-    -- Delete expired RFID cache
-    DELETE FROM temp_rfid_cache WHERE expires_at < NOW();
+    -- Delete expired RFID cache (registered cards are still served for
+    -- 10 minutes past expiry while the door refreshes them)
+    DELETE FROM temp_rfid_cache
+    WHERE expires_at < NOW() - INTERVAL 10 MINUTE
+       OR (expires_at < NOW() AND customer_id IS NULL);
     
     -- Delete synced access events
     DELETE FROM temp_access_events 
@@ -5,26 +5,50 @@ Now supports entry processing, cart assignment, and exit validation
 """
 
 import json
+import os
+import sys
 import time
 import ssl
 import logging
 import queue
 import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from datetime import datetime
 from paho.mqtt.client import Client as MQTTClient
 from database import DatabaseManager
 from config import Config
+from rfid_cache import get_rfid_cache
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+PUBLISH_TIMEOUT = 5          # seconds to wait for AWS IoT to acknowledge a request
+REQUEST_TIMEOUT = 30         # seconds an entry/exit request stays in flight without an answer
+LATE_GRANT_WINDOW = 3        # seconds after the tap a cloud grant may still open a door refused locally
+RESPONSE_CACHE_SIZE = 100    # cloud answers kept for get_response_for_rfid()
+RECONNECT_MIN_DELAY = 1      # paho's reconnect backoff, in seconds
+RECONNECT_MAX_DELAY = 30
+# The device policy only lets clients named <project>-*-<environment> connect,
+# so the per-process part goes between these two
+DOOR_CLIENT_PREFIX = "iot-convenience-store-door-001"
+DOOR_CLIENT_SUFFIX = "production"
+
+def process_client_id():
+    """An MQTT client id of this process's own, e.g.
+    iot-convenience-store-door-001-app-production. AWS IoT drops the older
+    connection when another connects with the same id."""
+    script = os.path.splitext(os.path.basename(sys.argv[0] or ''))[0] or 'door'
+    return f"{DOOR_CLIENT_PREFIX}-{script}-{DOOR_CLIENT_SUFFIX}"
+
 class SmartDoorMQTTClient:
-    def __init__(self):
+    def __init__(self, cloud_deadline=None, client_id=None):
         # AWS IoT Core Configuration
         self.iot_endpoint = "a2amimoaybc420-ats.iot.us-east-1.amazonaws.com"
         self.port = 8883
-        self.client_id = "iot-convenience-store-door-001-production"
+        self.client_id = client_id or process_client_id()
         
         # Certificate files
         self.ca_cert = "certificates/AmazonRootCA1.pem"
@@ -51,12 +75,23 @@ class SmartDoorMQTTClient:
         self.mqtt_client = None
         self.connected = False
         self.running = False
+        self.started = False
+        self._connected_event = threading.Event()
+        
+        # Entry/exit requests published and waiting for the cloud's answer:
+        # request_id -> {'kind', 'rfid_uid', 'sent_at', 'answer' (Future),
+        #                'waiter', 'decided_by', 'decision'}
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        
+        # How long a tap waits for the cloud before the door decides locally
+        self.cloud_deadline = Config.CLOUD_DEADLINE_MS / 1000 if cloud_deadline is None else cloud_deadline
         
         # Door state
         self.current_customer = None
         self.awaiting_exit_response = False
         self.request_queue = queue.Queue()
-        self.response_cache = {}
+        self.response_cache = OrderedDict()   # rfid_uid -> latest cloud answer, oldest first
         
     def setup_mqtt_client(self):
         """Configure MQTT client with SSL certificates"""
@@ -88,6 +123,7 @@ class SmartDoorMQTTClient:
         if rc == 0:
             logger.info("🌟 Connected to AWS IoT Core successfully!")
             self.connected = True
+            self._connected_event.set()
             
             # Subscribe to response topics
             client.subscribe(self.topics['customer_valid'], qos=1)
@@ -100,11 +136,13 @@ class SmartDoorMQTTClient:
         else:
             logger.error(f"❌ Failed to connect to AWS IoT Core: {rc}")
             self.connected = False
+            self._connected_event.clear()
     
     def on_disconnect(self, client, userdata, rc):
         """Callback when MQTT client disconnects"""
         logger.warning("⚠️ Disconnected from AWS IoT Core")
         self.connected = False
+        self._connected_event.clear()
     
     def on_message(self, client, userdata, msg):
         """Handle incoming MQTT messages"""
@@ -113,8 +151,13 @@ class SmartDoorMQTTClient:
             payload = json.loads(msg.payload.decode())
             
             logger.info(f"📨 Received message on {topic}")
+            request = self.complete_request(topic, payload)
             
-            if topic == self.topics['customer_valid']:
+            if request is not None and request['decided_by'] == 'local':
+                self.reconcile(request, payload)
+            elif request is not None and request['waiter']:
+                pass  # request_access() is waiting for this answer and acts on it
+            elif topic == self.topics['customer_valid']:
                 self.handle_customer_validation_response(payload)
             elif topic == self.topics['exit_response']:
                 self.handle_exit_response(payload)
@@ -140,14 +183,14 @@ class SmartDoorMQTTClient:
         logger.info(f"👤 Entry validation: {customer_name} - {'VALID' if is_valid else 'INVALID'}")
         
         # Store response for Flask app to retrieve
-        self.response_cache[rfid_uid] = {
+        self.cache_response(rfid_uid, {
             'type': 'entry_response',
             'valid': is_valid,
             'customer_name': customer_name,
             'assigned_cart': assigned_cart,
             'message': message,
             'timestamp': datetime.utcnow().isoformat()
-        }
+        })
         
         if is_valid:
             # Grant entry access
@@ -155,6 +198,9 @@ class SmartDoorMQTTClient:
         else:
             # Deny entry access
             self.deny_entry_access(rfid_uid, customer_name, message)
+        
+        return {'allowed': is_valid, 'source': 'cloud', 'customer_name': customer_name,
+                'assigned_cart': assigned_cart, 'message': message}
     
     def handle_exit_response(self, response_data):
         """Handle exit validation response from cloud"""
@@ -166,13 +212,13 @@ class SmartDoorMQTTClient:
         logger.info(f"🚪 Exit validation: {customer_name} - {'ALLOWED' if allow_exit else 'DENIED'}")
         
         # Store response for Flask app to retrieve
-        self.response_cache[rfid_uid] = {
+        self.cache_response(rfid_uid, {
             'type': 'exit_response',
             'allowed': allow_exit,
             'customer_name': customer_name,
             'message': message,
             'timestamp': datetime.utcnow().isoformat()
-        }
+        })
         
         if allow_exit:
             # Grant exit access
@@ -180,6 +226,200 @@ class SmartDoorMQTTClient:
         else:
             # Deny exit access
             self.deny_exit_access(rfid_uid, customer_name, message)
+        
+        return {'allowed': allow_exit, 'source': 'cloud', 'customer_name': customer_name, 'message': message}
+    
+    def cache_response(self, rfid_uid, response):
+        """Keep a cloud answer for get_response_for_rfid(), dropping the oldest past RESPONSE_CACHE_SIZE"""
+        with self._lock:
+            self.response_cache.pop(rfid_uid, None)
+            self.response_cache[rfid_uid] = response
+            while len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                self.response_cache.popitem(last=False)
+    
+    def complete_request(self, topic, payload):
+        """Take the in-flight request a cloud answer belongs to off the table.
+        
+        Answers carry the request_id they were asked with; if the Lambda
+        doesn't echo it, the oldest request for the same card is taken. An
+        answer that beats the local decision settles the request's future.
+        Returns the request, or None if the message answers nothing in flight.
+        """
+        if topic == self.topics['customer_valid']:
+            kind, result = 'entry', payload.get('validation_result', {})
+        elif topic == self.topics['exit_response']:
+            kind, result = 'exit', payload
+        else:
+            return None
+        
+        request_id = payload.get('request_id') or result.get('request_id')
+        rfid_uid = result.get('rfid_uid')
+        with self._lock:
+            if request_id not in self.in_flight:
+                request_id = next((key for key, pending in self.in_flight.items()
+                                   if pending['kind'] == kind and pending['rfid_uid'] == rfid_uid), None)
+            request = self.in_flight.pop(request_id, None)
+            if request is not None and request['decided_by'] is None:
+                request['decided_by'] = 'cloud'
+        
+        if request is None:
+            return None
+        elapsed_ms = (time.monotonic() - request['sent_at']) * 1000
+        logger.info(f"⏱️ Cloud answered {kind} request for {rfid_uid} in {elapsed_ms:.0f} ms")
+        if request['decided_by'] == 'cloud':
+            request['answer'].set_result(payload)
+        return request
+    
+    def _track_request(self, kind, rfid_uid, waiter):
+        """Add a request to the in-flight table, dropping any that were never answered."""
+        now = time.monotonic()
+        with self._lock:
+            for request_id, pending in list(self.in_flight.items()):
+                if now - pending['sent_at'] > REQUEST_TIMEOUT:
+                    del self.in_flight[request_id]
+                    logger.warning(f"⚠️ No cloud answer to {pending['kind']} request for {pending['rfid_uid']}")
+            request = {'request_id': uuid.uuid4().hex, 'kind': kind, 'rfid_uid': rfid_uid, 'sent_at': now,
+                       'answer': Future(), 'waiter': waiter, 'decided_by': None, 'decision': None}
+            self.in_flight[request['request_id']] = request
+        return request
+    
+    def _publish_request(self, kind, topic, data, waiter=False, ack_timeout=PUBLISH_TIMEOUT):
+        """Publish an entry/exit request over the shared connection and track it
+        until the cloud answers. Returns the request once AWS IoT acknowledged
+        it (or, with ack_timeout=0, once it is queued), otherwise None."""
+        request = self._track_request(kind, data['rfid_uid'], waiter)
+        data['request_id'] = request['request_id']
+        try:
+            result = self.mqtt_client.publish(topic, json.dumps(data), qos=1)
+            if ack_timeout:
+                result.wait_for_publish(timeout=ack_timeout)
+            if result.rc == 0 and (not ack_timeout or result.is_published()):
+                return request
+            logger.error(f"❌ {kind.capitalize()} request for {data['rfid_uid']} not acknowledged: return code {result.rc}")
+        except Exception as e:
+            logger.error(f"❌ Error publishing {kind} request: {e}")
+        
+        with self._lock:
+            self.in_flight.pop(request['request_id'], None)
+        return None
+    
+    def request_access(self, kind, topic, data):
+        """Ask the cloud to decide an entry/exit and act on the decision.
+        
+        The cloud gets `cloud_deadline` seconds from the tap. After that (or
+        at once, if offline) the door decides from the local users table and
+        a late cloud answer is reconciled with that decision by reconcile().
+        Either way exactly one decision is acted on, and it is returned:
+        {'allowed', 'source' ('cloud' or 'local'), 'customer_name', 'message', ...}.
+        """
+        rfid_uid = data['rfid_uid']
+        request = None
+        if self.connected:
+            # QoS 1 keeps retrying in the background; the answer is what we wait for
+            request = self._publish_request(kind, topic, data, waiter=True, ack_timeout=0)
+        else:
+            logger.warning(f"⚠️ Not connected to cloud, deciding {kind} locally")
+        
+        if request is not None:
+            remaining = request['sent_at'] + self.cloud_deadline - time.monotonic()
+            try:
+                return self._act_on_answer(kind, request['answer'].result(timeout=max(remaining, 0)))
+            except FutureTimeout:
+                pass
+        
+        decision = self.authorize_locally(kind, rfid_uid)
+        if request is not None:
+            with self._lock:
+                claimed = request['decided_by'] is None
+                if claimed:
+                    request['decided_by'] = 'local'
+                    request['decision'] = decision
+            if not claimed:
+                # The answer arrived while the local lookup ran
+                return self._act_on_answer(kind, request['answer'].result())
+            logger.warning(f"⏱️ No cloud answer for {rfid_uid} within {self.cloud_deadline * 1000:.0f} ms, "
+                           f"{kind} decided locally")
+        self._act_on_decision(kind, rfid_uid, decision)
+        return decision
+    
+    def authorize_locally(self, kind, rfid_uid):
+        """Decide an entry/exit from the RFID cache, or the local users table
+        for a card the cache doesn't know. Entry needs a known, active card;
+        exit is always allowed so nobody is held in the store."""
+        cached = get_rfid_cache().peek(rfid_uid)
+        if cached is not None:
+            known = cached.get('found', False) and cached.get('membership_status', 'ACTIVE') == 'ACTIVE'
+            customer_name = cached.get('customer_name', "Unknown")
+            refusal = "Card not registered (cached)" if not cached.get('found') else "Membership not active"
+        else:
+            user = self.db.get_user_by_uid(rfid_uid)
+            known = bool(user)
+            customer_name = user[1] if user else "Unknown"
+            refusal = "User not found in local database"
+        
+        if kind == 'exit':
+            return {'allowed': True, 'source': 'local', 'customer_name': customer_name,
+                    'message': "Exit allowed locally"}
+        if known:
+            return {'allowed': True, 'source': 'local', 'customer_name': customer_name,
+                    'assigned_cart': "Local Cart", 'message': "Entry granted locally"}
+        return {'allowed': False, 'source': 'local', 'customer_name': customer_name,
+                'message': refusal}
+    
+    def reconcile(self, request, payload):
+        """Square a cloud answer that arrived after the door decided locally.
+        
+        Agreement is logged. A local refusal the cloud overrides is granted
+        now if the customer is likely still at the door (LATE_GRANT_WINDOW);
+        later, it is only logged and published. A local grant the cloud
+        refuses can't be taken back, so it is logged and published for review.
+        """
+        kind, rfid_uid, local = request['kind'], request['rfid_uid'], request['decision']
+        if kind == 'entry':
+            result = payload.get('validation_result', {})
+            allowed = result.get('valid', False)
+        else:
+            result = payload
+            allowed = result.get('allow_exit', False)
+        customer_name = result.get('customer_name', local['customer_name'])
+        message = result.get('message', '')
+        label = kind.upper()
+        
+        if allowed == local['allowed']:
+            logger.info(f"✅ Late cloud answer agrees with the local {kind} decision for {customer_name}")
+            self.db.log_access(rfid_uid, customer_name, f"{label}_CONFIRMED")
+            if (kind == 'entry' and allowed and self.current_customer
+                    and self.current_customer['rfid_uid'] == rfid_uid):
+                self.current_customer['assigned_cart'] = result.get('assigned_cart', 'N/A')
+        elif allowed and time.monotonic() - request['sent_at'] <= LATE_GRANT_WINDOW:
+            logger.info(f"🔓 Cloud allows the {kind} refused locally for {customer_name}, opening now")
+            self._act_on_answer(kind, payload)
+        elif allowed:
+            elapsed = time.monotonic() - request['sent_at']
+            logger.warning(f"⚠️ Cloud allows the {kind} refused locally for {customer_name} "
+                           f"{elapsed:.1f} s after the tap, too late to open")
+            self.db.log_access(rfid_uid, customer_name, f"{label}_LATE_GRANT")
+            publish_event = self.publish_entry_event if kind == 'entry' else self.publish_exit_event
+            publish_event(rfid_uid, customer_name, False,
+                          f"Allowed by cloud {elapsed:.1f} s after local refusal; door not opened")
+        else:
+            logger.warning(f"⚠️ Cloud refuses the {kind} granted locally for {customer_name}: {message}")
+            self.db.log_access(rfid_uid, customer_name, f"{label}_REVOKED")
+            publish_event = self.publish_entry_event if kind == 'entry' else self.publish_exit_event
+            publish_event(rfid_uid, customer_name, False, f"Refused by cloud after local grant: {message}")
+    
+    def _act_on_answer(self, kind, payload):
+        if kind == 'entry':
+            return self.handle_customer_validation_response(payload)
+        return self.handle_exit_response(payload)
+    
+    def _act_on_decision(self, kind, rfid_uid, decision):
+        if kind == 'entry' and decision['allowed']:
+            self.grant_entry_access(rfid_uid, decision['customer_name'], decision['assigned_cart'], decision['message'])
+        elif kind == 'entry':
+            self.deny_entry_access(rfid_uid, decision['customer_name'], decision['message'])
+        else:
+            self.grant_exit_access(rfid_uid, decision['customer_name'], decision['message'])
     
     def get_response_for_rfid(self, rfid_uid):
         """Get cached response for RFID UID"""
@@ -209,6 +449,12 @@ class SmartDoorMQTTClient:
         elif command_type == 'EMERGENCY_UNLOCK':
             self.db.add_command("OPEN_DOOR")
             logger.warning("🚨 Emergency unlock command queued")
+            
+        elif command_type == 'INVALIDATE_RFID':
+            # Sent by the admin portal when a card is assigned or reassigned
+            rfid_uids = command_data.get('rfid_uids') or [command_data.get('rfid_uid')]
+            for rfid_uid in filter(None, rfid_uids):
+                get_rfid_cache().invalidate(rfid_uid)
     
     def process_rfid_scan(self, rfid_uid, scan_context="entry"):
         """Process RFID scan - determine if entry or exit"""
@@ -221,7 +467,8 @@ class SmartDoorMQTTClient:
             self.process_entry_request(rfid_uid)  # Default to entry
     
     def process_entry_request(self, rfid_uid):
-        """Process customer entry request with enhanced debugging"""
+        """Decide a customer's entry, from the cloud or locally after the
+        deadline, and open the door if allowed. Returns the decision."""
         logger.info(f"🔍 Processing entry request for RFID: {rfid_uid}")
         
         # Publish RFID scan for cloud validation
@@ -232,54 +479,12 @@ class SmartDoorMQTTClient:
             'scan_type': 'entry'
         }
         
-        # ADD DETAILED LOGGING
-        logger.info(f"📤 MQTT PUBLISH DEBUG:")
-        logger.info(f"   Topic: {self.topics['rfid_scan']}")
-        logger.info(f"   Message: {json.dumps(scan_data, indent=2)}")
-        logger.info(f"   Connected: {self.connected}")
-        logger.info(f"   MQTT Client: {self.mqtt_client}")
-        
-        if self.connected:
-            try:
-                logger.info(f"🚀 Attempting to publish to topic: {self.topics['rfid_scan']}")
-                
-                result = self.mqtt_client.publish(
-                    self.topics['rfid_scan'],
-                    json.dumps(scan_data),
-                    qos=1
-                )
-                
-                # CHECK PUBLISH RESULT
-                logger.info(f"📤 Publish result:")
-                logger.info(f"   Return code: {result.rc}")
-                logger.info(f"   Message ID: {result.mid}")
-                
-                # Wait for publish to complete
-                try:
-                    result.wait_for_publish(timeout=5.0)
-                    logger.info(f"✅ Message confirmed published to IoT Core")
-                except Exception as wait_error:
-                    logger.error(f"⚠️ Publish wait timeout or error: {wait_error}")
-                
-                if result.rc == 0:
-                    logger.info(f"📤 Successfully published entry request for validation: {rfid_uid}")
-                    return True
-                else:
-                    logger.error(f"❌ Failed to publish: return code {result.rc}")
-                    return False
-                    
-            except Exception as e:
-                logger.error(f"❌ Error publishing entry request: {e}")
-                import traceback
-                logger.error(f"Full traceback: {traceback.format_exc()}")
-                return False
-        else:
-            logger.warning("⚠️ Not connected to cloud, processing locally")
-            self.process_local_entry(rfid_uid)
-            return False
+        logger.debug(f"📤 Publishing to {self.topics['rfid_scan']}: {json.dumps(scan_data)}")
+        return self.request_access('entry', self.topics['rfid_scan'], scan_data)
     
     def process_exit_request(self, rfid_uid):
-        """Process customer exit request"""
+        """Decide a customer's exit, from the cloud or locally after the
+        deadline, and open the door if allowed. Returns the decision."""
         logger.info(f"🚪 Processing exit request for RFID: {rfid_uid}")
         
         self.awaiting_exit_response = True
@@ -290,19 +495,20 @@ class SmartDoorMQTTClient:
             'door_id': 'door-001',
             'timestamp': datetime.utcnow().isoformat()
         }
-        
-        if self.connected:
-            self.mqtt_client.publish(
-                self.topics['exit_request'],
-                json.dumps(exit_data),
-                qos=1
-            )
-            logger.info(f"📤 Published exit request for validation: {rfid_uid}")
-            return True
-        else:
-            logger.warning("⚠️ Not connected to cloud, allowing exit")
-            self.grant_exit_access(rfid_uid, "Unknown", "Offline mode - exit allowed")
-            return False
+        return self.request_access('exit', self.topics['exit_request'], exit_data)
+    
+    def publish_access_request(self, kind, rfid_uid):
+        """Only publish an entry/exit request, for callers that act on the
+        cloud's answer themselves. Returns True once AWS IoT acknowledged it."""
+        topic = self.topics['rfid_scan'] if kind == 'entry' else self.topics['exit_request']
+        data = {
+            'rfid_uid': rfid_uid,
+            'door_id': 'door-001',
+            'timestamp': datetime.utcnow().isoformat()
+        }
+        if kind == 'entry':
+            data['scan_type'] = 'entry'
+        return self.connected and self._publish_request(kind, topic, data) is not None
     
     def grant_entry_access(self, rfid_uid, customer_name, assigned_cart, message):
         """Grant entry access and show cart assignment"""
@@ -393,12 +599,9 @@ class SmartDoorMQTTClient:
         # Fallback to local processing using existing database
         logger.info("🔄 Processing entry locally (offline mode)")
         
-        # Check local database for user
-        user = self.db.get_user_by_uid(rfid_uid)
-        if user:
-            self.grant_entry_access(rfid_uid, user[1], "Local Cart", "Offline mode - access granted")
-        else:
-            self.deny_entry_access(rfid_uid, "Unknown", "User not found in local database")
+        decision = self.authorize_locally('entry', rfid_uid)
+        self._act_on_decision('entry', rfid_uid, decision)
+        return decision
     
     def publish_door_status(self, status, message=""):
         """Publish door status to cloud"""
@@ -425,6 +628,29 @@ class SmartDoorMQTTClient:
             logger.error(f"❌ Error publishing status: {e}")
             return False
     
+    def publish_rfid_invalidation(self, rfid_uids):
+        """Drop cards from this process's RFID cache and tell every other door
+        process to do the same (INVALIDATE_RFID on the commands topic)"""
+        rfid_uids = [uid for uid in rfid_uids if uid]
+        for rfid_uid in rfid_uids:
+            get_rfid_cache().invalidate(rfid_uid)
+        if not self.connected:
+            return False
+        
+        message = {
+            'command': 'INVALIDATE_RFID',
+            'rfid_uids': rfid_uids,
+            'timestamp': datetime.utcnow().isoformat(),
+            'sent_by': 'door_admin'
+        }
+        
+        try:
+            result = self.mqtt_client.publish(self.topics['commands'], json.dumps(message), qos=1)
+            return result.rc == 0
+        except Exception as e:
+            logger.error(f"❌ Error publishing RFID invalidation: {e}")
+            return False
+    
     def publish_entry_event(self, rfid_uid, customer_name, granted=True, reason=""):
         """Publish door entry event"""
         if not self.connected:
@@ -504,12 +730,37 @@ class SmartDoorMQTTClient:
             logger.error(f"❌ Error connecting to AWS IoT Core: {e}")
             return False
     
+    def start(self):
+        """Connect in the background and stay connected.
+        
+        Returns at once; paho's network thread keeps retrying the connection
+        with backoff and reconnects after a drop, and on_connect subscribes
+        again each time. Calling it again does nothing.
+        """
+        with self._lock:
+            if self.started:
+                return True
+            if not self.setup_mqtt_client():
+                return False
+            self.mqtt_client.reconnect_delay_set(RECONNECT_MIN_DELAY, RECONNECT_MAX_DELAY)
+            logger.info(f"🔗 Connecting to {self.iot_endpoint}:{self.port} in the background")
+            self.mqtt_client.connect_async(self.iot_endpoint, self.port, 60)
+            self.mqtt_client.loop_start()
+            self.started = True
+        return True
+    
+    def wait_connected(self, timeout):
+        """Wait up to `timeout` seconds for the connection; returns whether it is up."""
+        return self._connected_event.wait(timeout)
+    
     def disconnect(self):
         """Disconnect from AWS IoT Core"""
         if self.mqtt_client:
             self.mqtt_client.loop_stop()
             self.mqtt_client.disconnect()
         self.connected = False
+        self.started = False
+        self._connected_event.clear()
         logger.info("👋 Disconnected from AWS IoT Core")
     
     def run(self):
@@ -551,28 +802,26 @@ class SmartDoorMQTTClient:
 
 # Flask integration helpers
 mqtt_client_instance = None
+_instance_lock = threading.Lock()
 
 def get_mqtt_client():
-    """Get global MQTT client instance"""
+    """The door process's one MQTT connection, shared by entry and exit.
+    
+    Created and started on first use, then kept connected for the life of
+    the process, so a card tap only costs a publish on an open connection.
+    Its client id is derived from the process (see process_client_id), so
+    the web app and the serial handler don't drop each other's connection.
+    """
     global mqtt_client_instance
-    if mqtt_client_instance is None:
-        mqtt_client_instance = SmartDoorMQTTClient()
+    with _instance_lock:
+        if mqtt_client_instance is None:
+            mqtt_client_instance = SmartDoorMQTTClient()
+            mqtt_client_instance.start()
     return mqtt_client_instance
 
 def start_mqtt_client_background():
-    """Start MQTT client in background thread"""
-    def run_mqtt():
-        client = get_mqtt_client()
-        if client.connect():
-            logger.info("🎉 MQTT client connected in background")
-            # Keep connection alive
-            while client.connected:
-                time.sleep(1)
-        else:
-            logger.error("❌ Failed to connect MQTT client in background")
-    
-    mqtt_thread = threading.Thread(target=run_mqtt, daemon=True)
-    mqtt_thread.start()
+    """Start the shared MQTT client; it connects and reconnects in paho's own thread"""
+    get_mqtt_client()
     logger.info("🚀 Started MQTT client in background thread")
 
 
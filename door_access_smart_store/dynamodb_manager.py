@@ -11,9 +11,14 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from botocore.exceptions import ClientError, NoCredentialsError
 import logging
+from config import Config
+from rfid_cache import get_rfid_cache
+from uid_normalizer import RFIDUIDNormalizer
 
 logger = logging.getLogger(__name__)
 
+CANONICAL_UID_INDEX = 'rfid-canonical-index'    # GSI on rfid_uid_canonical
+
 class DynamoDBManager:
     def __init__(self, region='us-east-1'):
         """Initialize DynamoDB manager with AWS credentials"""
@@ -56,34 +61,7 @@ class DynamoDBManager:
         ADDED: Normalize RFID UID to handle different formats
         Converts formats like '63 99 C2 2F' to '6399C22F'
         """
-        if not uid:
-            return None
-        
-        # Convert to string and strip whitespace
-        uid_str = str(uid).strip()
-        
-        # Remove common prefixes
-        if uid_str.lower().startswith('0x'):
-            uid_str = uid_str[2:]
-        
-        # Remove all separators (spaces, colons, dashes, dots)
-        import re
-        normalized = re.sub(r'[:\s\-\.]', '', uid_str)
-        
-        # Convert to uppercase
-        normalized = normalized.upper()
-        
-        # Validate that it's a valid hex string
-        if not re.match(r'^[0-9A-F]+$', normalized):
-            logger.warning(f"Invalid UID format: {normalized}")
-            return None
-        
-        # Pad with leading zeros if needed (common RFID UIDs are 8 characters)
-        if len(normalized) < 8:
-            normalized = normalized.zfill(8)
-        
-        logger.debug(f"Normalized UID: '{uid}' → '{normalized}'")
-        return normalized
+        return RFIDUIDNormalizer.normalize_uid(uid)
     
     def _generate_uid_variants(self, uid):
         """
@@ -115,11 +93,70 @@ class DynamoDBManager:
         return unique_variants
     
     def get_customer_by_rfid(self, rfid_uid):
-        """ENHANCED: Get customer information by RFID UID with format handling"""
+        """Get customer information by RFID UID, through the RFID cache"""
+        return get_rfid_cache().get(rfid_uid, self._lookup_customer_by_rfid)
+    
+    def _lookup_customer_by_rfid(self, rfid_uid):
+        """Get customer information by RFID UID with one query on its canonical form"""
         try:
             customers_table = self.dynamodb.Table(self.tables['customers'])
             
-            logger.info(f"🔍 Looking up customer with RFID: {rfid_uid}")
+            canonical_uid = self._normalize_uid(rfid_uid)
+            logger.info(f"🔍 Looking up customer with RFID: {rfid_uid} → {canonical_uid}")
+            
+            if not canonical_uid:
+                return {
+                    'found': False,
+                    'rfid_card_uid': rfid_uid,
+                    'reason': 'Invalid UID format',
+                    'variants_tried': []
+                }
+            
+            try:
+                response = customers_table.query(
+                    IndexName=CANONICAL_UID_INDEX,
+                    KeyConditionExpression='rfid_uid_canonical = :uid',
+                    ExpressionAttributeValues={':uid': canonical_uid}
+                )
+                customers = response.get('Items', [])
+            except ClientError as e:
+                # The index may not exist yet on a table that is being migrated
+                if not Config.RFID_VARIANT_LOOKUP:
+                    raise
+                logger.warning(f"⚠️ {CANONICAL_UID_INDEX} query failed, trying UID variants: {e}")
+                customers = []
+            
+            if customers:
+                customer = customers[0]  # Should be unique
+                logger.info(f"✅ Customer found: {customer.get('customer_name', 'Unknown')}")
+                return self._customer_result(customer, customer.get('rfid_card_uid', canonical_uid), rfid_uid)
+            
+            if Config.RFID_VARIANT_LOOKUP:
+                # Compatibility mode for customers written before rfid_uid_canonical
+                return self._lookup_customer_by_rfid_variants(rfid_uid)
+            
+            logger.warning(f"❌ No customer found with RFID: {canonical_uid}")
+            return {
+                'found': False,
+                'rfid_card_uid': rfid_uid,
+                'reason': 'RFID not registered',
+                'variants_tried': [canonical_uid]
+            }
+                
+        except Exception as e:
+            logger.error(f"❌ Error looking up customer by RFID: {e}")
+            return {
+                'found': False,
+                'rfid_card_uid': rfid_uid,
+                'reason': 'Database error',
+                'error': str(e)
+            }
+    
+    def _lookup_customer_by_rfid_variants(self, rfid_uid):
+        """ENHANCED: Get customer information by RFID UID with format handling
+        (one rfid-lookup-index query per UID variant; compatibility mode only)"""
+        try:
+            customers_table = self.dynamodb.Table(self.tables['customers'])
             
             # Generate all possible UID variants
             uid_variants = self._generate_uid_variants(rfid_uid)
@@ -140,23 +177,7 @@ class DynamoDBManager:
                     if customers:
                         customer = customers[0]  # Should be unique
                         logger.info(f"✅ Customer found with UID format '{variant_uid}': {customer.get('customer_name', 'Unknown')}")
-                        
-                        # Convert Decimal types for JSON serialization
-                        customer_data = self._convert_decimals(customer)
-                        
-                        return {
-                            'found': True,
-                            'customer_id': customer_data.get('customer_id'),
-                            'customer_name': customer_data.get('customer_name', 'Unknown'),
-                            'rfid_card_uid': customer_data.get('rfid_card_uid'),
-                            'customer_type': customer_data.get('customer_type', 'REGULAR'),
-                            'membership_status': customer_data.get('membership_status', 'ACTIVE'),
-                            'discount_percentage': customer_data.get('discount_percentage', 0),
-                            'total_spent': customer_data.get('total_spent', 0.0),
-                            'total_visits': customer_data.get('total_visits', 0),
-                            'matched_format': variant_uid,  # ADDED: Track which format worked
-                            'original_input': rfid_uid      # ADDED: Track original input
-                        }
+                        return self._customer_result(customer, variant_uid, rfid_uid)
                 
                 except Exception as e:
                     logger.debug(f"Error trying UID variant '{variant_uid}': {e}")
@@ -180,6 +201,40 @@ class DynamoDBManager:
                 'error': str(e)
             }
     
+    def _customer_result(self, customer, matched_format, rfid_uid):
+        """Shape a customers table item as a get_customer_by_rfid() answer"""
+        # Convert Decimal types for JSON serialization
+        customer_data = self._convert_decimals(customer)
+        
+        return {
+            'found': True,
+            'customer_id': customer_data.get('customer_id'),
+            'customer_name': customer_data.get('customer_name', 'Unknown'),
+            'rfid_card_uid': customer_data.get('rfid_card_uid'),
+            'customer_type': customer_data.get('customer_type', 'REGULAR'),
+            'membership_status': customer_data.get('membership_status', 'ACTIVE'),
+            'discount_percentage': customer_data.get('discount_percentage', 0),
+            'total_spent': customer_data.get('total_spent', 0.0),
+            'total_visits': customer_data.get('total_visits', 0),
+            'matched_format': matched_format,  # ADDED: Track which format worked
+            'original_input': rfid_uid         # ADDED: Track original input
+        }
+    
+    def set_canonical_uid(self, customer_id, canonical_uid):
+        """Store a customer's normalized UID in rfid_uid_canonical"""
+        try:
+            customers_table = self.dynamodb.Table(self.tables['customers'])
+            customers_table.update_item(
+                Key={'customer_id': customer_id},
+                UpdateExpression='SET rfid_uid_canonical = :canonical',
+                ConditionExpression='attribute_exists(customer_id)',
+                ExpressionAttributeValues={':canonical': canonical_uid}
+            )
+            return True
+        except Exception as e:
+            logger.error(f"❌ Error setting canonical UID for {customer_id}: {e}")
+            return False
+    
     def create_customer(self, customer_name, rfid_uid, customer_type='REGULAR'):
         """ENHANCED: Create new customer in DynamoDB with normalized UID"""
         try:
@@ -197,8 +252,9 @@ class DynamoDBManager:
             
             logger.info(f"📝 Creating customer with normalized UID: '{rfid_uid}' → '{normalized_uid}'")
             
-            # Check if RFID already exists (using variant matching)
-            existing = self.get_customer_by_rfid(normalized_uid)
+            # Check if RFID already exists (by canonical UID), asking
+            # DynamoDB itself rather than a possibly stale cache
+            existing = self._lookup_customer_by_rfid(normalized_uid)
             if existing['found']:
                 logger.warning(f"⚠️  Customer with RFID {normalized_uid} already exists")
                 return {
@@ -217,6 +273,7 @@ class DynamoDBManager:
                 'customer_id': customer_id,
                 'customer_name': customer_name,
                 'rfid_card_uid': normalized_uid,  # CHANGED: Store normalized UID
+                'rfid_uid_canonical': normalized_uid,
                 'customer_type': customer_type,
                 'membership_status': 'ACTIVE',
                 'discount_percentage': Decimal('0'),
@@ -227,6 +284,7 @@ class DynamoDBManager:
             }
             
             customers_table.put_item(Item=customer_data)
+            get_rfid_cache().invalidate(normalized_uid)
             
             logger.info(f"✅ Created customer: {customer_name} ({customer_id}) with UID: {normalized_uid}")
             
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+RFID Authorization Cache
+Two tiers in front of the DynamoDB customer lookup: an in-process LRU and
+the temp_rfid_cache table in the local MariaDB
+"""
+
+import threading
+import time
+import logging
+from collections import OrderedDict
+from mysql.connector import Error
+from uid_normalizer import RFIDUIDNormalizer
+
+logger = logging.getLogger(__name__)
+
+POSITIVE_TTL = 120     # seconds a registered card is answered without asking the cloud (temp_rfid_cache's 2 minutes)
+NEGATIVE_TTL = 30      # seconds an unregistered card is remembered as unregistered
+STALE_TTL = 600        # seconds past POSITIVE_TTL a registered card is still answered while it is refreshed
+LRU_SIZE = 512         # cards kept in process
+TABLE_RETRY = 30       # seconds before temp_rfid_cache is tried again after it was unavailable
+
+class _Entry:
+    __slots__ = ('customer', 'fresh_until', 'stale_until')
+
+    def __init__(self, customer, fresh_until, stale_until):
+        self.customer = customer
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+class RFIDAuthCache:
+    """Customer lookups by card, cached in process and in temp_rfid_cache.
+
+    get() answers from the LRU, then from temp_rfid_cache, and only then
+    calls the loader (the DynamoDB lookup), writing the answer back to both
+    tiers. Registered cards are kept for `positive_ttl` and unregistered ones
+    for `negative_ttl`. A registered card past its TTL but within
+    `stale_ttl` is answered at once while one background thread refreshes
+    it. Entries are keyed by normalized UID, so every format of a card
+    shares one entry. invalidate() drops a card from both tiers.
+    """
+
+    def __init__(self, db=None, positive_ttl=POSITIVE_TTL, negative_ttl=NEGATIVE_TTL,
+                 stale_ttl=STALE_TTL, size=LRU_SIZE):
+        self.db = db    # DatabaseManager for temp_rfid_cache, or None for the LRU alone
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.size = size
+
+        self._entries = OrderedDict()   # normalized uid -> _Entry, least recently used first
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._table_ready = None
+        self._table_retry_at = 0
+        self._stats = {'memory_hits': 0, 'table_hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def get(self, rfid_uid, loader):
+        """Customer info for a card, as returned by `loader(rfid_uid)`"""
+        key = self._key(rfid_uid)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.stale_until:
+                self._entries.move_to_end(key)
+                if now < entry.fresh_until:
+                    self._stats['memory_hits'] += 1
+                    return entry.customer
+                self._stats['stale_hits'] += 1
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+            else:
+                entry = None
+
+        if entry is not None:
+            if refresh:
+                self._start_refresh(key, rfid_uid, loader, claimed=True)
+            return entry.customer
+
+        customer, ttl = self._read_table(key)
+        if customer is not None:
+            self._count('table_hits')
+            if ttl <= 0:
+                self._start_refresh(key, rfid_uid, loader)
+            return customer
+
+        self._count('misses')
+        return self._load(key, rfid_uid, loader)
+
+    def peek(self, rfid_uid):
+        """The cached customer info for a card, stale or not, without asking
+        the cloud; None if neither tier knows the card."""
+        key = self._key(rfid_uid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() < entry.stale_until:
+                return entry.customer
+        return self._read_table(key)[0]
+
+    def invalidate(self, rfid_uid):
+        """Forget a card in both tiers, e.g. after the admin portal assigned it"""
+        key = self._key(rfid_uid)
+        with self._lock:
+            self._entries.pop(key, None)
+        if self._table_available():
+            self._execute("DELETE FROM temp_rfid_cache WHERE rfid_card_uid = %s", (key,))
+        logger.info(f"🗑️ RFID cache entry dropped: {key}")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), table=bool(self._table_ready))
+
+    def _key(self, rfid_uid):
+        return RFIDUIDNormalizer.normalize_uid(rfid_uid) or str(rfid_uid).strip().upper()
+
+    def _load(self, key, rfid_uid, loader):
+        customer = loader(rfid_uid)
+        # A failed lookup says nothing about the card, so it isn't cached
+        if customer.get('found') or 'error' not in customer:
+            self._remember(key, customer)
+            self._write_table(key, customer)
+        return customer
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _start_refresh(self, key, rfid_uid, loader, claimed=False):
+        """Reload a card in the background; one refresh per card at a time"""
+        if not claimed:
+            with self._lock:
+                if key in self._refreshing:
+                    return
+                self._refreshing.add(key)
+        threading.Thread(target=self._refresh, args=(key, rfid_uid, loader), daemon=True).start()
+
+    def _refresh(self, key, rfid_uid, loader):
+        try:
+            self._load(key, rfid_uid, loader)
+            self._count('refreshes')
+        except Exception as e:
+            logger.warning(f"⚠️ RFID cache refresh failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _remember(self, key, customer, ttl=None):
+        found = customer.get('found')
+        if ttl is None:
+            ttl = self.positive_ttl if found else self.negative_ttl
+        now = time.monotonic()
+        entry = _Entry(customer, now + ttl, now + ttl + (self.stale_ttl if found else 0))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    # temp_rfid_cache tier
+
+    def _table_available(self):
+        """Add the columns this cache needs to temp_rfid_cache once; without
+        MariaDB or the table the cache keeps to the LRU, trying the table
+        again every TABLE_RETRY seconds (MariaDB may still be starting)."""
+        if self._table_ready or self.db is None:
+            return bool(self._table_ready)
+        now = time.monotonic()
+        if now < self._table_retry_at:
+            return False
+        self._table_ready = self._execute("""
+            ALTER TABLE temp_rfid_cache
+                ADD COLUMN IF NOT EXISTS customer_id VARCHAR(50) AFTER rfid_card_uid,
+                ADD COLUMN IF NOT EXISTS cloud_rfid_uid VARCHAR(32) AFTER customer_id
+        """)
+        if not self._table_ready:
+            self._table_retry_at = now + TABLE_RETRY
+            logger.warning(f"⚠️ temp_rfid_cache unavailable, caching RFID lookups in memory only "
+                           f"(retrying in {TABLE_RETRY} s)")
+        return self._table_ready
+
+    def _read_table(self, key):
+        """(customer, seconds of TTL left) from temp_rfid_cache, or (None, 0)"""
+        if not self._table_available():
+            return None, 0
+        rows = self._query("""
+            SELECT customer_id, cloud_rfid_uid, customer_name, customer_type, membership_status,
+                   TIMESTAMPDIFF(SECOND, NOW(), expires_at) AS ttl
+            FROM temp_rfid_cache
+            WHERE rfid_card_uid = %s AND expires_at > NOW() - INTERVAL %s SECOND
+        """, (key, self.stale_ttl))
+        if not rows:
+            return None, 0
+
+        customer_id, cloud_rfid_uid, customer_name, customer_type, membership_status, ttl = rows[0]
+        if customer_id is None:
+            if ttl <= 0:
+                return None, 0
+            customer = {'found': False, 'rfid_card_uid': key, 'reason': 'RFID not registered (cached)'}
+        else:
+            customer = {
+                'found': True,
+                'customer_id': customer_id,
+                'customer_name': customer_name or 'Unknown',
+                'rfid_card_uid': cloud_rfid_uid or key,
+                'customer_type': customer_type or 'REGULAR',
+                'membership_status': membership_status or 'ACTIVE',
+                'matched_format': cloud_rfid_uid or key,
+                'original_input': key
+            }
+        # Served from the table for what is left of its TTL; a stale row
+        # comes back already due for a refresh
+        self._remember(key, customer, ttl=max(ttl, 0))
+        return customer, ttl
+
+    def _write_table(self, key, customer):
+        if not self._table_available():
+            return
+        found = bool(customer.get('found'))
+        active = found and customer.get('membership_status', 'ACTIVE') == 'ACTIVE'
+        self._execute("""
+            INSERT INTO temp_rfid_cache
+                (rfid_card_uid, customer_id, cloud_rfid_uid, customer_name, customer_type, membership_status,
+                 access_granted, can_enter, can_exit, vip_access, cached_at, expires_at, cloud_verified)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, TRUE, %s, NOW(), NOW() + INTERVAL %s SECOND, TRUE)
+            ON DUPLICATE KEY UPDATE
+                customer_id = VALUES(customer_id),
+                cloud_rfid_uid = VALUES(cloud_rfid_uid),
+                customer_name = VALUES(customer_name),
+                customer_type = VALUES(customer_type),
+                membership_status = VALUES(membership_status),
+                access_granted = VALUES(access_granted),
+                can_enter = VALUES(can_enter),
+                vip_access = VALUES(vip_access),
+                cached_at = VALUES(cached_at),
+                expires_at = VALUES(expires_at)
+        """, (key, customer.get('customer_id') if found else None,
+              customer.get('matched_format') if found else None,
+              customer.get('customer_name') if found else None,
+              customer.get('customer_type', 'REGULAR') if found else 'REGULAR',
+              customer.get('membership_status', 'ACTIVE') if found else 'ACTIVE',
+              active, active, found and customer.get('customer_type') == 'VIP',
+              self.positive_ttl if found else self.negative_ttl))
+
+    def _query(self, query, params):
+        conn = self.db.get_connection()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        except Error as e:
+            logger.debug(f"temp_rfid_cache read failed: {e}")
+            return None
+        finally:
+            if conn.is_connected():
+                conn.close()
+
+    def _execute(self, query, params=()):
+        conn = self.db.get_connection()
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            cursor.close()
+            return True
+        except Error as e:
+            logger.debug(f"temp_rfid_cache write failed: {e}")
+            return False
+        finally:
+            if conn.is_connected():
+                conn.close()
+
+
+# One cache per process, shared by the DynamoDB lookups, the MQTT client's
+# local decisions and its invalidation commands
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+def get_rfid_cache():
+    """The process's RFID cache, backed by the door's local database"""
+    global _shared_cache
+    with _shared_lock:
+        if _shared_cache is None:
+            from database import DatabaseManager
+            _shared_cache = RFIDAuthCache(DatabaseManager())
+    return _shared_cache
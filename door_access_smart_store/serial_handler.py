@@ -1,11 +1,69 @@
 import serial
 import time
+import queue
 import threading
 import requests
 from database import DatabaseManager
+from command_bus import CommandBusServer
 from config import Config
 import re
 
+COMMAND_POLL_INTERVAL = 5.0    # seconds between checks of the fallback commands table
+
+# Web/cloud commands and the Arduino command each one is sent as
+ARDUINO_COMMANDS = {
+    "OPEN_DOOR": "MANUAL_OPEN",
+    "REGISTER_MODE": "REGISTER_MODE",
+    "MONITOR_MODE": "MONITOR_MODE",
+    "CALIBRATE_IR": "CALIBRATE_IR",
+    "GET_STATUS": "GET_STATUS"
+}
+
+def arduino_command(command):
+    """The Arduino command for a web/cloud command, or None if it has none"""
+    if command.startswith("ADD_USER:"):
+        # Forward the ADD_USER command directly to Arduino
+        return command
+    return ARDUINO_COMMANDS.get(command)
+
+class SerialLineReader(threading.Thread):
+    """Blocks on the Arduino's port and queues each line as soon as it is complete.
+    
+    Everything waiting on the port is read at once, so a burst of messages
+    reaches the main loop together instead of one line per tick. Events are
+    (kind, payload) tuples: ('LINE', message) or ('DISCONNECTED', reason).
+    """
+    
+    def __init__(self, serial_conn, events):
+        super().__init__(name="door-serial-reader", daemon=True)
+        self.serial_conn = serial_conn
+        self.events = events
+        self._buffer = bytearray()
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                # read() blocks until a byte arrives or the port timeout expires
+                data = self.serial_conn.read(max(self.serial_conn.in_waiting, 1))
+            except (serial.SerialException, OSError, TypeError) as e:
+                if not self._stop_event.is_set():
+                    self.events.put(('DISCONNECTED', str(e)))
+                return
+            
+            if not data:
+                continue
+            self._buffer += data
+            *lines, rest = self._buffer.split(b"\n")
+            self._buffer = bytearray(rest)
+            for raw in lines:
+                message = raw.decode('utf-8', errors='ignore').strip()
+                if message:
+                    self.events.put(('LINE', message))
+    
+    def stop(self):
+        self._stop_event.set()
+
 class ArduinoHandler:
     def __init__(self):
         self.port = Config.ARDUINO_PORT
@@ -15,6 +73,10 @@ class ArduinoHandler:
         self.running = False
         self.flask_url = "http://localhost:5000"
         
+        # Arduino lines and pushed commands, handled in order by run()
+        self.events = queue.Queue()
+        self.command_bus = CommandBusServer(lambda command: self.events.put(('COMMAND', command)))
+        
     def connect(self):
         try:
             self.serial_conn = serial.Serial(self.port, self.baudrate, timeout=1)
@@ -211,7 +273,8 @@ class ArduinoHandler:
         if status == 'granted':
             # Access granted - door should open
             print(f"✅ Access granted for {user_name} ({action})")
-            self.send_command("MANUAL_OPEN")  # Open door
+            if not result.get('door_command_queued'):
+                self.send_command("MANUAL_OPEN")  # Open door
             
             # Display message on LCD/console
             if action == 'entry':
@@ -271,30 +334,20 @@ class ArduinoHandler:
             print(f"❌ Error in fallback processing: {e}")
             self.display_message("System error - try again")
     
+    def execute_command(self, command):
+        """Send a web/cloud command to the Arduino"""
+        print(f"📋 Processing web command: {command}")
+        arduino = arduino_command(command)
+        if arduino:
+            self.send_command(arduino)
+        else:
+            print(f"⚠️ Unknown web command: {command}")
+    
     def check_pending_commands(self):
-        """Check for pending commands from web interface"""
+        """Run commands the web interface persisted while the command bus was down"""
         commands = self.db.get_pending_commands()
         for cmd_id, command in commands:
-            print(f"📋 Processing web command: {command}")
-            
-            if command == "OPEN_DOOR":
-                self.send_command("MANUAL_OPEN")
-                
-            elif command == "REGISTER_MODE":
-                self.send_command("REGISTER_MODE")
-                
-            elif command == "MONITOR_MODE":
-                self.send_command("MONITOR_MODE")
-                
-            elif command == "CALIBRATE_IR":
-                self.send_command("CALIBRATE_IR")
-                
-            elif command.startswith("ADD_USER:"):
-                # Forward the ADD_USER command directly to Arduino
-                self.send_command(command)
-                
-            elif command == "GET_STATUS":
-                self.send_command("GET_STATUS")
+            self.execute_command(command)
             
             # Mark command as completed
             self.db.mark_command_completed(cmd_id)
@@ -304,6 +357,9 @@ class ArduinoHandler:
             return
         
         self.running = True
+        reader = SerialLineReader(self.serial_conn, self.events)
+        reader.start()
+        self.command_bus.start()
         print("🚀 Arduino IoT handler started")
         print("🎮 Arduino is now controlled by the web interface")
         print("🌐 Use the Flask app to send commands")
@@ -313,27 +369,40 @@ class ArduinoHandler:
         time.sleep(1)
         self.send_command("GET_STATUS")
         
+        last_command_check = 0
+        
         while self.running:
+            # Block until the Arduino says something, a command is pushed or
+            # it's time to drain commands persisted while the bus was down
+            timeout = max(0, last_command_check + COMMAND_POLL_INTERVAL - time.time())
             try:
-                # Check for Arduino messages
-                if self.serial_conn.in_waiting > 0:
-                    message = self.serial_conn.readline().decode('utf-8', errors='ignore')
-                    if message.strip():
-                        self.parse_arduino_message(message)
-                
-                # Check for pending commands from web interface
-                self.check_pending_commands()
+                kind, payload = self.events.get(timeout=timeout)
+            except queue.Empty:
+                kind, payload = None, None
+            
+            try:
+                if kind == 'LINE':
+                    self.parse_arduino_message(payload)
+                elif kind == 'COMMAND':
+                    self.execute_command(payload)
+                elif kind == 'DISCONNECTED':
+                    print(f"❌ Lost connection to Arduino: {payload}")
+                    self.running = False
                 
-                time.sleep(0.5)  # Check every 500ms
+                if self.running and time.time() - last_command_check >= COMMAND_POLL_INTERVAL:
+                    last_command_check = time.time()
+                    self.check_pending_commands()
                 
             except Exception as e:
                 print(f"Error in main loop: {e}")
-                time.sleep(1)
         
+        self.command_bus.stop()
+        reader.stop()
         self.disconnect()
     
     def stop(self):
         self.running = False
+        self.events.put(('STOP', None))
 
 def main():
     print("🏪 Smart Convenience Store - IoT Arduino Handler")
@@ -35,15 +35,15 @@ def test_mqtt_client():
     # Test 2: Entry request
     print("\n🚪 Test 2: Processing entry request...")
     test_rfid = "ABC123456789"
-    success = client.process_entry_request(test_rfid)
-    print(f"Entry request for {test_rfid}: {'✅ Sent' if success else '❌ Failed'}")
+    decision = client.process_entry_request(test_rfid)
+    print(f"Entry request for {test_rfid}: {'✅ Granted' if decision['allowed'] else '❌ Denied'} ({decision['source']})")
     
     time.sleep(3)
     
     # Test 3: Exit request
     print("\n🚶 Test 3: Processing exit request...")
-    success = client.process_exit_request(test_rfid)
-    print(f"Exit request for {test_rfid}: {'✅ Sent' if success else '❌ Failed'}")
+    decision = client.process_exit_request(test_rfid)
+    print(f"Exit request for {test_rfid}: {'✅ Granted' if decision['allowed'] else '❌ Denied'} ({decision['source']})")
     
     time.sleep(2)
     
@@ -5,6 +5,7 @@ Handles different RFID UID formats and normalizes them for consistent lookup
 """
 
 import re
+import sys
 import logging
 
 logger = logging.getLogger(__name__)
@@ -156,12 +157,13 @@ def enhanced_customer_lookup(db_manager, rfid_uid):
         'variants_tried': len(uid_variants)
     }
 
-def update_existing_uids_in_database(db_manager):
+def update_existing_uids_in_database(db_manager, apply=False):
     """
-    Utility function to normalize existing UIDs in database
-    Run this once to clean up existing data
+    Utility function to backfill rfid_uid_canonical on existing customers
+    Run this once, first without apply to review the changes, then with
+    apply=True (`python uid_normalizer.py --backfill --apply`)
     """
-    print("🔧 Normalizing existing UIDs in database...")
+    print("🔧 Backfilling canonical UIDs in database...")
     
     try:
         # Get all customers
@@ -169,28 +171,54 @@ def update_existing_uids_in_database(db_manager):
         normalizer = RFIDUIDNormalizer()
         
         updated_count = 0
+        failed_count = 0
+        invalid_uids = []
+        owners = {}     # canonical UID -> customer IDs holding it
         
         for customer in customers:
             current_uid = customer.get('rfid_card_uid')
             if not current_uid:
                 continue
             
+            customer_id = customer.get('customer_id')
             normalized_uid = normalizer.normalize_uid(current_uid)
+            if not normalized_uid:
+                invalid_uids.append((customer_id, current_uid))
+                continue
+            
+            owners.setdefault(normalized_uid, []).append(customer_id)
+            if customer.get('rfid_uid_canonical') == normalized_uid:
+                continue
             
-            if normalized_uid and normalized_uid != current_uid:
-                print(f"Normalizing: '{current_uid}' → '{normalized_uid}'")
-                
-                # In a real implementation, you'd update the customer record
-                # customer['rfid_card_uid'] = normalized_uid
-                # db_manager.update_customer(customer)
-                
+            print(f"Normalizing: {customer_id} '{current_uid}' → '{normalized_uid}'")
+            if not apply:
                 updated_count += 1
+            elif db_manager.set_canonical_uid(customer_id, normalized_uid):
+                updated_count += 1
+            else:
+                failed_count += 1
+        
+        if apply:
+            print(f"✅ Backfilled {updated_count} canonical UIDs ({failed_count} failed)")
+        else:
+            print(f"✅ Found {updated_count} customers that need a canonical UID")
+            print("   Run again with --apply to write them")
+        
+        for customer_id, uid in invalid_uids:
+            print(f"⚠️  {customer_id}: '{uid}' is not a valid UID and can't be looked up")
+        for canonical_uid, customer_ids in owners.items():
+            if len(customer_ids) > 1:
+                print(f"⚠️  {canonical_uid} is assigned to several customers: {', '.join(customer_ids)}")
         
-        print(f"✅ Found {updated_count} UIDs that need normalization")
-        print("   Run the actual update function to apply changes")
+        return updated_count
         
     except Exception as e:
         print(f"❌ Error normalizing UIDs: {e}")
+        return 0
 
 if __name__ == "__main__":
-    test_uid_normalizer()
+    if '--backfill' in sys.argv:
+        from dynamodb_manager import DynamoDBManager
+        update_existing_uids_in_database(DynamoDBManager(), apply='--apply' in sys.argv)
+    else:
+        test_uid_normalizer()
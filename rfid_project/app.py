@@ -1,11 +1,10 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session as flask_session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, g, Response, stream_with_context, session as flask_session
 import mysql.connector
 import json
 from datetime import datetime
 import time
 import logging
 import secrets
-import boto3
 import uuid
 from dotenv import load_dotenv
 import os
@@ -13,6 +12,19 @@ import traceback
 import decimal
 from decimal import Decimal
 from mqtt_client import SmartCartMQTT
+from command_bus import send_command, EventSubscriber
+from db_pool import ConnectionPool, PoolTimeout
+from event_stream import EventHub
+from weight_buffer import WeightBuffer
+from migrations import migrate, current_version
+from product_catalog import ProductCatalog
+from cloud_outbox import OutboxSender, enqueue, outbox_stats
+from dynamo_batch import DynamoWriteBatch
+from mqtt_batch import MqttPublishBatch
+from aws_clients import AwsClientRegistry
+from discounts import DiscountEngine
+from cart_state import Cart, CartStore
+from metrics import Metrics
 
 class DecimalEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -38,6 +50,9 @@ logging.basicConfig(
 app = Flask(__name__)
 app.secret_key = secrets.token_hex(16)
 
+# Route, MySQL and AWS call latencies, served on /metrics for Prometheus
+metrics = Metrics()
+
 # AWS Configuration
 AWS_REGION = 'us-east-1'
 ACCOUNT_ID = '378084046672'
@@ -51,9 +66,24 @@ DYNAMODB_TABLES = {
     'products': 'iot-convenience-store-products-production',
     'discounts': 'iot-convenience-store-discount-effectiveness-production'
 }
+# Shared AWS clients - created once and reused by every request thread and the
+# cloud outbox sender. Size the keep-alive pools for the Flask worker threads
+# (see DB_POOL_SIZE) plus the background threads.
+AWS_POOL_SIZE = int(os.getenv('AWS_POOL_SIZE', '10'))
+IOT_DATA_ENDPOINT = os.getenv('IOT_DATA_ENDPOINT', 'https://a2amimoaybc420-ats.iot.us-east-1.amazonaws.com')
+# DYNAMODB_ENDPOINT points DynamoDB at a stand-in such as DynamoDB Local (see benchmark.py)
+DYNAMODB_ENDPOINT = os.getenv('DYNAMODB_ENDPOINT')
+aws_clients = AwsClientRegistry(
+    AWS_REGION,
+    max_pool_connections=AWS_POOL_SIZE,
+    endpoints={'iot-data': IOT_DATA_ENDPOINT, 'dynamodb': DYNAMODB_ENDPOINT},
+    on_call=metrics.record_aws_call
+)
+aws_clients.warm(clients=('lambda', 'iot-data'))
+
 # Initialize DynamoDB client
 try:
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION)
+    dynamodb = aws_clients.resource('dynamodb')
     # Table references
     sessions_table = dynamodb.Table(DYNAMODB_TABLES['sessions'])
     customers_table = dynamodb.Table(DYNAMODB_TABLES['customers'])
@@ -74,9 +104,67 @@ DB_CONFIG = {
     'user': 'shifaz',
     'password': 'Shifaz1122@',
     'host': 'localhost',
-    'database': 'automated_shopping_cart'
+    'database': os.getenv('CART_DB_NAME', 'automated_shopping_cart')
 }
 
+# Shared connection pool - sized for the Flask worker threads plus the UI pollers
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '5'))
+db_pool = ConnectionPool(DB_CONFIG, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT, on_query=metrics.record_query)
+
+# Scan, weight and fraud events pushed by the serial handler, fanned out to /stream.
+# Weight readings are also kept in a ring buffer that the weight routes answer from.
+event_hub = EventHub()
+weight_buffer = WeightBuffer()
+product_catalog = ProductCatalog()
+
+# Each session's validated items and totals, mirrored to temp_active_sessions
+cart_store = CartStore()
+
+# Each session's discounts, read from the discount table when it starts
+discount_engine = DiscountEngine(discounts_table if dynamodb else None, product_catalog)
+
+GROCERY_MIN_WEIGHT = 10        # grams; anything lighter means the scale is empty
+GROCERY_WEIGHT_MAX_AGE = 10    # seconds a reading still describes what is on the scale
+GROCERY_WEIGHT_MAX_WAIT = 10   # longest a /get_grocery_weight long-poll may wait
+WEIGH_ITEM_TIMEOUT = 5         # seconds /weigh_item waits for a stable weight
+READ_WEIGHT_TIMEOUT = 10       # seconds /read_weight_control waits for a new reading
+
+def on_serial_event(event_type, data):
+    if event_type == 'scan':
+        # The serial handler resolved (and may have just created) this product
+        product_catalog.put(data['product_id'], data['product_name'], data['price'],
+                            data['is_grocery'], data['tag_id'])
+    elif event_type == 'weight':
+        reading = weight_buffer.add(data['weight'], data.get('stable'), data.get('item_id'))
+        data = dict(data, stable=reading.stable)
+    elif event_type == 'fraud':
+        record_cart_fraud()
+    event_hub.publish(event_type, data)
+
+def record_cart_fraud():
+    """Count a fraud alert against the cart in use."""
+    cart = cart_store.active()
+    if cart is None:
+        return
+    cart.count_fraud()
+    try:
+        conn = db_pool.acquire()
+    except (PoolTimeout, mysql.connector.Error) as err:
+        logging.error(f"Could not save cart fraud count: {err}")
+        return
+    try:
+        cursor = conn.cursor()
+        cart_store.persist(cursor, cart)
+        conn.commit()
+        cursor.close()
+    except mysql.connector.Error as err:
+        logging.error(f"Could not save cart fraud count: {err}")
+    finally:
+        conn.close()
+
+event_subscriber = EventSubscriber(on_serial_event)
+
 class CloudSessionManager:
     def __init__(self):
         self.current_session = None
@@ -153,8 +241,13 @@ class CloudSessionManager:
             logging.error(f"[ERROR] Error creating cloud session: {str(e)}")
             return None
     
-    def end_cloud_session(self, session_id, total_amount=0, item_count=0, items_data=None):
-        """End session and trigger cloud processing"""
+    def end_cloud_session(self, session_id, total_amount=0, item_count=0):
+        """Mark the cloud session completed.
+        
+        Called from the cloud outbox; the session processor is triggered by a
+        separate 'session_process' entry (see session_processor_payload).
+        Returns False if it should be retried.
+        """
         if not dynamodb:
             logging.warning("AWS DynamoDB not available, skipping cloud session end")
             return False
@@ -163,7 +256,7 @@ class CloudSessionManager:
             # Convert to Decimal for DynamoDB
             total_amount_decimal = Decimal(str(total_amount))
             
-            # Update session in DynamoDB
+            # Update session in DynamoDB (setting the same values twice is harmless)
             sessions_table.update_item(
                 Key={'session_id': session_id},
                 UpdateExpression='SET session_status = :status, end_time = :end_time, total_amount = :amount, total_items = :items',
@@ -175,120 +268,79 @@ class CloudSessionManager:
                 }
             )
             
-            # Trigger Lambda function for session processing
-            try:
-                lambda_client = boto3.client('lambda', region_name=AWS_REGION)
-                
-                # FIXED: Send proper payload with customer_id and items data
-                payload = {
-                    'session_id': session_id,
-                    'customer_id': self.current_session.get('customer_id') if self.current_session else None,
-                    'trigger': 'session_end',
-                    'timestamp': datetime.now().isoformat(),
-                    'total_amount': float(total_amount_decimal),
-                    'total_items': item_count,
-                    # Add items data for active sessions update
-                    'items': [],  # Will be filled below
-                    'customer_name': self.current_session.get('customer_name') if self.current_session else None
-                }
-                
-                # Get the actual items from the session for Lambda processing
-                try:
-                    conn = get_db_connection()
-                    if conn:
-                        cursor = conn.cursor(dictionary=True)
-                        cursor.execute("""
-                            SELECT s.id, s.tag_id, s.weight, p.product_name, p.price, p.is_grocery
-                            FROM scanned_items s
-                            JOIN product_data p ON s.product_id = p.id
-                            WHERE s.is_validated = TRUE
-                        """)
-                        items = cursor.fetchall()
-                        
-                        # Format items for Lambda
-                        payload['items'] = [
-                            {
-                                'id': item['id'],
-                                'product_name': item['product_name'],
-                                'price': float(item['price']),
-                                'weight': float(item['weight']) if item['weight'] else None,
-                                'is_grocery': item['is_grocery'],
-                                'tag_id': item['tag_id']
-                            }
-                            for item in items
-                        ]
-                        
-                        cursor.close()
-                        conn.close()
-                        
-                        logging.info(f"Sending {len(payload['items'])} items to Lambda for session {session_id}")
-                        
-                except Exception as items_err:
-                    logging.error(f"Error getting items for Lambda payload: {items_err}")
-                    # Continue without items if there's an error
-                
-                # Invoke session processor Lambda
-                lambda_client.invoke(
-                    FunctionName='iot-convenience-store-session-processor-production',
-                    InvocationType='Event',  # Async invocation
-                    Payload=json.dumps(payload, cls=DecimalEncoder)
-                )
-                
-                logging.info(f"[SUCCESS] Cloud session ended and Lambda triggered: {session_id}")
-                logging.info(f"Lambda payload: customer_id={payload.get('customer_id')}, items_count={len(payload.get('items', []))}")
-                
-            except Exception as lambda_err:
-                logging.error(f"[ERROR] Error triggering Lambda: {lambda_err}")
-            
+            logging.info(f"[SUCCESS] Cloud session ended: {session_id}")
             return True
             
         except Exception as e:
             logging.error(f"[ERROR] Error ending cloud session: {str(e)}")
             return False
     
-    def create_cloud_transaction(self, session_id, items_data, total_amount):
-        """Create transaction record in cloud"""
+    @staticmethod
+    def session_processor_payload(session_id, total_amount, items_data, customer_id=None,
+                                  customer_name=None, idempotency_key=None):
+        """The message the session processor Lambda handles, via MQTT or a direct invoke."""
+        return {
+            'session_id': session_id,
+            'customer_id': customer_id,
+            'trigger': 'session_end',
+            'timestamp': datetime.now().isoformat(),
+            'total_amount': float(total_amount),
+            'total_items': len(items_data),
+            'items': [
+                {
+                    'id': item['id'],
+                    'product_name': item['product_name'],
+                    'price': float(item['price']),
+                    'weight': float(item['weight']) if item.get('weight') else None,
+                    'is_grocery': item.get('is_grocery', False),
+                    'tag_id': item.get('tag_id')
+                }
+                for item in items_data
+            ],
+            'customer_name': customer_name,
+            # Lets the processor recognise a redelivered session end
+            'idempotency_key': idempotency_key
+        }
+    
+    def invoke_session_processor(self, payload):
+        """Trigger the session processor directly, for carts without MQTT credentials."""
+        try:
+            aws_clients.client('lambda').invoke(
+                FunctionName='iot-convenience-store-session-processor-production',
+                InvocationType='Event',  # Async invocation
+                Payload=json.dumps(payload, cls=DecimalEncoder)
+            )
+            logging.info(f"[SUCCESS] Lambda triggered for session {payload['session_id']}: "
+                         f"customer_id={payload.get('customer_id')}, items_count={len(payload['items'])}")
+            return True
+        except Exception as e:
+            logging.error(f"[ERROR] Error triggering session processor: {str(e)}")
+            return False
+    
+    def create_cloud_transaction(self, session_id, items_data, total_amount, transaction_id=None, customer_id=None):
+        """Create transaction record in cloud.
+        
+        Passing the transaction_id makes the write idempotent: a transaction
+        that already exists is left alone and counts as created.
+        """
         if not dynamodb:
             logging.warning("AWS DynamoDB not available, skipping cloud transaction creation")
             return None
             
         try:
-            transaction_id = f"trans_{uuid.uuid4().hex[:8]}"
-            
-            # Convert to Decimal for DynamoDB
-            total_amount_decimal = Decimal(str(total_amount))
-            
-            # Prepare items for cloud storage
-            cloud_items = []
-            for item in items_data:
-                # Convert all numeric values to Decimal for DynamoDB
-                price = Decimal(str(item['price']))
-                weight = Decimal(str(item.get('weight', 0))) if item.get('weight') is not None else None
-                
-                cloud_items.append({
-                    'product_id': str(item.get('id', 'unknown')),
-                    'product_name': str(item['product_name']),
-                    'price': price,
-                    'weight': weight,
-                    'is_grocery': bool(item.get('is_grocery', False)),
-                    'tag_id': str(item.get('tag_id', 'unknown'))
-                })
-            
-            transaction_data = {
-                'transaction_id': transaction_id,
-                'session_id': session_id,
-                'customer_id': self.current_session.get('customer_id') if self.current_session else 'unknown',
-                'timestamp': datetime.now().isoformat(),
-                'amount': total_amount_decimal,
-                'item_count': len(items_data),
-                'items': cloud_items,
-                'payment_method': 'card',
-                'node_id': 'cart-001'
-            }
+            transaction_data = self.transaction_item(session_id, items_data, total_amount, transaction_id, customer_id)
+            transaction_id = transaction_data['transaction_id']
             
-            transactions_table.put_item(Item=transaction_data)
+            try:
+                transactions_table.put_item(
+                    Item=transaction_data,
+                    ConditionExpression='attribute_not_exists(transaction_id)'
+                )
+            except transactions_table.meta.client.exceptions.ConditionalCheckFailedException:
+                logging.info(f"Cloud transaction {transaction_id} already recorded")
+                return transaction_id
             
-            logging.info(f"[SUCCESS] Cloud transaction created: {transaction_id} with {len(items_data)} items, total: ${total_amount_decimal}")
+            logging.info(f"[SUCCESS] Cloud transaction created: {transaction_id} with {len(items_data)} items, total: ${transaction_data['amount']}")
             return transaction_id
             
         except Exception as e:
@@ -296,98 +348,126 @@ class CloudSessionManager:
             logging.error(f"Transaction error traceback: {traceback.format_exc()}")
             return None
     
-    def log_fraud_event(self, session_id, fraud_type, details):
-        """Log fraud event to DynamoDB"""
+    def transaction_item(self, session_id, items_data, total_amount, transaction_id=None, customer_id=None):
+        """Build the transactions table item for a checkout."""
+        transaction_id = transaction_id or f"trans_{uuid.uuid4().hex[:8]}"
+        if customer_id is None:
+            customer_id = self.current_session.get('customer_id') if self.current_session else 'unknown'
+        
+        # Prepare items for cloud storage
+        cloud_items = []
+        for item in items_data:
+            # Convert all numeric values to Decimal for DynamoDB
+            price = Decimal(str(item['price']))
+            weight = Decimal(str(item.get('weight', 0))) if item.get('weight') is not None else None
+            
+            cloud_items.append({
+                'product_id': str(item.get('id', 'unknown')),
+                'product_name': str(item['product_name']),
+                'price': price,
+                'weight': weight,
+                'is_grocery': bool(item.get('is_grocery', False)),
+                'tag_id': str(item.get('tag_id', 'unknown'))
+            })
+        
+        return {
+            'transaction_id': transaction_id,
+            'session_id': session_id,
+            'customer_id': customer_id,
+            'timestamp': datetime.now().isoformat(),
+            'amount': Decimal(str(total_amount)),
+            'item_count': len(items_data),
+            'items': cloud_items,
+            'payment_method': 'card',
+            'node_id': 'cart-001'
+        }
+    
+    def stage_cloud_transaction(self, batch, session_id, items_data, total_amount, transaction_id, customer_id):
+        """Queue a transaction on a DynamoWriteBatch instead of writing it now."""
+        batch.put(transactions_table,
+                  self.transaction_item(session_id, items_data, total_amount, transaction_id, customer_id),
+                  ['transaction_id', 'session_id'])
+    
+    def log_fraud_event(self, session_id, fraud_type, details, event_id=None, timestamp=None):
+        """Log fraud event to DynamoDB.
+        
+        With an event_id and the event's own timestamp (together the table's
+        key) the event is logged and counted at most once, however often it
+        is delivered.
+        """
         if not dynamodb:
             logging.warning("AWS DynamoDB not available, skipping cloud fraud logging")
             return False
             
         try:
-            event_id = f"fraud_{uuid.uuid4().hex[:8]}"
+            fraud_data = self.fraud_event_item(session_id, fraud_type, details, event_id, timestamp)
+            event_id = fraud_data['event_id']
             
-            fraud_data = {
-                'event_id': event_id,
-                'session_id': session_id,
-                'fraud_type': fraud_type,
-                'details': details,
-                'timestamp': datetime.now().isoformat(),
-                'node_type': 'smart-cart',
-                'severity': 'medium'
-            }
+            # Update session fraud count, remembering which events were counted
+            try:
+                sessions_table.update_item(
+                    Key={'session_id': session_id},
+                    UpdateExpression='SET fraud_event_count = fraud_event_count + :inc, has_fraud_alerts = :has_fraud ADD fraud_event_ids :event_ids',
+                    ConditionExpression='attribute_not_exists(fraud_event_ids) OR NOT contains(fraud_event_ids, :event_id)',
+                    ExpressionAttributeValues={
+                        ':inc': 1,
+                        ':has_fraud': True,
+                        ':event_ids': {event_id},
+                        ':event_id': event_id
+                    }
+                )
+            except sessions_table.meta.client.exceptions.ConditionalCheckFailedException:
+                logging.info(f"Fraud event {event_id} already counted for session {session_id}")
             
             fraud_events_table.put_item(Item=fraud_data)
             
-            # Update session fraud count
-            sessions_table.update_item(
-                Key={'session_id': session_id},
-                UpdateExpression='SET fraud_event_count = fraud_event_count + :inc, has_fraud_alerts = :has_fraud',
-                ExpressionAttributeValues={
-                    ':inc': 1,
-                    ':has_fraud': True
-                }
-            )
-            
             logging.info(f"[FRAUD] Fraud event logged to cloud: {fraud_type} for session {session_id}")
             return True
             
         except Exception as e:
             logging.error(f"[ERROR] Error logging fraud event to cloud: {str(e)}")
             return False
+    
+    def fraud_event_item(self, session_id, fraud_type, details, event_id=None, timestamp=None):
+        """Build the fraud events table item for one fraud event."""
+        return {
+            'event_id': event_id or f"fraud_{uuid.uuid4().hex[:8]}",
+            'session_id': session_id,
+            'fraud_type': fraud_type,
+            'details': details,
+            'timestamp': timestamp or datetime.now().isoformat(),
+            'node_type': 'smart-cart',
+            'severity': 'medium'
+        }
+    
+    def stage_fraud_event(self, batch, session_id, fraud_type, details, event_id, timestamp):
+        """Queue a fraud event and its session count on a DynamoWriteBatch."""
+        batch.put(fraud_events_table,
+                  self.fraud_event_item(session_id, fraud_type, details, event_id, timestamp),
+                  ['event_id', 'timestamp'])
+        batch.count_fraud_event(session_id, event_id)
             
      
-def get_applicable_discounts(customer_id, item_names):
+def get_applicable_discounts(customer_id, item_names, session_id=None):
     """
-    Simple discount check: Only cust_002 gets discount on Smartphone if they have 'shown' response
+    Discounts the customer has earned on these items.
+    Uses the session's cached discount map when a session_id is given.
     Returns: dict mapping product_name -> discount_percentage
     """
-    # Only check for cust_002
-    if customer_id != "cust_002":
-        logging.info(f"💰 No discounts: Customer {customer_id} is not cust_002")
-        return {}
-    
-    # Only check for Smartphone
-    if "Smartphone" not in item_names:
-        logging.info(f"💰 No discounts: Smartphone not in cart items {item_names}")
-        return {}
-    
-    if not dynamodb:
-        logging.info("💰 No discounts: AWS not configured")
-        return {}
-    
-    try:
-        logging.info(f"💰 Checking discount for cust_002 with Smartphone...")
-        
-        # Query discounts for cust_002
-        response = discounts_table.scan(
-            FilterExpression='customer_id = :customer_id',
-            ExpressionAttributeValues={':customer_id': 'cust_002'}
-        )
-        
-        discounts = response.get('Items', [])
-        logging.info(f"💰 Found {len(discounts)} discount records for cust_002")
-        
-        # Look for any discount with action_taken = 'shown'
-        for discount in discounts:
-            customer_response = discount.get('customer_response', {})
-            action_taken = customer_response.get('action_taken', '')
-            
-            if action_taken == 'shown':
-                discount_details = discount.get('discount_details', {})
-                discount_percentage = discount_details.get('discount_percentage', 0)
-                
-                # Convert Decimal to float if needed
-                if hasattr(discount_percentage, '__float__'):
-                    discount_percentage = float(discount_percentage)
-                
-                logging.info(f"✅ Found 'shown' discount for cust_002: {discount_percentage}%")
-                return {"Smartphone": discount_percentage}
-        
-        logging.info(f"💰 No 'shown' discounts found for cust_002")
-        return {}
-        
-    except Exception as e:
-        logging.error(f"💥 Error getting discounts: {e}")
-        return {}
+    if session_id:
+        discounts = discount_engine.for_session(session_id, customer_id)
+    elif dynamodb and customer_id:
+        discounts = discount_engine.load_customer(customer_id)
+    else:
+        discounts = {}
+    return {name: discounts[name] for name in item_names if name in discounts}
+
+def current_session_discounts():
+    """Discount map for the active cloud session, and its customer id."""
+    if not cloud_session.current_session:
+        return {}, None
+    customer_id = cloud_session.current_session.get('customer_id')
+    return discount_engine.for_session(cloud_session.current_session.get('session_id'), customer_id), customer_id
         
 @app.route('/test_discount_direct')
 def test_discount_direct():
@@ -486,6 +566,17 @@ def recover_session_for_checkout():
         
         logging.info(f"🔄 Using cloud session: customer_id={cloud_customer_id}, session_id={cloud_session_id}")
         
+        # The session's cart already knows who it belongs to
+        cart = cart_store.for_cloud_session(cloud_session_id)
+        if cart is not None and cart.customer_id:
+            flask_session['session_id'] = cart.session_token
+            flask_session['customer_id'] = cart.customer_id
+            flask_session['customer_name'] = customer_name or cart.customer_name
+            flask_session['cloud_session_id'] = cloud_session_id
+            
+            logging.info(f"✅ Session recovered from cart: local_id={cart.customer_id}, cloud_id={cloud_customer_id}")
+            return cart.customer_id, cloud_customer_id, True
+        
         # Find matching database session
         conn = get_db_connection()
         if conn:
@@ -525,95 +616,152 @@ def recover_session_for_checkout():
     return None, None, False
 
 def get_db_connection():
-    """Create and return a new database connection."""
+    """Check out a connection from the shared pool.
+    
+    Calling close() on it returns it to the pool.
+    """
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        return conn
+        return db_pool.acquire()
+    except PoolTimeout as err:
+        logging.error(f"Database pool exhausted: {err}")
+        return None
     except mysql.connector.Error as err:
         logging.error(f"Database connection error: {err}")
         return None
 
+def get_request_db():
+    """Return the pooled connection for the current request.
+    
+    The connection is checked out on first use and released automatically when
+    the request ends, so routes don't need to close it.
+    """
+    if 'db_conn' not in g:
+        g.db_conn = get_db_connection()
+    return g.db_conn
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        # The URL rule, not the path, so /get_customer_details?id=... is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.observe('http_request', {'route': route, 'method': request.method},
+                        time.perf_counter() - started, error=response.status_code >= 500)
+    return response
+
+@app.teardown_appcontext
+def release_request_db(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.close()
+
+def dispatch_command(cursor, command_type, parameters=None, wait=False):
+    """Send a command to the serial handler.
+    
+    Commands go over the local command bus. Only while the bus is down (serial
+    handler not running) is the command persisted to the commands table, which
+    the serial handler drains when it comes back. Callers commit as usual.
+    
+    Returns the bus acknowledgement, or {'status': 'persisted'} for the fallback.
+    """
+    reply = send_command(command_type, parameters, wait=wait)
+    if reply is not None:
+        return reply
+    
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    cursor.execute(
+        "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
+        (command_type, json.dumps(parameters or {}), 'pending', timestamp)
+    )
+    logging.info(f"Command bus down - persisted {command_type} to commands table")
+    return {'status': 'persisted', 'response': None}
+
+def with_products(conn, items):
+    """Fill in product_name, price and is_grocery from the product catalogue.
+    
+    Replaces joining product_data: items whose product_id is unknown trigger
+    one catalogue reload, and any still unknown are dropped as the inner join did.
+    """
+    if any(product_catalog.get(item['product_id']) is None for item in items):
+        cursor = conn.cursor()
+        try:
+            product_catalog.load(cursor)
+        finally:
+            cursor.close()
+    
+    result = []
+    for item in items:
+        product = product_catalog.get(item.pop('product_id'))
+        if product is None:
+            continue
+        item['product_name'] = product.name
+        item['price'] = product.price
+        item['is_grocery'] = product.is_grocery
+        result.append(item)
+    return result
+
+def validated_items(conn):
+    """The validated scanned_items on the cart, with their product details."""
+    cursor = conn.cursor(dictionary=True)
+    try:
+        cursor.execute("""
+            SELECT id, tag_id, timestamp, weight, is_validated, product_id
+            FROM scanned_items
+            WHERE is_validated = TRUE AND product_id IS NOT NULL
+        """)
+        return with_products(conn, cursor.fetchall())
+    finally:
+        cursor.close()
+
+def session_cart(conn):
+    """The cart of the request's session.
+    
+    Built from the validated scanned_items the first time it is needed after a
+    restart; after that it is kept current by the routes that change the cart.
+    """
+    session_token = flask_session.get('session_id')
+    if not session_token:
+        # No session: the validated items on the device, in a cart nobody keeps
+        cart = Cart(None)
+        for item in validated_items(conn):
+            cart.add(item)
+        return cart
+    
+    cart = cart_store.get(session_token)
+    if cart is None:
+        items = validated_items(conn)
+        cursor = conn.cursor(dictionary=True)
+        try:
+            cart = cart_store.load(cursor, session_token, items)
+        finally:
+            cursor.close()
+    return cart
+
 def initialize_database():
-    """Initialize database tables if they don't exist."""
+    """Apply any pending schema migrations (shared with serial_handler.py)."""
     conn = get_db_connection()
     if not conn:
         logging.error("Failed to initialize database")
         return False
     
-    cursor = conn.cursor()
     try:
-        # Create customers table if it doesn't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS customers (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                name VARCHAR(100) NOT NULL,
-                address TEXT,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_visit DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        version = migrate(conn)
+        logging.info(f"Database initialized successfully (schema version {version})")
         
-        # Create shopping_sessions table if it doesn't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS shopping_sessions (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                customer_id INT,
-                cloud_session_id VARCHAR(100),
-                start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
-                end_time DATETIME NULL,
-                total_amount DECIMAL(10, 2) DEFAULT 0.00,
-                fraud_alerts INT DEFAULT 0,
-                status ENUM('active', 'completed', 'abandoned') DEFAULT 'active',
-                FOREIGN KEY (customer_id) REFERENCES customers(id)
-            )
-        """)
-        
-        # Add session_id field to transactions table if it doesn't exist
-        try:
-            cursor.execute("""
-                SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_SCHEMA = DATABASE() 
-                AND TABLE_NAME = 'transactions' 
-                AND COLUMN_NAME = 'session_id'
-            """)
-            
-            if not cursor.fetchone():
-                cursor.execute("""
-                    ALTER TABLE transactions 
-                    ADD COLUMN session_id INT,
-                    ADD FOREIGN KEY (session_id) REFERENCES shopping_sessions(id)
-                """)
-                logging.info("Added session_id to transactions table")
-        except mysql.connector.Error as err:
-            logging.error(f"Error checking/updating transactions table: {err}")
-        
-        # Add session_id field to fraud_logs table if it doesn't exist
+        cursor = conn.cursor()
         try:
-            cursor.execute("""
-                SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_SCHEMA = DATABASE() 
-                AND TABLE_NAME = 'fraud_logs' 
-                AND COLUMN_NAME = 'session_id'
-            """)
-            
-            if not cursor.fetchone():
-                cursor.execute("""
-                    ALTER TABLE fraud_logs
-                    ADD COLUMN session_id INT,
-                    ADD FOREIGN KEY (session_id) REFERENCES shopping_sessions(id)
-                """)
-                logging.info("Added session_id to fraud_logs table")
-        except mysql.connector.Error as err:
-            logging.error(f"Error checking/updating fraud_logs table: {err}")
-        
-        conn.commit()
-        logging.info("Database initialized successfully")
+            product_catalog.load(cursor, products_table if dynamodb else None)
+        finally:
+            cursor.close()
         return True
-    except mysql.connector.Error as err:
+    except (mysql.connector.Error, RuntimeError) as err:
         logging.error(f"Database initialization error: {err}")
         return False
     finally:
-        cursor.close()
         conn.close()
 
 # Initialize database on startup
@@ -622,6 +770,76 @@ initialize_database()
 # Initialize the cloud session manager
 cloud_session = CloudSessionManager()
 
+# One MQTT connection for the life of the process. Without the device
+# certificates the session processor is invoked directly instead.
+cart_mqtt = SmartCartMQTT()
+mqtt_publisher = MqttPublishBatch(cart_mqtt) if cart_mqtt.has_credentials() else None
+
+def publish_session_mqtt(session_data, idempotency_key):
+    if not cart_mqtt.connect():
+        return False
+    return cart_mqtt.publish_session_complete(dict(session_data, idempotency_key=idempotency_key))
+
+# Cloud writes queued by checkout, end_session and fraud sync are delivered from
+# the cloud_outbox table in the background. Each handler returns True once the
+# write has been accepted; anything else is retried later.
+CLOUD_OUTBOX_HANDLERS = {
+    'session_end': lambda p, key: cloud_session.end_cloud_session(
+        p['session_id'], p['total_amount'], p['item_count']),
+    'session_process': lambda p, key: cloud_session.invoke_session_processor(p),
+    'session_complete_mqtt': publish_session_mqtt,
+}
+
+# Transactions and fraud events are coalesced into batch writes, with each
+# session's fraud count bumped once per flush. Session messages are published
+# over the MQTT connection in batches, with QoS 1; the IoT rule on the checkout
+# topic hands them to the session processor.
+CLOUD_OUTBOX_BATCHED = {}
+if dynamodb:
+    dynamo_batch = DynamoWriteBatch(sessions_table)
+    CLOUD_OUTBOX_BATCHED.update({
+        'cloud_transaction': (dynamo_batch, lambda batch, p: cloud_session.stage_cloud_transaction(
+            batch, p['session_id'], p['items'], p['total_amount'], p['transaction_id'], p['customer_id'])),
+        'fraud_event': (dynamo_batch, lambda batch, p: cloud_session.stage_fraud_event(
+            batch, p['session_id'], p['fraud_type'], p['details'], p['event_id'], p['timestamp'])),
+    })
+if mqtt_publisher:
+    CLOUD_OUTBOX_BATCHED.update({
+        'session_process': (mqtt_publisher, lambda batch, p: batch.publish(cart_mqtt.checkout_topic, p)),
+        'session_complete_mqtt': (mqtt_publisher, lambda batch, p: batch.publish(
+            cart_mqtt.session_topic, cart_mqtt.session_complete_message(p))),
+    })
+
+cloud_outbox_sender = OutboxSender(db_pool, CLOUD_OUTBOX_HANDLERS, batch_handlers=CLOUD_OUTBOX_BATCHED)
+
+def start_background_workers():
+    """Start the serial event subscriber and the cloud outbox sender."""
+    event_subscriber.start()
+    cloud_outbox_sender.start()
+
+def enqueue_session_end(cursor, cloud_session_id, total_amount, items, customer_id, customer_name):
+    """Queue the cloud session's end: the session update, then the processor trigger."""
+    enqueue(cursor, 'session_end', {
+        'session_id': cloud_session_id,
+        'total_amount': total_amount,
+        'item_count': len(items)
+    }, ordering_key=cloud_session_id)
+    key = uuid.uuid4().hex
+    enqueue(cursor, 'session_process', cloud_session.session_processor_payload(
+        cloud_session_id, total_amount, items, customer_id, customer_name, idempotency_key=key
+    ), ordering_key=cloud_session_id, idempotency_key=key)
+
+def enqueue_fraud_event(cursor, cloud_session_id, fraud):
+    """Queue a fraud_logs row for the cloud and mark it synced in the same transaction."""
+    enqueue(cursor, 'fraud_event', {
+        'session_id': cloud_session_id,
+        'event_id': f"fraud_local_{fraud['id']}",
+        'fraud_type': fraud['event_type'],
+        'details': fraud['details'],
+        'timestamp': fraud['timestamp'].isoformat()
+    }, ordering_key=cloud_session_id)
+    cursor.execute("UPDATE fraud_logs SET synced_to_cloud = TRUE WHERE id = %s", (fraud['id'],))
+
 @app.route('/debug_session_state')
 def debug_session_state():
     """Debug current session state"""
@@ -956,6 +1174,7 @@ def create_session():
                         if cloud_session_id:
                             logging.info(f"✅ Cloud session created successfully: {cloud_session_id}")
                             cloud_success = True
+                            discount_engine.prefetch(cloud_session_id, cloud_session_data.get('customer_id'))
                         else:
                             logging.warning("⚠️ Cloud session creation returned no session ID")
                     else:
@@ -977,6 +1196,9 @@ def create_session():
             )
             local_session_id = cursor.lastrowid
             logging.info(f"Created local session with ID {local_session_id}")
+            cart = cart_store.open(cursor, local_session_id, customer_id, cloud_session_id,
+                                   cloud_session.current_session.get('customer_id') if cloud_success else None, name,
+                                   items=validated_items(conn))
             
             # STEP 4: Store in Flask session
             logging.info("Step 4: Storing session in Flask")
@@ -988,6 +1210,7 @@ def create_session():
             
             # STEP 5: Commit transaction
             conn.commit()
+            cart_store.activate(cart)
             logging.info("✅ All database operations committed successfully")
             
             # STEP 6: Return success response
@@ -1126,6 +1349,9 @@ def create_session_from_active():
                 (customer_id, cloud_session_id)
             )
             local_session_id = cursor.lastrowid
+            cart = cart_store.open(cursor, local_session_id, customer_id, cloud_session_id,
+                                   aws_customer_id if cloud_session_id else None, customer_name,
+                                   items=validated_items(conn))
             
             # Store in Flask session
             flask_session['session_id'] = local_session_id
@@ -1140,8 +1366,10 @@ def create_session_from_active():
                     'customer_id': aws_customer_id,  # Use AWS customer_id, not local one!
                     'customer_name': customer_name
                 }
+                discount_engine.prefetch(cloud_session_id, aws_customer_id)
             
             conn.commit()
+            cart_store.activate(cart)
             
             response_data = {
                 'success': True,
@@ -1339,11 +1567,8 @@ def end_session():
         )
         fraud_count = cursor.fetchone()[0]
         
-        # Get item count
-        cursor.execute(
-            "SELECT COUNT(*) FROM scanned_items s JOIN product_data p ON s.product_id = p.id WHERE s.is_validated = TRUE"
-        )
-        item_count = cursor.fetchone()[0]
+        # The items for the cloud session processor
+        items = session_cart(conn).items()
         
         # Update the local session
         cursor.execute(
@@ -1354,12 +1579,17 @@ def end_session():
             """,
             (total_amount, fraud_count, local_session_id)
         )
+        cart_store.close(cursor, local_session_id)
         
-        conn.commit()
+        # End cloud session once this commits
+        if cloud_session_id and dynamodb:
+            enqueue_session_end(cursor, cloud_session_id, total_amount, items,
+                                flask_session.get('customer_id'), flask_session.get('customer_name'))
         
-        # End cloud session
-        if cloud_session_id:
-            cloud_session.end_cloud_session(cloud_session_id, total_amount, item_count)
+        conn.commit()
+        cart_store.forget(local_session_id)
+        cloud_outbox_sender.wake()
+        discount_engine.end_session(cloud_session_id)
         
         # Clear Flask session
         flask_session.pop('session_id', None)
@@ -1448,7 +1678,7 @@ def get_session_info():
 @app.route('/get_cart_items')
 def get_cart_items():
     """Return all items currently in the cart."""
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
@@ -1458,23 +1688,12 @@ def get_cart_items():
         session_id = flask_session.get('session_id')
         cloud_session_id = flask_session.get('cloud_session_id')
         
-        # Join scanned_items with product_data to get product information
-        cursor.execute("""
-            SELECT s.id, s.tag_id, s.timestamp, s.weight, s.is_validated, 
-                   p.product_name, p.price, p.is_grocery
-            FROM scanned_items s
-            JOIN product_data p ON s.product_id = p.id
-            WHERE s.is_validated = TRUE
-            ORDER BY s.timestamp DESC
-        """)
-        items = cursor.fetchall()
-        
-        # Calculate total price
-        total = sum(item['price'] for item in items)
+        # Items and the running total come from the session's cart
+        cart = session_cart(conn)
         
         return jsonify({
-            'items': items,
-            'total': total,
+            'items': cart.items(),
+            'total': cart.running_total,
             'session_id': session_id,
             'cloud_session_id': cloud_session_id
         })
@@ -1483,27 +1702,26 @@ def get_cart_items():
         return jsonify({'error': str(err)}), 500
     finally:
         cursor.close()
-        conn.close()
 
 @app.route('/get_recent_scan')
 def get_recent_scan():
     """Return the most recently scanned item that hasn't been validated yet."""
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
     cursor = conn.cursor(dictionary=True)
     try:
         cursor.execute("""
-            SELECT s.id, s.tag_id, s.timestamp, s.weight, s.is_validated, 
-                   p.product_name, p.price, p.is_grocery
-            FROM scanned_items s
-            JOIN product_data p ON s.product_id = p.id
-            WHERE s.is_validated = FALSE AND s.product_id IS NOT NULL
-            ORDER BY s.timestamp DESC
+            SELECT id, tag_id, timestamp, weight, is_validated, product_id
+            FROM scanned_items
+            WHERE is_validated = FALSE AND product_id IS NOT NULL
+            ORDER BY timestamp DESC
             LIMIT 1
         """)
-        item = cursor.fetchone()
+        row = cursor.fetchone()
+        items = with_products(conn, [row]) if row else []
+        item = items[0] if items else None
         
         if item:
             # Check if there are any fraud logs for this item
@@ -1515,35 +1733,14 @@ def get_recent_scan():
             """, (item['timestamp'],))
             fraud = cursor.fetchone()
             
-            # ✅ HOTFIX: Sync fraud to cloud if detected and not already synced
+            # Queue the fraud for the cloud if detected and not already queued
             if fraud:
                 cloud_session_id = flask_session.get('cloud_session_id')
-                if cloud_session_id and not fraud.get('synced_to_cloud', False):
-                    try:
-                        logging.info(f"🚨 Syncing fraud event to cloud: {fraud['event_type']}")
-                        success = cloud_session.log_fraud_event(
-                            cloud_session_id,
-                            fraud['event_type'],
-                            fraud['details']
-                        )
-                        
-                        if success:
-                            # Mark as synced if column exists
-                            try:
-                                cursor.execute(
-                                    "UPDATE fraud_logs SET synced_to_cloud = TRUE WHERE id = %s",
-                                    (fraud['id'],)
-                                )
-                                conn.commit()
-                                logging.info(f"✅ Fraud event {fraud['id']} synced to cloud successfully")
-                            except mysql.connector.Error:
-                                # Column doesn't exist yet, skip marking
-                                logging.info("✅ Fraud synced to cloud (sync tracking not available)")
-                        else:
-                            logging.warning(f"⚠️ Failed to sync fraud event to cloud")
-                            
-                    except Exception as e:
-                        logging.error(f"❌ Error syncing fraud to cloud: {e}")
+                if cloud_session_id and dynamodb and not fraud.get('synced_to_cloud', False):
+                    logging.info(f"🚨 Queueing fraud event for cloud sync: {fraud['event_type']}")
+                    enqueue_fraud_event(cursor, cloud_session_id, fraud)
+                    conn.commit()
+                    cloud_outbox_sender.wake()
             
             return jsonify({
                 'item': item,
@@ -1573,7 +1770,20 @@ def get_recent_scan():
         return jsonify({'error': str(err)}), 500
     finally:
         cursor.close()
-        conn.close()
+
+@app.route('/stream')
+def stream():
+    """Server-sent events for scans, weight readings and fraud alerts.
+    
+    Replaces polling /get_recent_scan and the weight routes: the page keeps one
+    connection open and the serial handler's events are pushed as they happen.
+    """
+    client = event_hub.subscribe()
+    return Response(
+        stream_with_context(event_hub.stream(client, encoder=DecimalEncoder)),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
 
 @app.route('/sync_fraud_manual', methods=['POST'])
 def sync_fraud_manual():
@@ -1606,7 +1816,9 @@ def sync_fraud_manual():
                 success = cloud_session.log_fraud_event(
                     cloud_session_id,
                     fraud['event_type'],
-                    fraud['details']
+                    fraud['details'],
+                    event_id=f"fraud_local_{fraud['id']}",
+                    timestamp=fraud['timestamp'].isoformat()
                 )
                 
                 if success:
@@ -1644,13 +1856,28 @@ def validate_item():
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
-    cursor = conn.cursor()
+    cursor = conn.cursor(dictionary=True)
     try:
+        cart = session_cart(conn)
         cursor.execute(
             "UPDATE scanned_items SET is_validated = TRUE WHERE id = %s",
             (item_id,)
         )
+        cursor.execute("""
+            SELECT id, tag_id, timestamp, weight, is_validated, product_id
+            FROM scanned_items
+            WHERE id = %s AND product_id IS NOT NULL
+        """, (item_id,))
+        row = cursor.fetchone()
+        items = with_products(conn, [row]) if row else []
+        # Persist the cart with the item, then add it once that commits
+        updated = cart.copy()
+        for item in items:
+            updated.add(item)
+        cart_store.persist(cursor, updated)
         conn.commit()
+        for item in items:
+            cart.add(item)
         return jsonify({'success': True})
     except mysql.connector.Error as err:
         logging.error(f"Database update error: {err}")
@@ -1664,7 +1891,7 @@ def weigh_item():
     """Request Arduino to weigh an item."""
     item_id = request.form.get('item_id')
     
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
@@ -1686,35 +1913,46 @@ def weigh_item():
         if not is_grocery:
             return jsonify({'error': 'Only grocery items need to be weighed'}), 400
         
-        # Add weigh_item command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Ask the serial handler to weigh the item
+        dispatch_command(cursor, 'weigh_item', {'item_id': item_id})
+        conn.commit()
+    except mysql.connector.Error as err:
+        logging.error(f"Database operation error: {err}")
+        return jsonify({'error': str(err)}), 500
+    finally:
+        cursor.close()
+    
+    # Release the connection before blocking on the scale
+    release_request_db(None)
+    
+    # The serial handler assigns the next stable weight to the item and
+    # pushes it once committed
+    reading = weight_buffer.wait_for_item(item_id, WEIGH_ITEM_TIMEOUT)
+    if reading is not None:
+        return jsonify({'success': True, 'weight': reading.weight})
+    
+    # The weight may have been assigned while the event stream was down
+    conn = get_request_db()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    
+    cursor = conn.cursor()
+    try:
         cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('weigh_item', json.dumps({'item_id': item_id}), 'pending', timestamp)
+            "SELECT weight FROM scanned_items WHERE id = %s",
+            (item_id,)
         )
-        conn.commit()
-        
-        # Wait for weight to be updated (polling)
-        max_retries = 10
-        for _ in range(max_retries):
-            time.sleep(0.5)  # Wait for serial handler to process
-            
-            cursor.execute(
-                "SELECT weight FROM scanned_items WHERE id = %s",
-                (item_id,)
-            )
-            result = cursor.fetchone()
-            
-            if result and result[0] is not None:
-                return jsonify({'success': True, 'weight': result[0]})
-        
-        return jsonify({'error': 'Weight measurement timed out. Please try again.'}), 408
+        result = cursor.fetchone()
     except mysql.connector.Error as err:
         logging.error(f"Database operation error: {err}")
         return jsonify({'error': str(err)}), 500
     finally:
         cursor.close()
-        conn.close()
+    
+    if result and result[0] is not None:
+        return jsonify({'success': True, 'weight': result[0]})
+    
+    return jsonify({'error': 'Weight measurement timed out. Please try again.'}), 408
 
 # @app.route('/checkout', methods=['POST'])
 # def checkout():
@@ -1814,52 +2052,19 @@ def checkout():
     
     cursor = conn.cursor(dictionary=True)
     try:
-        # Get all validated items
-        cursor.execute("""
-            SELECT s.id, s.tag_id, p.product_name, p.price, p.is_grocery, s.weight
-            FROM scanned_items s
-            JOIN product_data p ON s.product_id = p.id
-            WHERE s.is_validated = TRUE
-        """)
-        items = cursor.fetchall()
-        
-        if not items:
+        # All validated items, priced with the session's discounts
+        cart = session_cart(conn)
+        if not cart.item_count:
             return jsonify({'error': 'No items to checkout'}), 400
         
-        # SIMPLE DISCOUNT CHECK - Only for cust_002 with Smartphone
-        cloud_customer_id = None
-        if cloud_session.current_session:
-            cloud_customer_id = cloud_session.current_session.get('customer_id')
-        
-        item_names = [item['product_name'] for item in items]
-        discounts = get_applicable_discounts(cloud_customer_id, item_names)
-        
-        # Apply discount and calculate total
-        total_amount = 0
-        discount_applied = False
-        total_savings = 0
-        
-        for item in items:
-            original_price = float(item['price'])
-            
-            if item['product_name'] == "Smartphone" and "Smartphone" in discounts:
-                # Apply discount to Smartphone
-                discount_percent = discounts["Smartphone"]
-                discounted_price = original_price * (1 - discount_percent / 100)
-                savings = original_price - discounted_price
-                
-                item['original_price'] = original_price
-                item['discounted_price'] = discounted_price
-                item['discount_percent'] = discount_percent
-                item['price'] = discounted_price  # Update price for transaction
-                
-                total_amount += discounted_price
-                total_savings += savings
-                discount_applied = True
-                
-                logging.info(f"✅ Applied {discount_percent}% discount to Smartphone: ${original_price:.2f} -> ${discounted_price:.2f}")
-            else:
-                total_amount += original_price
+        discounts, cloud_customer_id = current_session_discounts()
+        cart.set_discounts(discounts)
+        items = cart.priced_items()
+        totals = cart.totals()
+        total_amount, total_savings = totals['total'], totals['total_savings']
+        discount_applied = total_savings > 0
+        if discount_applied:
+            logging.info(f"✅ Applied discounts saving ${total_savings:.2f} for customer {cloud_customer_id}")
         
         # Get session info
         local_session_id = flask_session.get('session_id')
@@ -1883,74 +2088,89 @@ def checkout():
                 (total_amount, local_session_id)
             )
         
-        # Create CLOUD transaction record
+        customer_id = flask_session.get('customer_id')
+        customer_name = flask_session.get('customer_name')
+        
+        # Queue the CLOUD transaction, the session's fraud events and the cloud
+        # session end. They commit with the local records below and are sent to
+        # DynamoDB/Lambda by the outbox sender, so checkout never waits on AWS.
         cloud_transaction_id = None
-        if cloud_session_id:
-            try:
-                logging.info(f"Creating cloud transaction for session {cloud_session_id} with {len(items)} items")
-                cloud_transaction_id = cloud_session.create_cloud_transaction(
-                    cloud_session_id, 
-                    items, 
-                    total_amount
-                )
-                if cloud_transaction_id:
-                    logging.info(f"[SUCCESS] Cloud transaction created successfully: {cloud_transaction_id}")
-                else:
-                    logging.warning("[WARNING] Cloud transaction creation returned None")
-            except Exception as cloud_err:
-                logging.error(f"[ERROR] Error during cloud transaction creation: {cloud_err}")
-                logging.error(f"Cloud transaction error traceback: {traceback.format_exc()}")
+        if cloud_session_id and dynamodb:
+            cloud_transaction_id = f"trans_{uuid.uuid4().hex[:8]}"
+            logging.info(f"Queueing cloud transaction {cloud_transaction_id} for session {cloud_session_id} with {len(items)} items")
+            enqueue(cursor, 'cloud_transaction', {
+                'session_id': cloud_session_id,
+                'transaction_id': cloud_transaction_id,
+                'customer_id': cloud_customer_id or 'unknown',
+                'items': items,
+                'total_amount': total_amount
+            }, ordering_key=cloud_session_id)
+            
+            cursor.execute("""
+                SELECT * FROM fraud_logs 
+                WHERE session_id = %s AND NOT synced_to_cloud
+                ORDER BY timestamp
+            """, (local_session_id,))
+            for fraud in cursor.fetchall():
+                enqueue_fraud_event(cursor, cloud_session_id, fraud)
+            
+            enqueue_session_end(cursor, cloud_session_id, total_amount, items, cloud_customer_id, customer_name)
         else:
             logging.info("[INFO] No cloud session ID available, skipping cloud transaction")
         
-        conn.commit()
-
-        if cloud_session_id:
-            try:
-                cursor.execute("""
-                    SELECT * FROM fraud_logs 
-                    WHERE session_id = %s
-                    ORDER BY timestamp DESC
-                """, (local_session_id,))
-                session_fraud_events = cursor.fetchall()
-                
-                for fraud in session_fraud_events:
-                    try:
-                        cloud_session.log_fraud_event(
-                            cloud_session_id,
-                            fraud['event_type'],
-                            fraud['details']
-                        )
-                        logging.info(f"✅ Synced fraud event during checkout: {fraud['event_type']}")
-                    except Exception as fraud_sync_err:
-                        logging.error(f"❌ Failed to sync fraud during checkout: {fraud_sync_err}")
-                        
-            except Exception as e:
-                logging.error(f"❌ Error syncing fraud events during checkout: {e}")
-
-        customer_id = flask_session.get('customer_id')
-        customer_name = flask_session.get('customer_name')
-        
         # End local session
         if local_session_id:
             cursor.execute(
                 "UPDATE shopping_sessions SET end_time = NOW(), status = 'completed' WHERE id = %s",
                 (local_session_id,)
             )
-            conn.commit()
-            
-            # Clear Flask session
-            flask_session.pop('session_id', None)
-            flask_session.pop('customer_id', None)
-            flask_session.pop('customer_name', None)
         
-        # End cloud session
-        if cloud_session_id:
-            cloud_session.end_cloud_session(cloud_session_id, total_amount, len(items))
-            
         # Clear validated items
         cursor.execute("DELETE FROM scanned_items WHERE is_validated = TRUE")
+        cart_store.close(cursor, local_session_id)
+        
+        # Session summary for IoT Core, published by the outbox sender as well;
+        # without device credentials there is nothing to publish it with
+        if cart_mqtt.has_credentials():
+            mqtt_session_id = cloud_session_id or f"local_{local_session_id}"
+            enqueue(cursor, 'session_complete_mqtt', {
+                "session_id": mqtt_session_id,
+                "local_session_id": local_session_id,
+                "cloud_session_id": cloud_session_id,
+                "customer_id": customer_id,
+                "customer_name": customer_name,
+                "total_amount": float(total_amount),
+                "item_count": len(items),
+                "items": [
+                    {
+                        "product_name": item['product_name'],
+                        "price": float(item['price']),
+                        "original_price": item.get('original_price', item['price']),
+                        "discount_percent": item.get('discount_percent', 0),
+                        "is_grocery": item.get('is_grocery', False),
+                        "weight": item.get('weight')
+                    } for item in items
+                ],
+                "fraud_events": [],
+                "transaction_ids": {
+                    "local": local_transaction_id,
+                    "cloud": cloud_transaction_id
+                },
+                "discount_applied": discount_applied,
+                "total_savings": total_savings if discount_applied else 0,
+                "completed_at": datetime.now().isoformat()
+            }, ordering_key=mqtt_session_id)
+        
         conn.commit()
+        cart_store.forget(local_session_id)
+        cloud_outbox_sender.wake()
+        discount_engine.end_session(cloud_session_id)
+        
+        # Clear Flask session
+        if local_session_id:
+            flask_session.pop('session_id', None)
+            flask_session.pop('customer_id', None)
+            flask_session.pop('customer_name', None)
         
         # Build response with discount information
         response_data = {
@@ -1960,6 +2180,7 @@ def checkout():
             'local_transaction_id': local_transaction_id,
             'cloud_transaction_id': cloud_transaction_id,
             'cloud_enabled': cloud_transaction_id is not None,
+            'cloud_sync': 'queued',
             'discount_applied': discount_applied,
             'customer_id': cloud_customer_id
         }
@@ -1970,54 +2191,7 @@ def checkout():
             response_data['total_savings'] = total_savings
             response_data['message'] = f'Checkout successful! You saved ${total_savings:.2f} with discounts!'
         else:
-            response_data['message'] = f'Checkout successful! {"Cloud sync enabled." if cloud_transaction_id else "Local only."}'
-
-        try:
-            mqtt_client = SmartCartMQTT()
-            if mqtt_client.connect():
-                session_data = {
-                    "session_id": cloud_session_id or f"local_{local_session_id}",
-                    "local_session_id": local_session_id,
-                    "cloud_session_id": cloud_session_id,
-                    "customer_id": customer_id,
-                    "customer_name": customer_name,
-                    "total_amount": float(total_amount),
-                    "item_count": len(items),
-                    "items": [
-                        {
-                            "product_name": item['product_name'],
-                            "price": float(item['price']),
-                            "original_price": item.get('original_price', item['price']),
-                            "discount_percent": item.get('discount_percent', 0),
-                            "is_grocery": item.get('is_grocery', False),
-                            "weight": item.get('weight')
-                        } for item in items
-                    ],
-                    "fraud_events": [],
-                    "transaction_ids": {
-                        "local": local_transaction_id,
-                        "cloud": cloud_transaction_id
-                    },
-                    "discount_applied": discount_applied,
-                    "total_savings": total_savings if discount_applied else 0,
-                    "completed_at": datetime.now().isoformat()
-                }
-                
-                if mqtt_client.publish_session_complete(session_data):
-                    logging.info(f"✅ MQTT session sync successful for session {cloud_session_id}")
-                    response_data['mqtt_sync'] = True
-                else:
-                    logging.warning("⚠️ MQTT session sync failed")
-                    response_data['mqtt_sync'] = False
-                
-                mqtt_client.disconnect()
-            else:
-                logging.warning("⚠️ MQTT connection failed")
-                response_data['mqtt_sync'] = False
-                
-        except Exception as mqtt_error:
-            logging.error(f"❌ MQTT sync error: {mqtt_error}")
-            response_data['mqtt_sync'] = False
+            response_data['message'] = f'Checkout successful! {"Cloud sync queued." if cloud_transaction_id else "Local only."}'
 
         if discount_applied:
             logging.info(f"[SUCCESS] Checkout completed with discount: Local ID={local_transaction_id}, Cloud ID={cloud_transaction_id}, Total=${total_amount:.2f}, Savings=${total_savings:.2f}")
@@ -2058,6 +2232,7 @@ def write_tag():
         return jsonify({'error': 'Database connection failed'}), 500
     
     cursor = conn.cursor()
+    changed_product = None
     try:
         # Only update product_data if not in control mode
         if not is_control:
@@ -2074,6 +2249,7 @@ def write_tag():
                     "UPDATE product_data SET is_grocery = %s WHERE product_name = %s AND price = %s",
                     (is_grocery, product_name, float(price))
                 )
+                product_id = existing[0]
                 logging.info(f"Updated existing product: {product_name}")
             else:
                 # Insert new product
@@ -2081,16 +2257,27 @@ def write_tag():
                     "INSERT INTO product_data (product_name, price, is_grocery) VALUES (%s, %s, %s)",
                     (product_name, float(price), is_grocery)
                 )
+                product_id = cursor.lastrowid
                 logging.info(f"Created new product: {product_name}")
+            
+            changed_product = {
+                'product_id': product_id,
+                'product_name': product_name,
+                'price': float(price),
+                'is_grocery': is_grocery
+            }
         
-        # Add write_tag command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('write_tag', json.dumps({'data': data, 'control_mode': is_control}), 'pending', timestamp)
-        )
+        # Send write_tag command to the serial handler
+        dispatch_command(cursor, 'write_tag', {'data': data, 'control_mode': is_control})
         
         conn.commit()
+        
+        if changed_product:
+            # Keep both product catalogues current; if the bus is down the
+            # serial handler picks the change up when it next loads the catalogue
+            product_catalog.put(**changed_product)
+            send_command('product_changed', changed_product)
+        
         return jsonify({
             'success': True,
             'message': 'Write command sent to Arduino. Place your tag on the reader now.'
@@ -2113,12 +2300,8 @@ def read_tag():
     
     cursor = conn.cursor()
     try:
-        # Add read_tag command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('read_tag', '{}', 'pending', timestamp)
-        )
+        # Send read_tag command to the serial handler
+        dispatch_command(cursor, 'read_tag')
         conn.commit()
         
         # In a real application, we would need to implement a way to get the data back
@@ -2142,12 +2325,8 @@ def reset_tag():
     
     cursor = conn.cursor()
     try:
-        # Add reset_tag command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('reset_tag', json.dumps({'control_mode': is_control}), 'pending', timestamp)
-        )
+        # Send reset_tag command to the serial handler
+        dispatch_command(cursor, 'reset_tag', {'control_mode': is_control})
         conn.commit()
         return jsonify({'success': True})
     except mysql.connector.Error as err:
@@ -2166,12 +2345,8 @@ def tare_scale():
     
     cursor = conn.cursor()
     try:
-        # Add tare command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('tare', '{}', 'pending', timestamp)
-        )
+        # Send tare command to the serial handler
+        dispatch_command(cursor, 'tare')
         conn.commit()
         return jsonify({'success': True})
     except mysql.connector.Error as err:
@@ -2346,75 +2521,52 @@ def get_grocery_items():
 
 @app.route('/get_grocery_weight', methods=['POST'])
 def get_grocery_weight():
-    """Get the weight of a grocery item."""
-    conn = get_db_connection()
-    if not conn:
-        return jsonify({'error': 'Database connection failed'}), 500
+    """Get the weight of a grocery item.
     
-    cursor = conn.cursor()
+    Answers from the weight buffer fed by the serial handler. Pass `wait`
+    (seconds) to long-poll until a stable reading arrives instead of getting
+    an immediate 202.
+    """
     try:
-        # Check if weight_readings table exists
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_schema = DATABASE() 
-            AND table_name = 'weight_readings'
-        """)
-        
-        table_exists = cursor.fetchone()[0] > 0
+        wait = min(max(float(request.values.get('wait', 0)), 0), GROCERY_WEIGHT_MAX_WAIT)
+    except ValueError:
+        wait = 0
+    
+    reading = weight_buffer.latest(
+        max_age=GROCERY_WEIGHT_MAX_AGE, stable_only=True, min_weight=GROCERY_MIN_WEIGHT
+    )
+    
+    if reading is None:
+        # Ask the scale for a fresh reading; it comes back through the event stream
+        conn = get_request_db()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
         
-        if not table_exists:
-            # If table doesn't exist, send command to create it and get a weight
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            cursor.execute(
-                "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-                ('weigh_item', '{}', 'pending', timestamp)
-            )
+        cursor = conn.cursor()
+        try:
+            dispatch_command(cursor, 'weigh_item')
             conn.commit()
-            
-            # Wait a bit for serial handler to process
-            time.sleep(1.0)
-            
-            return jsonify({'error': 'Please wait, initializing scale...'}), 202
-        
-        # First, send the weigh command to Arduino
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('weigh_item', '{}', 'pending', timestamp)
-        )
-        conn.commit()
-        
-        # Wait a bit for the serial handler to process the command
-        time.sleep(0.5)
-        
-        # Get the most recent weight reading
-        cursor.execute("""
-            SELECT weight, timestamp 
-            FROM weight_readings
-            WHERE timestamp > DATE_SUB(NOW(), INTERVAL 10 SECOND)
-            ORDER BY timestamp DESC
-            LIMIT 1
-        """)
-        
-        result = cursor.fetchone()
+        except mysql.connector.Error as err:
+            logging.error(f"Database operation error: {err}")
+            return jsonify({'error': str(err)}), 500
+        finally:
+            cursor.close()
         
-        if result and result[0] is not None:
-            weight = float(result[0])
-            
-            # Only return if the weight is above a minimum threshold
-            if weight > 10:
-                # Success - we have a valid weight
-                return jsonify({'weight': weight})
+        # Release the connection before blocking on the scale
+        release_request_db(None)
         
-        # If we didn't get a valid weight, return an error
+        reading = weight_buffer.wait_for(
+            wait, max_age=GROCERY_WEIGHT_MAX_AGE, stable_only=True, min_weight=GROCERY_MIN_WEIGHT
+        )
+    
+    if reading is None:
         return jsonify({'error': 'Waiting for item on scale...'}), 202
-    except mysql.connector.Error as err:
-        logging.error(f"Database operation error: {err}")
-        return jsonify({'error': str(err)}), 500
-    finally:
-        cursor.close()
-        conn.close()
+    
+    return jsonify({
+        'weight': reading.weight,
+        'stable': reading.stable,
+        'timestamp': datetime.fromtimestamp(reading.received_at).strftime('%Y-%m-%d %H:%M:%S')
+    })
 
 @app.route('/get_cart_items_with_discounts')
 def get_cart_items_with_discounts():
@@ -2425,58 +2577,17 @@ def get_cart_items_with_discounts():
     
     cursor = conn.cursor(dictionary=True)
     try:
-        # Get all validated items
-        cursor.execute("""
-            SELECT s.id, s.tag_id, s.timestamp, s.weight, s.is_validated, 
-                   p.product_name, p.price, p.is_grocery
-            FROM scanned_items s
-            JOIN product_data p ON s.product_id = p.id
-            WHERE s.is_validated = TRUE
-            ORDER BY s.timestamp DESC
-        """)
-        items = cursor.fetchall()
-        
-        # Get customer ID for discounts
-        cloud_customer_id = None
-        if cloud_session.current_session:
-            cloud_customer_id = cloud_session.current_session.get('customer_id')
-        
-        # Apply discounts to items
-        item_names = [item['product_name'] for item in items]
-        discounts = get_applicable_discounts(cloud_customer_id, item_names)
-        
-        total = 0
-        original_total = 0
-        total_savings = 0
-        
-        for item in items:
-            original_price = float(item['price'])
-            original_total += original_price
-            
-            if item['product_name'] == "Smartphone" and "Smartphone" in discounts:
-                # Apply discount
-                discount_percent = discounts["Smartphone"]
-                discounted_price = original_price * (1 - discount_percent / 100)
-                savings = original_price - discounted_price
-                
-                # Add discount info to item
-                item['original_price'] = original_price
-                item['discounted_price'] = discounted_price
-                item['discount_percent'] = discount_percent
-                item['savings'] = savings
-                item['price'] = discounted_price  # Update current price
-                
-                total += discounted_price
-                total_savings += savings
-            else:
-                total += original_price
+        # The session's cart, priced with its discounts
+        cart = session_cart(conn)
+        cart.set_discounts(current_session_discounts()[0])
+        totals = cart.totals()
         
         return jsonify({
-            'items': items,
-            'total': total,
-            'original_total': original_total,
-            'total_savings': total_savings,
-            'discount_applied': total_savings > 0,
+            'items': cart.priced_items(),
+            'total': totals['total'],
+            'original_total': totals['original_total'],
+            'total_savings': totals['total_savings'],
+            'discount_applied': totals['total_savings'] > 0,
             'session_id': flask_session.get('session_id'),
             'cloud_session_id': flask_session.get('cloud_session_id')
         })
@@ -2527,14 +2638,18 @@ def add_grocery_to_cart():
         
         # Create a temporary entry in product_data for this specific weight/price
         # or find an existing one
-        cursor.execute(
-            "SELECT id FROM product_data WHERE product_name = %s AND price = %s AND is_grocery = TRUE",
-            (product_name, price)
-        )
-        product = cursor.fetchone()
+        product = product_catalog.find(product_name, price)
+        if product is None or not product.is_grocery:
+            cursor.execute(
+                "SELECT id FROM product_data WHERE product_name = %s AND price = %s AND is_grocery = TRUE",
+                (product_name, price)
+            )
+            row = cursor.fetchone()
+        else:
+            row = (product.id,)
         
-        if product:
-            product_id = product[0]
+        if row:
+            product_id = row[0]
         else:
             # Insert a new product record
             cursor.execute(
@@ -2544,15 +2659,31 @@ def add_grocery_to_cart():
             product_id = cursor.lastrowid
         
         # Create a scanned_item entry
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        session_id = flask_session.get('session_id')
+        timestamp = datetime.now().replace(microsecond=0)
+        tag_id = f"GROCERY-{grocery_id}"
+        cart = session_cart(conn)
         
         cursor.execute(
             "INSERT INTO scanned_items (tag_id, timestamp, product_id, weight, is_validated) VALUES (%s, %s, %s, %s, %s)",
-            (f"GROCERY-{grocery_id}", timestamp, product_id, weight, True)  # Already validated
+            (tag_id, timestamp.strftime('%Y-%m-%d %H:%M:%S'), product_id, weight, True)  # Already validated
         )
         
+        product = product_catalog.put(product_id, product_name, price, True)
+        item = {
+            'id': cursor.lastrowid,
+            'tag_id': tag_id,
+            'timestamp': timestamp,
+            'weight': weight,
+            'is_validated': True,
+            'product_name': product.name,
+            'price': product.price,
+            'is_grocery': True
+        }
+        updated = cart.copy()
+        updated.add(item)
+        cart_store.persist(cursor, updated)
         conn.commit()
+        cart.add(item)
         return jsonify({'success': True})
     except mysql.connector.Error as err:
         logging.error(f"Database operation error: {err}")
@@ -2854,31 +2985,13 @@ def read_tag_control():
     
     cursor = conn.cursor()
     try:
-        # Create control_results table if it doesn't exist
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS control_results (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                tag_id VARCHAR(100),
-                data TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # First, set the control flag
+        # A control-mode read_tag arms the serial handler so the next card
+        # scan goes to control_results instead of the cart
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('_control_read_flag', json.dumps({'purpose': 'control_read_only'}), 'pending', timestamp)
-        )
-        
-        # Then add the actual read command
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('read_tag', json.dumps({'control_mode': True}), 'pending', timestamp)
-        )
+        dispatch_command(cursor, 'read_tag', {'control_mode': True}, wait=True)
         
         conn.commit()
-        logging.info("Control read commands added to database")
+        logging.info("Control read command sent to serial handler")
         
         # Wait for serial handler to process and store results
         max_retries = 15
@@ -2916,76 +3029,47 @@ def read_tag_control():
 
 @app.route('/read_weight_control', methods=['POST'])
 def read_weight_control():
-    """Read weight from load cell for control page."""
-    conn = get_db_connection()
+    """Read weight from load cell for control page.
+    
+    Answers with the first reading the serial handler pushes after the
+    weigh command, from the weight buffer.
+    """
+    conn = get_request_db()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
     cursor = conn.cursor()
     try:
-        # Send command to read weight
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('weigh_item', json.dumps({'control_mode': True}), 'pending', timestamp)
-        )
+        # Send command to read weight; the next stable weight is reported
+        # even if the item was already resting on the scale
+        requested_at = time.time()
+        dispatch_command(cursor, 'weigh_item', {'control_mode': True})
         conn.commit()
-        
-        # Wait briefly for command to be processed
-        time.sleep(1)
-        
-        # Check for recent weight readings
-        max_retries = 10
-        weight_value = None
-        
-        for _ in range(max_retries):
-            cursor.execute("""
-                SELECT weight
-                FROM weight_readings
-                WHERE timestamp > %s
-                ORDER BY timestamp DESC
-                LIMIT 1
-            """, (timestamp,))
-            
-            result = cursor.fetchone()
-            if result and result[0]:
-                weight_value = float(result[0])
-                break
-            
-            time.sleep(1)
-        
-        if weight_value is not None:
-            return jsonify({'success': True, 'weight': weight_value})
-        else:
-            # Return a partial success to let the frontend know to keep polling
-            return jsonify({'success': True, 'message': 'Reading weight, please wait...'})
     except mysql.connector.Error as err:
         logging.error(f"Read weight control error: {err}")
         return jsonify({'error': str(err)}), 500
     finally:
         cursor.close()
-        conn.close()
+    
+    # Release the connection before blocking on the scale
+    release_request_db(None)
+    
+    reading = weight_buffer.wait_for(READ_WEIGHT_TIMEOUT, stable_only=False, since=requested_at)
+    if reading is not None and reading.weight:
+        return jsonify({'success': True, 'weight': reading.weight})
+    
+    # Return a partial success to let the frontend know to keep polling
+    return jsonify({'success': True, 'message': 'Reading weight, please wait...'})
 
 @app.route('/get_latest_weight', methods=['GET'])
 def get_latest_weight():
     """Get the latest weight reading."""
-    conn = get_db_connection()
+    conn = get_request_db()
     if not conn:
         return jsonify({'error': 'Database connection failed'}), 500
     
     cursor = conn.cursor()
     try:
-        # Check if weight_readings table exists
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_schema = DATABASE() 
-            AND table_name = 'weight_readings'
-        """)
-        
-        if cursor.fetchone()[0] == 0:
-            return jsonify({'error': 'Weight readings not available'}), 404
-        
         # Get the most recent weight reading
         cursor.execute("""
             SELECT weight, timestamp 
@@ -3028,7 +3112,6 @@ def get_latest_weight():
         return jsonify({'error': f'Unexpected error: {str(e)}'}), 500
     finally:
         cursor.close()
-        conn.close()
 
 
 @app.route('/read_tag_control_only', methods=['POST'])
@@ -3045,22 +3128,9 @@ def read_tag_control_only():
     
     cursor = conn.cursor()
     try:
-        # Ensure control_results table exists
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS control_results (
-                id INT AUTO_INCREMENT PRIMARY KEY,
-                tag_id VARCHAR(100),
-                data TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
         # Send READC command directly
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('READC', json.dumps({'tag_id': tag_id}), 'pending', timestamp)
-        )
+        dispatch_command(cursor, 'READC', {'tag_id': tag_id})
         conn.commit()
         
         logging.info("READC command sent to serial handler")
@@ -3106,17 +3176,6 @@ def get_latest_tag_data():
     
     cursor = conn.cursor()
     try:
-        # Check if control_results table exists
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_schema = DATABASE() 
-            AND table_name = 'control_results'
-        """)
-        
-        if cursor.fetchone()[0] == 0:
-            return jsonify({'message': 'No tag data available yet'})
-        
         # Get the most recent tag data
         cursor.execute("""
             SELECT tag_id, data, timestamp 
@@ -3157,14 +3216,10 @@ def tare_scale_control():
     
     cursor = conn.cursor()
     try:
-        # Add tare command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('tare', json.dumps({'control_mode': True}), 'pending', timestamp)
-        )
+        # Send tare command and wait for the Arduino's acknowledgement
+        reply = dispatch_command(cursor, 'tare', {'control_mode': True}, wait=True)
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': reply['status'] != 'failed', 'status': reply['status'], 'response': reply.get('response')})
     except mysql.connector.Error as err:
         logging.error(f"Tare scale control error: {err}")
         return jsonify({'error': str(err)}), 500
@@ -3181,14 +3236,10 @@ def open_lid_control():
     
     cursor = conn.cursor()
     try:
-        # Add open_lid command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('OPEN_LID', json.dumps({'control_mode': True}), 'pending', timestamp)
-        )
+        # Send open_lid command and wait for the Arduino's acknowledgement
+        reply = dispatch_command(cursor, 'OPEN_LID', {'control_mode': True}, wait=True)
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': reply['status'] != 'failed', 'status': reply['status'], 'response': reply.get('response')})
     except mysql.connector.Error as err:
         logging.error(f"Open lid control error: {err}")
         return jsonify({'error': str(err)}), 500
@@ -3205,14 +3256,10 @@ def close_lid_control():
     
     cursor = conn.cursor()
     try:
-        # Add close_lid command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('CLOSE_LID', json.dumps({'control_mode': True}), 'pending', timestamp)
-        )
+        # Send close_lid command and wait for the Arduino's acknowledgement
+        reply = dispatch_command(cursor, 'CLOSE_LID', {'control_mode': True}, wait=True)
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': reply['status'] != 'failed', 'status': reply['status'], 'response': reply.get('response')})
     except mysql.connector.Error as err:
         logging.error(f"Close lid control error: {err}")
         return jsonify({'error': str(err)}), 500
@@ -3229,40 +3276,12 @@ def trigger_buzzer_control():
     
     cursor = conn.cursor()
     try:
-        # Add buzzer command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Define command type explicitly as a variable for clarity
-        command_type = 'BUZZER'
-        parameters = json.dumps({'control_mode': True})
-        status = 'pending'
-        
-        # Super detailed logging
-        logging.info(f"BUZZER COMMAND DEBUG - About to insert: command_type='{command_type}' (type: {type(command_type)}), parameters={parameters}, status={status}")
-        
-        # Insert the command
-        sql_statement = "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)"
-        values = (command_type, parameters, status, timestamp)
-        logging.info(f"SQL statement: {sql_statement}")
-        logging.info(f"Values: {values}")
-        
-        cursor.execute(sql_statement, values)
-        inserted_id = cursor.lastrowid
-        logging.info(f"Inserted command with ID {inserted_id}")
-        
-        # Verify the value was properly stored by selecting it back
-        cursor.execute("SELECT command_type, parameters FROM commands WHERE id = %s", (inserted_id,))
-        result = cursor.fetchone()
-        if result:
-            stored_command, stored_params = result
-            logging.info(f"VERIFICATION: Stored command_type='{stored_command}' (type: {type(stored_command)}), parameters={stored_params}")
-        else:
-            logging.warning("VERIFICATION FAILED: Could not retrieve the inserted command")
-        
+        # Send buzzer command and wait for the Arduino's acknowledgement
+        reply = dispatch_command(cursor, 'BUZZER', {'control_mode': True}, wait=True)
         conn.commit()
-        logging.info("Transaction committed successfully")
+        logging.info(f"BUZZER command {reply['status']}: {reply.get('response')}")
         
-        return jsonify({'success': True})
+        return jsonify({'success': reply['status'] != 'failed', 'status': reply['status'], 'response': reply.get('response')})
     except mysql.connector.Error as err:
         logging.error(f"Trigger buzzer control error: {err}")
         return jsonify({'error': str(err)}), 500
@@ -3279,14 +3298,10 @@ def toggle_led_control():
     
     cursor = conn.cursor()
     try:
-        # Add LED toggle command to commands table
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute(
-        "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-        ('LED', json.dumps({'control_mode': True}), 'pending', timestamp)
-    )
+        # Send LED toggle command and wait for the Arduino's acknowledgement
+        reply = dispatch_command(cursor, 'LED', {'control_mode': True}, wait=True)
         conn.commit()
-        return jsonify({'success': True})
+        return jsonify({'success': reply['status'] != 'failed', 'status': reply['status'], 'response': reply.get('response')})
     except mysql.connector.Error as err:
         logging.error(f"Toggle LED control error: {err}")
         return jsonify({'error': str(err)}), 500
@@ -3350,18 +3365,9 @@ def check_db_structure():
     
     cursor = conn.cursor()
     try:
-        # Check if commands table exists
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_schema = DATABASE() 
-            AND table_name = 'commands'
-        """)
-        
-        table_exists = cursor.fetchone()[0] > 0
-        
-        if not table_exists:
-            return jsonify({'error': 'Commands table does not exist'}), 404
+        # The schema is managed by migrations.py, so report its version
+        # rather than probing information_schema
+        schema_version = current_version(cursor)
         
         # Get table structure
         cursor.execute("DESCRIBE commands")
@@ -3373,6 +3379,7 @@ def check_db_structure():
         
         return jsonify({
             'success': True,
+            'schema_version': schema_version,
             'table_structure': columns,
             'recent_commands': recent_commands
         })
@@ -3383,6 +3390,44 @@ def check_db_structure():
         cursor.close()
         conn.close()
 
+@app.route('/db_pool_stats', methods=['GET'])
+def db_pool_stats():
+    """Report connection pool size and checkout wait times."""
+    return jsonify(db_pool.stats())
+
+@app.route('/aws_client_stats', methods=['GET'])
+def aws_client_stats():
+    """Report the shared AWS clients and their HTTP connection pools."""
+    return jsonify(aws_clients.stats())
+
+@app.route('/outbox_stats', methods=['GET'])
+def cloud_outbox_stats():
+    """Report how many cloud writes are waiting, delivered or given up on."""
+    conn = get_request_db()
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+
+    cursor = conn.cursor()
+    try:
+        return jsonify(outbox_stats(cursor))
+    except mysql.connector.Error as err:
+        logging.error(f"Database query error: {err}")
+        return jsonify({'error': str(err)}), 500
+    finally:
+        cursor.close()
+
+@app.route('/mqtt_stats', methods=['GET'])
+def mqtt_stats():
+    """Report the MQTT connection and how many session messages it has published."""
+    if mqtt_publisher is None:
+        return jsonify({'enabled': False})
+    return jsonify(dict(mqtt_publisher.stats(), enabled=True))
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Route, MySQL statement and AWS call latencies in Prometheus text format."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/direct_buzzer_insert', methods=['POST'])
 def direct_buzzer_insert():
     """Direct SQL insertion for buzzer command."""
@@ -3420,4 +3465,9 @@ def direct_buzzer_insert():
 
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    debug = True
+    # With the reloader this module also runs in the watcher process; only
+    # the child that serves requests starts the background workers
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_background_workers()
+    app.run(debug=debug, host='0.0.0.0', port=5000)
@@ -0,0 +1,140 @@
+import threading
+import time
+import logging
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+class AwsClientRegistry:
+    """One boto3 client (or resource) per AWS service, shared by every thread.
+
+    Creating a client loads the service model and resolves its endpoint,
+    which costs a few hundred milliseconds on the Pi, so it is done once per
+    process. boto3 clients are thread-safe; creation goes through one
+    session under a lock because sessions are not. Each client keeps up to
+    `max_pool_connections` keep-alive HTTPS connections, so size it for the
+    number of threads that call AWS at once. If `on_call` is given, every
+    API call reports on_call(service, operation, seconds, error), timed
+    through botocore's event hooks so retries are included.
+    """
+
+    def __init__(self, region, max_pool_connections=10, connect_timeout=3, read_timeout=10, endpoints=None,
+                 on_call=None):
+        self.region = region
+        self.endpoints = endpoints or {}  # service -> endpoint_url, e.g. the account's iot-data endpoint
+        self.on_call = on_call
+        self.config = Config(
+            region_name=region,
+            max_pool_connections=max_pool_connections,
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            tcp_keepalive=True,
+            retries={'max_attempts': 3, 'mode': 'standard'}
+        )
+        self._session = boto3.session.Session(region_name=region)
+        self._clients = {}
+        self._resources = {}
+        self._created_ms = {}
+        self._lock = threading.Lock()
+
+    def client(self, service):
+        client = self._clients.get(service)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(service)
+                if client is None:
+                    client = self._timed(service, lambda: self._session.client(
+                        service, config=self.config, endpoint_url=self.endpoints.get(service)))
+                    self._instrument(client)
+                    self._clients[service] = client
+        return client
+
+    def resource(self, service):
+        resource = self._resources.get(service)
+        if resource is None:
+            with self._lock:
+                resource = self._resources.get(service)
+                if resource is None:
+                    resource = self._timed(f"{service} (resource)", lambda: self._session.resource(
+                        service, config=self.config, endpoint_url=self.endpoints.get(service)))
+                    self._instrument(resource.meta.client)
+                    self._resources[service] = resource
+        return resource
+
+    def warm(self, clients=(), resources=()):
+        """Create clients ahead of the first request. Failures are logged, not raised."""
+        for service in clients:
+            try:
+                self.client(service)
+            except Exception as e:
+                logger.warning(f"Could not create {service} client: {e}")
+        for service in resources:
+            try:
+                self.resource(service)
+            except Exception as e:
+                logger.warning(f"Could not create {service} resource: {e}")
+
+    def stats(self):
+        with self._lock:
+            clients = dict(self._clients)
+            clients.update({f"{name} (resource)": r.meta.client for name, r in self._resources.items()})
+            created_ms = dict(self._created_ms)
+
+        services = {}
+        for name, client in clients.items():
+            services[name] = dict(self._pool_stats(client), created_ms=round(created_ms.get(name, 0), 1))
+        return {
+            'region': self.region,
+            'max_pool_connections': self.config.max_pool_connections,
+            'services': services
+        }
+
+    def _timed(self, name, create):
+        started = time.monotonic()
+        created = create()
+        self._created_ms[name] = (time.monotonic() - started) * 1000
+        logger.info(f"Created AWS {name} client in {self._created_ms[name]:.0f} ms")
+        return created
+
+    def _instrument(self, client):
+        if self.on_call is None:
+            return
+        events = client.meta.events
+        events.register('before-call', self._call_started)
+        events.register('after-call', self._call_finished)
+        # Raised before a response arrived (connection errors, timeouts)
+        events.register('after-call-error', self._call_failed)
+
+    def _call_started(self, context, **kwargs):
+        context['metrics_started'] = time.perf_counter()
+
+    def _call_finished(self, event_name, context, http_response=None, **kwargs):
+        status = getattr(http_response, 'status_code', None)
+        self._report(event_name, context, status is None or status >= 300)
+
+    def _call_failed(self, event_name, context, **kwargs):
+        self._report(event_name, context, True)
+
+    def _report(self, event_name, context, error):
+        started = context.pop('metrics_started', None)
+        if started is None:
+            return
+        # event_name is "<event>.<service>.<Operation>"
+        _, service, operation = event_name.split('.', 2)
+        self.on_call(service, operation, time.perf_counter() - started, error)
+
+    @staticmethod
+    def _pool_stats(client):
+        # urllib3 keeps one connection pool per host; botocore doesn't expose
+        # it publicly, so report what is there and nothing if it moved
+        try:
+            manager = client._endpoint.http_session._manager
+            pools = [manager.pools[key] for key in manager.pools.keys()]
+        except Exception:
+            return {}
+        return {
+            'hosts': len(pools),
+            'connections_opened': sum(pool.num_connections for pool in pools),
+            'requests': sum(pool.num_requests for pool in pools)
+        }
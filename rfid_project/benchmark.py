@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the cart's scan -> validate -> checkout path.
+
+Replays an Arduino trace into serial_handler.py through a pseudo-terminal and
+drives app.py's routes with concurrent shoppers, then reports p50/p99 latency
+and throughput for every stage.
+
+    python3 benchmark.py --trace serial_handler.log --app http://localhost:5000 --shoppers 8
+
+The serial handler runs inside this process against a scratch database
+(--database, loaded from cart.sql beforehand); serial latency is measured from
+the line written to the pty to the event the handler publishes after its
+commit. Start app.py separately with CART_DB_NAME set to the same database,
+and with DYNAMODB_ENDPOINT pointing at a DynamoDB stand-in such as DynamoDB
+Local (--create-tables creates the tables there).
+"""
+
+import os
+import re
+import sys
+import tty
+import json
+import time
+import math
+import struct
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+import http.cookiejar
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# The handler's command bus must not collide with a cart running on this Pi
+os.environ.setdefault('CART_COMMAND_BUS', os.path.join(tempfile.gettempdir(), 'smart_cart_benchmark.sock'))
+
+from command_bus import EventSubscriber
+from serial_protocol import FRAME_KINDS, FrameParser, encode_frame
+
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3}) - \w+ - Received from Arduino(?: on \S+)?: (.*)$')
+LOG_LINE_START = re.compile(r'^\d{4}-\d\d-\d\d ')
+MAX_GAP = 5.0  # longest pause replayed from a log; the rest is idle time between sessions
+RESPONSE_PREFIXES = ('DATA:', 'OK:', 'ERR:')   # answers to commands, not replayed on their own
+FRAME_TYPES = {kind: frame_type for frame_type, kind in FRAME_KINDS.items()}
+WARMUP = 3.0   # seconds for the handler to open the pty (it waits 2 s for an Arduino reset)
+SERIAL_STAGES = {
+    'scan': "serial: CARD -> scan event",
+    'fraud': "serial: FRAUD -> fraud event",
+    'weight': "serial: Weight -> weight event",
+}
+
+# Tables app.py uses, with the keys from terraform/main.tf
+DYNAMODB_TABLES = {
+    'iot-convenience-store-sessions-production': [('session_id', 'HASH')],
+    'iot-convenience-store-customers-production': [('customer_id', 'HASH')],
+    'iot-convenience-store-transactions-production': [('transaction_id', 'HASH'), ('session_id', 'RANGE')],
+    'iot-convenience-store-fraud-events-production': [('event_id', 'HASH'), ('timestamp', 'RANGE')],
+    'iot-convenience-store-products-production': [('product_id', 'HASH')],
+    'iot-convenience-store-discount-effectiveness-production': [('discount_id', 'HASH')],
+}
+
+class Stats:
+    """Latency samples and error counts per stage."""
+
+    def __init__(self):
+        self._samples = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+
+    def error(self, stage):
+        with self._lock:
+            self._errors[stage] = self._errors.get(stage, 0) + 1
+
+    def report(self, title, elapsed):
+        print(f"\n{title} ({elapsed:.1f} s)")
+        print(f"{'stage':<40} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'per s':>8}")
+        with self._lock:
+            stages = sorted(set(self._samples) | set(self._errors))
+            for stage in stages:
+                samples = sorted(self._samples.get(stage, []))
+                errors = self._errors.get(stage, 0)
+                if samples:
+                    print(f"{stage:<40} {len(samples):>6} {errors:>6} {percentile(samples, 50) * 1000:>8.1f} "
+                          f"{percentile(samples, 99) * 1000:>8.1f} {samples[-1] * 1000:>8.1f} "
+                          f"{len(samples) / elapsed:>8.1f}")
+                else:
+                    print(f"{stage:<40} {0:>6} {errors:>6}")
+
+def percentile(samples, p):
+    """Nearest-rank percentile of sorted samples."""
+    return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+# ---------- Traces ----------
+
+def load_trace(path, max_gap=MAX_GAP):
+    """Read a trace: either a serial_handler.log, replayed with its recorded
+    timing (pauses capped at `max_gap` seconds), or a plain file of Arduino
+    lines, one per line.
+
+    Returns (lines, responses): (offset_seconds, line) pairs to send unprompted
+    and the DATA: lines to answer READ commands with, in order.
+    """
+    lines, responses = [], []
+    offset, previous = 0.0, None
+    with open(path, errors='replace') as f:
+        for raw in f:
+            raw = raw.rstrip('\n')
+            match = LOG_LINE.match(raw)
+            if match:
+                at = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S,%f').timestamp()
+                if previous is not None:
+                    offset += min(max(at - previous, 0), max_gap)
+                previous, line = at, match.group(2).strip()
+            elif raw.strip() and not LOG_LINE_START.match(raw):
+                line = raw.strip()
+            else:
+                continue
+
+            if line.startswith('DATA:'):
+                responses.append(line)
+            elif not line.startswith(RESPONSE_PREFIXES):
+                lines.append((offset, line))
+    return lines, responses
+
+def synthetic_trace(scans, interval=1.0):
+    """A scan of `scans` items, each followed by the load cell settling on its weight."""
+    lines, responses = [], []
+    for i in range(scans):
+        at = i * interval
+        lines.append((at, f"CARD:{random.getrandbits(32):08X}"))
+        responses.append(f"DATA:Bench Item {i % 10}#{1 + i % 10}.50")
+        weight = random.uniform(50, 500)
+        for sample in range(4):
+            lines.append((at + 0.1 * (sample + 1), f"Weight: {weight + random.uniform(-0.5, 0.5):.2f}"))
+    return lines, responses
+
+# ---------- Serial stage ----------
+
+class FakeArduino:
+    """The cart firmware, on the master side of a pty.
+
+    Plays the trace's unprompted lines and answers the handler's commands:
+    READ with the trace's next DATA: line, WRITE/RESET and tare with OK:, and
+    PROTO:BIN by switching to binary frames.
+    """
+
+    def __init__(self, lines, responses, stats, speed=1.0):
+        self.lines = lines
+        self.responses = deque(responses or ["DATA:Bench Item#1.00"])
+        self.stats = stats
+        self.speed = speed
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.binary = False
+        self.sent = 0
+        self._write_lock = threading.Lock()
+        self._pending = {'scan': deque(), 'fraud': deque()}   # (match value, sent at)
+        self._last_weight = None
+        self._match_lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._answer, name="fake-arduino-commands", daemon=True).start()
+
+    def replay(self):
+        """Send the trace, keeping its timing scaled by `speed` (0 sends as fast as possible)."""
+        started = time.monotonic()
+        for offset, line in self.lines:
+            if self.speed:
+                delay = started + offset / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            sent_at = time.monotonic()
+            with self._match_lock:
+                if line.startswith('CARD:'):
+                    self._pending['scan'].append((line[5:].strip(), sent_at))
+                elif line.startswith('FRAUD:'):
+                    self._pending['fraud'].append((line[6:].strip(), sent_at))
+                elif line.startswith('Weight:'):
+                    self._last_weight = sent_at
+            self._send(line)
+
+    def on_event(self, event_type, data):
+        """Match an event published by the handler to the line that caused it."""
+        received = time.monotonic()
+        with self._match_lock:
+            if event_type == 'weight':
+                # Timed from the sample that let the weight settle
+                if self._last_weight is not None:
+                    self.stats.add(SERIAL_STAGES['weight'], received - self._last_weight)
+                return
+            key = data.get('tag_id') if event_type == 'scan' else data.get('details')
+            pending = self._pending.get(event_type, ())
+            for entry in pending:
+                if entry[0] == key:
+                    pending.remove(entry)
+                    self.stats.add(SERIAL_STAGES[event_type], received - entry[1])
+                    return
+
+    def unanswered(self):
+        with self._match_lock:
+            return {kind: len(pending) for kind, pending in self._pending.items()}
+
+    def _send(self, line):
+        if self.binary:
+            payload = self._frame(line)
+        else:
+            payload = f"{line}\r\n".encode()
+        with self._write_lock:
+            os.write(self.master, payload)
+            self.sent += len(payload)
+
+    def _frame(self, line):
+        try:
+            if line.startswith('CARD:'):
+                return encode_frame(FRAME_TYPES['CARD'], bytes.fromhex(line[5:].strip()))
+            if line.startswith('Weight:'):
+                grams = float(line.split(':', 1)[1])
+                return encode_frame(FRAME_TYPES['WEIGHT'], struct.pack('<i', round(grams * 100)))
+        except ValueError:
+            # Not valid as a card or weight; the text handler would treat it as chatter too
+            return encode_frame(FRAME_TYPES['INFO'], line.encode())
+        kind, _, text = line.partition(':')
+        if kind in FRAME_TYPES and kind != 'INFO':
+            return encode_frame(FRAME_TYPES[kind], text.encode())
+        return encode_frame(FRAME_TYPES['INFO'], line.encode())
+
+    def _answer(self):
+        buffer, parser = b'', FrameParser()
+        while True:
+            try:
+                data = os.read(self.master, 256)
+            except OSError:
+                return
+            if self.binary:
+                # Commands arrive as frames of an unknown (to the parser) type
+                commands = [payload for _, payload, _ in parser.feed(data)]
+            else:
+                buffer += data
+                *complete, buffer = buffer.split(b'\n')
+                commands = [line.decode(errors='replace').strip() for line in complete]
+            for command in commands:
+                self._command(command)
+
+    def _command(self, command):
+        if command == 'READ':
+            self._send(self.responses[0])
+            self.responses.rotate(-1)
+        elif command.startswith('WRITE:') or command == 'RESET':
+            self._send("OK:Write successful")
+        elif command == 't':
+            self._send("OK:Tare complete")
+        elif command.startswith('PROTO:BIN'):
+            self._send("OK:PROTO BIN")
+            self.binary = True
+
+def run_serial_stage(args, stats):
+    lines, responses = load_trace(args.trace, args.max_gap) if args.trace else synthetic_trace(args.scans)
+
+    import serial_handler
+    arduino = FakeArduino(lines, responses, stats, speed=args.speed)
+    arduino.start()
+
+    serial_handler.DB_CONFIG['database'] = args.database
+    serial_handler.SERIAL_PORT = arduino.port
+    serial_handler.SERIAL_PORTS = (arduino.port,)
+    serial_handler.SERIAL_PROTOCOL = 'binary' if args.binary else 'text'
+    threading.Thread(target=serial_handler.main, name="serial-handler", daemon=True).start()
+
+    subscriber = EventSubscriber(arduino.on_event)
+    subscriber.start()
+    time.sleep(WARMUP)
+
+    started = time.monotonic()
+    arduino.replay()
+    time.sleep(args.drain)
+    elapsed = time.monotonic() - started
+    subscriber.stop()
+
+    print(f"\nReplayed {len(lines)} lines ({arduino.sent} bytes, {'binary frames' if args.binary else 'text'}) "
+          f"into {arduino.port}; unanswered: {arduino.unanswered()}")
+    return elapsed
+
+# ---------- Web stage ----------
+
+class Shopper:
+    """One customer's browser: its own cookies, timing every request."""
+
+    def __init__(self, base_url, stats):
+        self.base_url = base_url.rstrip('/')
+        self.stats = stats
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, form=None):
+        stage = f"{method} {path}"
+        data = urllib.parse.urlencode(form).encode() if form is not None else None
+        started = time.monotonic()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=data, method=method), timeout=30) as response:
+                body = response.read()
+        except Exception:
+            # HTTPError included: a 4xx/5xx is an error for the benchmark
+            self.stats.error(stage)
+            return None
+        self.stats.add(stage, time.monotonic() - started)
+        try:
+            return json.loads(body)
+        except ValueError:
+            return None
+
+    def shop(self, number, items):
+        """Start a session, validate up to `items` scans, look at the cart and check out."""
+        if self.request('POST', '/create_session', {'name': f"Benchmark Shopper {number}", 'address': 'benchmark'}) is None:
+            return
+        for _ in range(items):
+            scan = self.request('GET', '/get_recent_scan') or {}
+            item = scan.get('item')
+            if item and not item.get('is_validated'):
+                self.request('POST', '/validate_item', {'item_id': item['id']})
+            self.request('GET', '/get_cart_items')
+        self.request('GET', '/get_cart_items_with_discounts')
+        self.request('POST', '/checkout')
+
+def run_web_stage(args, stats):
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.shoppers) as pool:
+        for number in range(args.shoppers * args.rounds):
+            pool.submit(Shopper(args.app, stats).shop, number, args.items)
+    return time.monotonic() - started
+
+def create_tables(endpoint, region):
+    import boto3
+    dynamodb = boto3.client('dynamodb', endpoint_url=endpoint, region_name=region)
+    existing = set(dynamodb.list_tables()['TableNames'])
+    for name, keys in DYNAMODB_TABLES.items():
+        if name in existing:
+            continue
+        dynamodb.create_table(
+            TableName=name,
+            KeySchema=[{'AttributeName': attribute, 'KeyType': key_type} for attribute, key_type in keys],
+            AttributeDefinitions=[{'AttributeName': attribute, 'AttributeType': 'S'} for attribute, _ in keys],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        print(f"Created {name} on {endpoint}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--trace', help="serial_handler.log or a file of Arduino lines (default: a synthetic trace)")
+    parser.add_argument('--scans', type=int, default=50, help="items in the synthetic trace")
+    parser.add_argument('--max-gap', type=float, default=MAX_GAP, help="longest pause replayed from a log, in seconds")
+    parser.add_argument('--speed', type=float, default=1.0, help="replay speed factor; 0 sends as fast as possible")
+    parser.add_argument('--binary', action='store_true', help="negotiate the framed binary protocol")
+    parser.add_argument('--drain', type=float, default=2.0, help="seconds to wait for the last events after the replay")
+    parser.add_argument('--database', default='automated_shopping_cart_bench', help="scratch database for the serial handler")
+    parser.add_argument('--no-serial', action='store_true', help="only drive the web app")
+    parser.add_argument('--app', help="base URL of a running app.py to drive, e.g. http://localhost:5000")
+    parser.add_argument('--shoppers', type=int, default=4, help="concurrent shoppers")
+    parser.add_argument('--rounds', type=int, default=5, help="shopping trips per shopper")
+    parser.add_argument('--items', type=int, default=5, help="scans each shopper tries to validate")
+    parser.add_argument('--create-tables', metavar='ENDPOINT', help="create the DynamoDB tables on a stand-in endpoint")
+    parser.add_argument('--region', default='us-east-1')
+    args = parser.parse_args()
+
+    # Set up before serial_handler is imported, so its logging goes here
+    # rather than into the serial_handler.log a trace may be read from
+    logging.basicConfig(level=logging.INFO, filename='benchmark.log',
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    if args.create_tables:
+        create_tables(args.create_tables, args.region)
+
+    serial_stats, web_stats = Stats(), Stats()
+    results = {}
+    threads = []
+    if not args.no_serial:
+        threads.append(threading.Thread(target=lambda: results.update(serial=run_serial_stage(args, serial_stats))))
+    if args.app:
+        # Shoppers start once the handler is up, so they see the replayed scans
+        def web():
+            if not args.no_serial:
+                time.sleep(WARMUP)
+            results['web'] = run_web_stage(args, web_stats)
+        threads.append(threading.Thread(target=web))
+    if not threads:
+        parser.error("nothing to run: give --app and/or leave the serial stage on")
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if 'serial' in results:
+        serial_stats.report("Serial handler", results['serial'])
+    if 'web' in results:
+        web_stats.report(f"Web app ({args.shoppers} shoppers)", results['web'])
+
+if __name__ == "__main__":
+    sys.exit(main())
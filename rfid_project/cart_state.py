@@ -0,0 +1,233 @@
+import threading
+import logging
+from decimal import Decimal
+from discounts import apply_discounts
+
+logger = logging.getLogger(__name__)
+
+CART_ID = 'cart-001'
+SESSION_TTL_HOURS = 4   # temp_active_sessions rows expire this long after the last change
+
+class Cart:
+    """Validated items and running totals for one shopping session.
+
+    Totals are kept up to date as items are added, so reading them never
+    walks the item list. Discount savings are recomputed only when the
+    session's offers change.
+    """
+
+    def __init__(self, session_token, customer_id=None, cloud_session_id=None,
+                 cloud_customer_id=None, customer_name=None):
+        self.session_token = session_token
+        self.customer_id = customer_id
+        self.cloud_session_id = cloud_session_id
+        self.cloud_customer_id = cloud_customer_id
+        self.customer_name = customer_name
+        self.fraud_alerts = 0
+        self.checkout_completed = False
+        self._items = {}              # scanned_items.id -> item
+        self._discounts = {}
+        self._running_total = Decimal('0.00')
+        self._total_savings = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, item):
+        """Add a validated item (id, tag_id, timestamp, weight, product fields). Returns False if already in the cart."""
+        with self._lock:
+            if item['id'] in self._items:
+                return False
+            self._items[item['id']] = item
+            self._running_total += Decimal(str(item['price']))
+            self._total_savings += self._saving(item)
+            return True
+
+    def copy(self):
+        """An independent cart with the same session, items and offers.
+
+        Routes persist a copy with their change applied and make the change
+        to the cart itself only once that commits.
+        """
+        cart = Cart(self.session_token, self.customer_id, self.cloud_session_id,
+                    self.cloud_customer_id, self.customer_name)
+        with self._lock:
+            cart.fraud_alerts = self.fraud_alerts
+            cart.checkout_completed = self.checkout_completed
+            cart._items = dict(self._items)
+            cart._discounts = dict(self._discounts)
+            cart._running_total = self._running_total
+            cart._total_savings = self._total_savings
+        return cart
+
+    def remove(self, item_id):
+        with self._lock:
+            item = self._items.pop(item_id, None)
+            if item is not None:
+                self._running_total -= Decimal(str(item['price']))
+                self._total_savings -= self._saving(item)
+            return item
+
+    def count_fraud(self):
+        with self._lock:
+            self.fraud_alerts += 1
+
+    def set_discounts(self, discounts):
+        """Use the session's current discount map, re-pricing only if it changed."""
+        with self._lock:
+            if discounts == self._discounts:
+                return
+            self._discounts = dict(discounts)
+            self._total_savings = sum(self._saving(item) for item in self._items.values())
+
+    @property
+    def item_count(self):
+        return len(self._items)
+
+    @property
+    def running_total(self):
+        """Total before discounts."""
+        return self._running_total
+
+    def totals(self):
+        with self._lock:
+            original_total = float(self._running_total)
+            return {
+                'total': original_total - self._total_savings,
+                'original_total': original_total,
+                'total_savings': self._total_savings
+            }
+
+    def items(self):
+        """Copies of the items, newest first, at their undiscounted prices."""
+        with self._lock:
+            items = [dict(item) for item in self._items.values()]
+        items.sort(key=lambda item: item['timestamp'], reverse=True)
+        return items
+
+    def priced_items(self):
+        """Copies of the items with the session's discounts applied (see apply_discounts)."""
+        with self._lock:
+            discounts = self._discounts
+        items = self.items()
+        apply_discounts(discounts, items)
+        return items
+
+    def _saving(self, item):
+        discount_percent = self._discounts.get(item['product_name'])
+        if not discount_percent:
+            return 0.0
+        return float(item['price']) * discount_percent / 100
+
+class CartStore:
+    """The carts of active sessions, mirrored to temp_active_sessions.
+
+    A cart is opened when its session starts, or rebuilt from scanned_items
+    the first time it is asked for after a restart. Every change is written
+    back to temp_active_sessions in the caller's transaction.
+    """
+
+    def __init__(self, cart_id=CART_ID, ttl_hours=SESSION_TTL_HOURS):
+        self.cart_id = cart_id
+        self.ttl_hours = ttl_hours
+        self._carts = {}
+        self._active = None   # session token of the cart most recently opened on this device
+        self._lock = threading.Lock()
+
+    def open(self, cursor, session_token, customer_id=None, cloud_session_id=None,
+             cloud_customer_id=None, customer_name=None, items=()):
+        """Start the cart of a new session, holding any validated items
+        already on the device, and write its row. The cart is only served
+        once activate() is called after that commits."""
+        cart = Cart(session_token, customer_id, cloud_session_id, cloud_customer_id, customer_name)
+        for item in items:
+            cart.add(item)
+        cursor.execute("DELETE FROM temp_active_sessions WHERE expires_at < NOW()")
+        self.persist(cursor, cart)
+        return cart
+
+    def activate(self, cart):
+        """Serve a cart from open() as its session's, and this device's, cart."""
+        with self._lock:
+            self._carts[cart.session_token] = cart
+            self._active = cart.session_token
+
+    def get(self, session_token):
+        with self._lock:
+            return self._carts.get(session_token)
+
+    def load(self, cursor, session_token, items):
+        """Rebuild a cart that isn't in memory from its validated items and saved
+        row. Takes a dictionary cursor."""
+        cart = Cart(session_token)
+        if session_token is not None:
+            cursor.execute("""
+                SELECT cloud_session_id, cloud_customer_id, customer_name, fraud_alerts
+                FROM temp_active_sessions WHERE session_token = %s
+            """, (str(session_token),))
+            row = cursor.fetchone()
+            if row:
+                cart.cloud_session_id = row['cloud_session_id'] or None
+                cart.cloud_customer_id = row['cloud_customer_id'] or None
+                cart.customer_name = row['customer_name']
+                cart.fraud_alerts = row['fraud_alerts'] or 0
+        for item in items:
+            cart.add(item)
+
+        with self._lock:
+            # Another request may have loaded it meanwhile; keep the first
+            cart = self._carts.setdefault(session_token, cart)
+            if self._active is None:
+                self._active = session_token
+        logger.info(f"Loaded cart for session {session_token}: {cart.item_count} items")
+        return cart
+
+    def active(self):
+        """The cart of the session currently using this device, if any."""
+        with self._lock:
+            return self._carts.get(self._active)
+
+    def for_cloud_session(self, cloud_session_id):
+        with self._lock:
+            return next((cart for cart in self._carts.values()
+                         if cloud_session_id and cart.cloud_session_id == cloud_session_id), None)
+
+    def close(self, cursor, session_token):
+        """Mark a finished session's row completed. The cart stays in memory
+        until forget() is called once this commits."""
+        cart = self.get(session_token)
+        if cart is not None:
+            closed = cart.copy()
+            closed.checkout_completed = True
+            self.persist(cursor, closed)
+        return cart
+
+    def forget(self, session_token):
+        """Drop a closed session's cart."""
+        with self._lock:
+            cart = self._carts.pop(session_token, None)
+            if self._active == session_token:
+                self._active = None
+        if cart is not None:
+            cart.checkout_completed = True
+        return cart
+
+    def persist(self, cursor, cart):
+        if cart.session_token is None:
+            return
+        totals = cart.totals()
+        discount_percentage = (round(totals['total_savings'] / totals['original_total'] * 100, 2)
+                               if totals['original_total'] else 0)
+        cursor.execute("""
+            INSERT INTO temp_active_sessions
+                (session_token, cart_identifier, cloud_session_id, cloud_customer_id, customer_name,
+                 discount_percentage, items_in_cart, running_total, fraud_alerts, checkout_completed, expires_at)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, NOW() + INTERVAL %s HOUR)
+            ON DUPLICATE KEY UPDATE
+                discount_percentage = VALUES(discount_percentage),
+                items_in_cart = VALUES(items_in_cart),
+                running_total = VALUES(running_total),
+                fraud_alerts = VALUES(fraud_alerts),
+                checkout_completed = VALUES(checkout_completed),
+                expires_at = VALUES(expires_at)
+        """, (str(cart.session_token), self.cart_id, cart.cloud_session_id or '', cart.cloud_customer_id or '',
+              cart.customer_name, discount_percentage, cart.item_count, cart.running_total,
+              cart.fraud_alerts, cart.checkout_completed, self.ttl_hours))
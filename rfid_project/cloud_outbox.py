@@ -0,0 +1,284 @@
+import json
+import threading
+import time
+import uuid
+import logging
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+SEND_INTERVAL = 5.0     # seconds between outbox sweeps when nothing wakes the sender
+SEND_BATCH = 100        # entries claimed per sweep
+RETRY_BASE = 2          # seconds before the first retry, doubled per attempt
+RETRY_MAX = 300         # longest wait between retries
+MAX_ATTEMPTS = 12       # after this an entry is parked as 'failed' for manual replay
+PURGE_INTERVAL = 3600   # seconds between clean-ups of delivered entries
+CLAIM_TIMEOUT = 300     # seconds before an entry claimed by a sender that died is claimed again
+KEEP_SENT_DAYS = 7      # delivered entries are kept this long for auditing
+
+# Cloud writes that must not be lost or block a request are recorded in
+# cloud_outbox in the same transaction as the local change, then delivered by
+# OutboxSender. Each entry has an idempotency key that the handler passes on to
+# DynamoDB/Lambda, so delivering an entry twice has no extra effect. Entries
+# sharing an ordering key (the cloud session) are delivered strictly in order.
+# A sender claims the entries it is about to deliver (status 'sending'), so
+# several senders - e.g. two app processes - never deliver the same entry.
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+def enqueue(cursor, operation, payload, ordering_key=None, idempotency_key=None):
+    """Record a cloud write inside the caller's transaction. Returns its key.
+
+    The caller commits as usual and may call OutboxSender.wake() afterwards.
+    """
+    idempotency_key = idempotency_key or uuid.uuid4().hex
+    cursor.execute(
+        "INSERT INTO cloud_outbox (idempotency_key, operation, ordering_key, payload) VALUES (%s, %s, %s, %s)",
+        (idempotency_key, operation, ordering_key, json.dumps(payload, default=_json_default))
+    )
+    return idempotency_key
+
+class OutboxSender(threading.Thread):
+    """Drains cloud_outbox in the background, retrying with back-off.
+
+    `handlers` maps an operation name to a callable taking (payload, key) and
+    returning a truthy value once the cloud has accepted the write. A falsy
+    return or an exception schedules a retry.
+
+    Operations in `batch_handlers` map instead to (batch, stage): `stage`
+    takes (batch, payload) and queues the write in `batch` (a DynamoWriteBatch
+    or MqttPublishBatch), and the entries are delivered together when that
+    batch is flushed. An operation in both maps is batched.
+    """
+
+    def __init__(self, pool, handlers, interval=SEND_INTERVAL, batch_handlers=None):
+        super().__init__(name="cloud-outbox", daemon=True)
+        self.pool = pool
+        self.handlers = handlers
+        self.interval = interval
+        self.batch_handlers = batch_handlers or {}
+        self.claim_id = uuid.uuid4().hex
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+
+    def wake(self):
+        """Deliver new entries now instead of at the next sweep."""
+        self._wake.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def run(self):
+        last_purge = 0
+        while not self._stop_event.is_set():
+            try:
+                while self.send_pending():
+                    pass
+                if time.time() - last_purge >= PURGE_INTERVAL:
+                    self.purge_sent()
+                    last_purge = time.time()
+            except Exception as e:
+                logger.error(f"Cloud outbox sweep failed: {e}")
+            woken = self._wake.wait(self.interval)
+            self._wake.clear()
+            if woken and self.batch_handlers:
+                # Let the rest of a burst commit so it shares one flush
+                self._stop_event.wait(max(batch.window for batch, _ in self.batch_handlers.values()))
+
+    def send_pending(self):
+        """Deliver due entries once. Returns how many were attempted."""
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.cursor(dictionary=True)
+            entries = self._claim(cursor)
+            conn.commit()
+
+            attempted = 0
+            blocked = set()
+            staged = {}   # batch -> entries staged into it
+            for entry in entries:
+                ordering_key = entry['ordering_key']
+                if ordering_key is not None and ordering_key in blocked:
+                    continue
+                attempted += 1
+
+                batch, stage = self.batch_handlers.get(entry['operation'], (None, None))
+                # Anything staged for the same session elsewhere must land first
+                self._flush_key(cursor, staged, blocked, ordering_key, batch)
+                if ordering_key is not None and ordering_key in blocked:
+                    conn.commit()
+                    continue
+
+                if stage is not None:
+                    try:
+                        stage(batch, json.loads(entry['payload']))
+                        staged.setdefault(batch, []).append(entry)
+                    except Exception as e:
+                        self._failed(cursor, entry, e)
+                        blocked.add(ordering_key)
+                    if batch.due():
+                        self._flush(cursor, batch, staged.pop(batch, []), blocked)
+                elif not self._deliver(cursor, entry):
+                    blocked.add(ordering_key)
+                conn.commit()
+
+            if staged:
+                for batch, batch_entries in staged.items():
+                    self._flush(cursor, batch, batch_entries, blocked)
+                conn.commit()
+
+            cursor.close()
+            return attempted
+        finally:
+            self._release(conn)
+            conn.close()
+
+    def _claim(self, cursor):
+        """Claim due entries for this sender and return them in delivery order."""
+        # An entry waits while an older one with the same ordering key is
+        # backing off or being delivered by another sender. Older due entries
+        # sort first, so they are claimed in this sweep and the loop in
+        # send_pending() keeps them in order.
+        cursor.execute("""
+            SELECT o.id
+            FROM cloud_outbox o
+            WHERE (o.status = 'pending' AND o.next_attempt_at <= NOW()
+                   OR o.status = 'sending' AND o.claimed_at < NOW() - INTERVAL %s SECOND)
+            AND NOT EXISTS (
+                SELECT 1 FROM cloud_outbox p
+                WHERE p.ordering_key = o.ordering_key AND p.id < o.id
+                AND (p.status = 'pending' AND p.next_attempt_at > NOW()
+                     OR p.status = 'sending' AND p.claimed_at >= NOW() - INTERVAL %s SECOND)
+            )
+            ORDER BY o.id
+            LIMIT %s
+        """, (CLAIM_TIMEOUT, CLAIM_TIMEOUT, SEND_BATCH))
+        ids = [row['id'] for row in cursor.fetchall()]
+        if not ids:
+            return []
+
+        # The UPDATE re-checks each row under its lock, so when two senders
+        # picked the same entry only the first one claims it
+        placeholders = ', '.join(['%s'] * len(ids))
+        cursor.execute(f"""
+            UPDATE cloud_outbox
+            SET status = 'sending', claimed_by = %s, claimed_at = NOW()
+            WHERE id IN ({placeholders})
+            AND (status = 'pending' OR status = 'sending' AND claimed_at < NOW() - INTERVAL %s SECOND)
+        """, (self.claim_id, *ids, CLAIM_TIMEOUT))
+
+        # Skip (and release afterwards) an entry whose session has an older
+        # entry another sender claimed or released in the meantime
+        cursor.execute("""
+            SELECT o.id, o.idempotency_key, o.operation, o.ordering_key, o.payload, o.attempts
+            FROM cloud_outbox o
+            WHERE o.claimed_by = %s AND o.status = 'sending'
+            AND NOT EXISTS (
+                SELECT 1 FROM cloud_outbox p
+                WHERE p.ordering_key = o.ordering_key AND p.id < o.id
+                AND p.status IN ('pending', 'sending') AND NOT (p.claimed_by <=> o.claimed_by)
+            )
+            ORDER BY o.id
+        """, (self.claim_id,))
+        return cursor.fetchall()
+
+    def _release(self, conn):
+        """Hand back entries this sender claimed but did not attempt."""
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "UPDATE cloud_outbox SET status = 'pending', claimed_by = NULL WHERE claimed_by = %s AND status = 'sending'",
+                (self.claim_id,)
+            )
+            conn.commit()
+            cursor.close()
+        except Exception as e:
+            logger.error(f"Could not release claimed outbox entries: {e}")
+
+    def purge_sent(self):
+        conn = self.pool.acquire()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                "DELETE FROM cloud_outbox WHERE status = 'sent' AND sent_at < NOW() - INTERVAL %s DAY",
+                (KEEP_SENT_DAYS,)
+            )
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def _deliver(self, cursor, entry):
+        """Attempt one entry and record the outcome. Returns True if delivered."""
+        handler = self.handlers.get(entry['operation'])
+        try:
+            if handler is None:
+                raise ValueError(f"No handler for outbox operation {entry['operation']}")
+            if not handler(json.loads(entry['payload']), entry['idempotency_key']):
+                raise RuntimeError("Cloud write was not accepted")
+        except Exception as e:
+            self._failed(cursor, entry, e)
+            return False
+
+        self._sent(cursor, entry)
+        return True
+
+    def _flush_key(self, cursor, staged, blocked, ordering_key, keep):
+        """Flush every batch except `keep` holding an entry with this ordering key."""
+        if ordering_key is None:
+            return
+        for batch in [b for b, entries in staged.items()
+                      if b is not keep and any(e['ordering_key'] == ordering_key for e in entries)]:
+            self._flush(cursor, batch, staged.pop(batch), blocked)
+
+    def _flush(self, cursor, batch, staged, blocked):
+        """Write a batch and record the outcome for each entry staged into it."""
+        try:
+            batch.flush()
+        except Exception as e:
+            for entry in staged:
+                self._failed(cursor, entry, e)
+                blocked.add(entry['ordering_key'])
+            return
+
+        for entry in staged:
+            self._sent(cursor, entry)
+
+    def _failed(self, cursor, entry, e):
+        attempts = entry['attempts'] + 1
+        if attempts >= MAX_ATTEMPTS:
+            status, delay = 'failed', 0
+            logger.error(f"Giving up on outbox entry {entry['id']} ({entry['operation']}): {e}")
+        else:
+            status, delay = 'pending', min(RETRY_BASE * 2 ** (attempts - 1), RETRY_MAX)
+            logger.warning(f"Outbox entry {entry['id']} ({entry['operation']}) failed, retry in {delay}s: {e}")
+        cursor.execute("""
+            UPDATE cloud_outbox
+            SET attempts = %s, status = %s, last_error = %s, claimed_by = NULL,
+                next_attempt_at = NOW() + INTERVAL %s SECOND
+            WHERE id = %s
+        """, (attempts, status, str(e)[:1000], delay, entry['id']))
+
+    def _sent(self, cursor, entry):
+        cursor.execute(
+            "UPDATE cloud_outbox SET status = 'sent', sent_at = NOW(), attempts = attempts + 1, claimed_by = NULL WHERE id = %s",
+            (entry['id'],)
+        )
+        logger.info(f"Outbox entry {entry['id']} ({entry['operation']}) delivered")
+
+def outbox_stats(cursor):
+    """Entry counts by status and the age of the oldest undelivered entry."""
+    cursor.execute("SELECT status, COUNT(*) FROM cloud_outbox GROUP BY status")
+    stats = {status: count for status, count in cursor.fetchall()}
+    cursor.execute("SELECT operation, COUNT(*) FROM cloud_outbox WHERE status IN ('pending', 'sending') GROUP BY operation")
+    stats['pending_by_operation'] = dict(cursor.fetchall())
+    cursor.execute("""
+        SELECT TIMESTAMPDIFF(SECOND, MIN(created_at), NOW())
+        FROM cloud_outbox WHERE status IN ('pending', 'sending')
+    """)
+    stats['oldest_pending_seconds'] = cursor.fetchone()[0]
+    return stats
@@ -0,0 +1,250 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+import logging
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+# Unix domain socket shared by app.py (client) and serial_handler.py (server)
+COMMAND_BUS_PATH = os.getenv('CART_COMMAND_BUS', '/tmp/smart_cart_commands.sock')
+
+CONNECT_TIMEOUT = 0.5   # seconds to reach the serial handler before falling back
+ACK_TIMEOUT = 3.0       # seconds to wait for a command to be executed when wait=True
+RECONNECT_DELAY = 1.0   # initial back-off for event subscribers, doubled up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 15.0
+
+# Wire format: one JSON object per line in each direction.
+#   Request:  {"command_type": "BUZZER", "parameters": {...}, "wait": true}
+#   Response: {"status": "complete" | "failed" | "queued", "response": "OK:..."}
+# With wait=false the serial handler acknowledges as soon as the command is
+# queued; with wait=true it answers after the Arduino has responded.
+#
+# A client may instead send {"subscribe": true}. The connection then stays
+# open and the serial handler pushes one line per cart event:
+#   Event:    {"event": "scan" | "weight" | "fraud", "data": {...}}
+
+def _json_default(value):
+    # Prices come out of MySQL as Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    return str(value)
+
+class CommandBusServer:
+    """Serial-handler side of the command bus.
+
+    Incoming commands are handed to `submit`, which must return a Future that
+    resolves to the response dict once the command has been executed. The
+    serial handler uses this to run commands on its main thread, or on the
+    device's worker thread for commands that wait on the Arduino, so a
+    database connection never crosses threads. publish() may be called from
+    any thread.
+    """
+
+    def __init__(self, submit, path=COMMAND_BUS_PATH, ack_timeout=ACK_TIMEOUT):
+        self.submit = submit
+        self.path = path
+        self.ack_timeout = ack_timeout
+        self._server = None
+        self._thread = None
+        self._subscribers = {}  # wfile -> socket of each event subscriber
+        self._subscribers_lock = threading.Lock()
+        self._publish_lock = threading.Lock()   # keeps events from different threads whole
+
+    def start(self):
+        # Remove a socket left behind by a previous run
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        bus = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if bus._is_subscribe(line):
+                        bus._serve_subscriber(self.connection, self.rfile, self.wfile)
+                        return
+                    reply = bus._handle_line(line)
+                    self.wfile.write((json.dumps(reply) + "\n").encode())
+                    self.wfile.flush()
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="command-bus", daemon=True)
+        self._thread.start()
+        logger.info(f"Command bus listening on {self.path}")
+
+    def stop(self):
+        with self._subscribers_lock:
+            subscribers, self._subscribers = self._subscribers, {}
+        for connection in subscribers.values():
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def publish(self, event_type, data):
+        """Push an event to every subscriber. A subscriber that cannot keep up
+        or has gone away is dropped; it reconnects and carries on from there."""
+        payload = (json.dumps({'event': event_type, 'data': data}, default=_json_default) + "\n").encode()
+        with self._subscribers_lock:
+            subscribers = list(self._subscribers)
+
+        with self._publish_lock:
+            for wfile in subscribers:
+                try:
+                    wfile.write(payload)
+                    wfile.flush()
+                except OSError as e:
+                    logger.warning(f"Dropping event subscriber: {e}")
+                    with self._subscribers_lock:
+                        self._subscribers.pop(wfile, None)
+
+    def _is_subscribe(self, line):
+        try:
+            return bool(json.loads(line).get('subscribe'))
+        except (ValueError, AttributeError):
+            return False
+
+    def _serve_subscriber(self, connection, rfile, wfile):
+        with self._subscribers_lock:
+            self._subscribers[wfile] = connection
+        logger.info("Event subscriber connected")
+        try:
+            # Nothing more is expected from the client; block until it disconnects
+            while rfile.readline():
+                pass
+        except OSError:
+            pass
+        finally:
+            with self._subscribers_lock:
+                self._subscribers.pop(wfile, None)
+            logger.info("Event subscriber disconnected")
+
+    def _handle_line(self, line):
+        try:
+            message = json.loads(line)
+            command_type = message['command_type']
+        except (ValueError, KeyError) as e:
+            return {'status': 'failed', 'response': f"Invalid command message: {e}"}
+
+        future = self.submit(command_type, message.get('parameters') or {})
+        if not message.get('wait'):
+            return {'status': 'queued', 'response': None}
+
+        try:
+            return future.result(timeout=self.ack_timeout)
+        except FutureTimeoutError:
+            return {'status': 'queued', 'response': 'Still executing'}
+
+def send_command(command_type, parameters=None, wait=False, path=COMMAND_BUS_PATH):
+    """Send a command to the serial handler over the bus.
+
+    Returns the response dict, or None if the bus is not available (the
+    serial handler is not running or not answering).
+    """
+    message = {
+        'command_type': command_type,
+        'parameters': parameters or {},
+        'wait': wait
+    }
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(CONNECT_TIMEOUT)
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + "\n").encode())
+    except OSError as e:
+        logger.warning(f"Command bus unavailable for {command_type}: {e}")
+        sock.close()
+        return None
+
+    # From here on the command has been delivered, so never report the bus as
+    # down - the caller would persist the command and it would run twice
+    try:
+        if wait:
+            sock.settimeout(ACK_TIMEOUT + CONNECT_TIMEOUT)
+        reply = b""
+        while not reply.endswith(b"\n"):
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+        return json.loads(reply)
+    except (OSError, ValueError) as e:
+        logger.warning(f"No acknowledgement for {command_type}: {e}")
+        return {'status': 'queued', 'response': None}
+    finally:
+        sock.close()
+
+class EventSubscriber(threading.Thread):
+    """Client side of the event stream.
+
+    Keeps a subscription open to the serial handler and calls
+    `on_event(event_type, data)` for every pushed event, reconnecting with
+    back-off whenever the serial handler restarts.
+    """
+
+    def __init__(self, on_event, path=COMMAND_BUS_PATH):
+        super().__init__(name="command-bus-events", daemon=True)
+        self.on_event = on_event
+        self.path = path
+        self._stop_event = threading.Event()
+        self._sock = None
+
+    def stop(self):
+        self._stop_event.set()
+        if self._sock:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def run(self):
+        delay = RECONNECT_DELAY
+        while not self._stop_event.is_set():
+            try:
+                self._listen()
+                delay = RECONNECT_DELAY
+            except OSError as e:
+                logger.debug(f"Event stream unavailable, retrying in {delay:.0f}s: {e}")
+                self._stop_event.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def _listen(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock = sock
+        try:
+            sock.settimeout(CONNECT_TIMEOUT)
+            sock.connect(self.path)
+            sock.sendall(b'{"subscribe": true}\n')
+            sock.settimeout(None)
+            logger.info("Subscribed to serial handler events")
+
+            connected_at = time.monotonic()
+            for line in sock.makefile('rb'):
+                try:
+                    message = json.loads(line)
+                    self.on_event(message['event'], message.get('data'))
+                except (ValueError, KeyError) as e:
+                    logger.warning(f"Ignoring malformed event: {e}")
+                except Exception as e:
+                    logger.error(f"Event handler failed: {e}")
+
+            # A connection that drops straight away is treated like a failure
+            if time.monotonic() - connected_at < RECONNECT_DELAY:
+                raise OSError("Event stream closed by serial handler")
+        finally:
+            self._sock = None
+            sock.close()
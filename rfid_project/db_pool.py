@@ -0,0 +1,206 @@
+import threading
+import time
+import logging
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes free within the checkout timeout."""
+
+class PooledConnection:
+    """A checked-out connection. close() hands it back to the pool instead of
+    closing the socket, so existing `finally: conn.close()` code keeps working."""
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        cursor = self._conn.cursor(*args, **kwargs)
+        if self._pool.on_query is None:
+            return cursor
+        return TimedCursor(cursor, self._pool.on_query)
+
+    def close(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool.release(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class TimedCursor:
+    """Reports how long each execute() takes to on_query(statement, seconds, error).
+
+    Fetching isn't timed separately: the connector's default unbuffered
+    cursors read the result while executing the next statement or closing,
+    and its buffered ones read it all in execute().
+    """
+
+    def __init__(self, cursor, on_query):
+        self._cursor = cursor
+        self._on_query = on_query
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._cursor.close()
+
+    def execute(self, operation, *args, **kwargs):
+        return self._timed(self._cursor.execute, operation, args, kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self._timed(self._cursor.executemany, operation, args, kwargs)
+
+    def _timed(self, execute, operation, args, kwargs):
+        started = time.perf_counter()
+        error = True
+        try:
+            result = execute(operation, *args, **kwargs)
+            error = False
+            return result
+        finally:
+            self._on_query(operation, time.perf_counter() - started, error)
+
+class ConnectionPool:
+    """Bounded, health-checked pool of MySQL connections shared across threads.
+
+    Connections are created lazily up to `size`. A checkout waits up to
+    `timeout` seconds for a free connection and records how long it waited.
+    Connections idle for longer than `health_check_after` seconds are pinged
+    before being handed out and replaced if the server dropped them. If
+    `on_query` is given, cursors of checked-out connections report the
+    duration of every statement to it (see TimedCursor).
+    """
+
+    def __init__(self, db_config, size=8, timeout=5.0, health_check_after=30.0, on_query=None):
+        self.db_config = db_config
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.on_query = on_query
+
+        self._idle = []  # (connection, returned_at), most recently used last
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'replaced': 0,
+            'timeouts': 0,
+            'waits': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0
+        }
+
+    def acquire(self, timeout=None):
+        """Check out a connection, creating one if the pool has room."""
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            while not self._idle and self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout(f"No database connection free after {timeout:.1f}s (pool size {self.size})")
+                self._cond.wait(remaining)
+
+            conn, returned_at = self._idle.pop() if self._idle else (None, None)
+            self._in_use += 1
+
+            waited_ms = (time.monotonic() - started) * 1000
+            self._stats['checkouts'] += 1
+            if waited_ms >= 1:
+                self._stats['waits'] += 1
+                self._stats['total_wait_ms'] += waited_ms
+                self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], waited_ms)
+
+        # Connecting and pinging happen outside the lock
+        try:
+            if conn is not None and time.monotonic() - returned_at > self.health_check_after:
+                conn = self._check_health(conn)
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        return PooledConnection(self, conn)
+
+    def release(self, conn):
+        """Return a connection; it is rolled back so no snapshot leaks into the next request."""
+        try:
+            conn.rollback()
+            healthy = True
+        except mysql.connector.Error as err:
+            logger.warning(f"Discarding pooled connection after failed rollback: {err}")
+            healthy = False
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+        with self._cond:
+            self._in_use -= 1
+            if healthy:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def stats(self):
+        """Pool size and wait-time metrics."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['in_use'] = self._in_use
+            stats['idle'] = len(self._idle)
+        stats['avg_wait_ms'] = stats['total_wait_ms'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+    def _connect(self):
+        conn = mysql.connector.connect(**self.db_config)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _check_health(self, conn):
+        """Return the connection if the server still answers, otherwise None."""
+        try:
+            conn.ping(reconnect=False)
+            return conn
+        except mysql.connector.Error as err:
+            logger.warning(f"Replacing stale pooled connection: {err}")
+            with self._cond:
+                self._stats['replaced'] += 1
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+            return None
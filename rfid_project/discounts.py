@@ -0,0 +1,151 @@
+import threading
+import time
+import logging
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_INDEX = 'customer-index'  # GSI on the discount table, hash key customer_id
+APPLIED_ACTIONS = ('shown',)       # customer_response.action_taken values that earn the discount
+REFRESH_AFTER = 60                 # seconds before a session's map is re-read (shelves add offers mid-visit)
+MAX_SESSIONS = 32                  # session maps kept in memory
+
+class DiscountEngine:
+    """Per-session discount maps built from the discount table.
+
+    A customer's discount records are read once when their session starts -
+    a Query on CUSTOMER_INDEX, following every page - and reduced to a map of
+    product name -> percentage. Pricing a cart is then one dictionary lookup
+    per item. The map is re-read at most every REFRESH_AFTER seconds so a
+    discount a smart shelf showed during the visit still applies at checkout.
+    """
+
+    def __init__(self, table, catalog=None, customer_index=CUSTOMER_INDEX,
+                 refresh_after=REFRESH_AFTER, max_sessions=MAX_SESSIONS):
+        self.table = table
+        self.catalog = catalog
+        self.customer_index = customer_index
+        self.refresh_after = refresh_after
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()  # session_id -> (customer_id, discounts, loaded_at)
+        self._lock = threading.Lock()
+        self._use_index = True
+        self._stats = {'queries': 0, 'scans': 0, 'hits': 0}
+
+    def prefetch(self, session_id, customer_id):
+        """Build the session's map in the background so session start doesn't wait."""
+        threading.Thread(target=self.for_session, args=(session_id, customer_id),
+                         name="discount-prefetch", daemon=True).start()
+
+    def for_session(self, session_id, customer_id):
+        """Return {product_name: discount_percentage} for the session's customer."""
+        if self.table is None or not customer_id:
+            return {}
+
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached and cached[0] == customer_id and time.time() - cached[2] < self.refresh_after:
+                self._sessions.move_to_end(session_id)
+                self._stats['hits'] += 1
+                return cached[1]
+
+        discounts = self.load_customer(customer_id)
+        with self._lock:
+            self._sessions[session_id] = (customer_id, discounts, time.time())
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return discounts
+
+    def end_session(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def load_customer(self, customer_id):
+        """Read a customer's discount records and reduce them to a price map."""
+        try:
+            records = self._customer_records(customer_id)
+        except Exception as e:
+            logger.error(f"Error getting discounts for {customer_id}: {e}")
+            return {}
+
+        discounts = {}
+        for record in records:
+            if record.get('customer_response', {}).get('action_taken', '') not in APPLIED_ACTIONS:
+                continue
+            details = record.get('discount_details', {})
+            product = self._product_name(details)
+            percentage = float(details.get('discount_percentage', 0) or 0)
+            if product and percentage > discounts.get(product, 0):
+                discounts[product] = percentage
+
+        logger.info(f"Loaded {len(discounts)} discounts from {len(records)} records for {customer_id}")
+        return discounts
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, sessions=len(self._sessions), using_index=self._use_index)
+
+    def _product_name(self, details):
+        if details.get('product_name'):
+            return details['product_name']
+        product_id = details.get('product_id')
+        if product_id and self.catalog is not None:
+            return self.catalog.cloud_product_name(product_id) or product_id
+        return product_id
+
+    def _customer_records(self, customer_id):
+        if self._use_index:
+            try:
+                return self._paginate(self.table.query, 'queries',
+                                      IndexName=self.customer_index,
+                                      KeyConditionExpression='customer_id = :customer_id',
+                                      ExpressionAttributeValues={':customer_id': customer_id})
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+                # The index hasn't been created on this table yet
+                logger.warning(f"Discount table has no {self.customer_index} index, falling back to scanning: {e}")
+                self._use_index = False
+
+        return self._paginate(self.table.scan, 'scans',
+                              FilterExpression='customer_id = :customer_id',
+                              ExpressionAttributeValues={':customer_id': customer_id})
+
+    def _paginate(self, operation, counter, **kwargs):
+        records = []
+        while True:
+            response = operation(**kwargs)
+            with self._lock:
+                self._stats[counter] += 1
+            records.extend(response.get('Items', []))
+            if 'LastEvaluatedKey' not in response:
+                return records
+            kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def apply_discounts(discounts, items):
+    """Price cart items against a discount map, in place.
+
+    Discounted items get original_price, discounted_price, discount_percent and
+    savings, and their price becomes the discounted one.
+    Returns (total, original_total, total_savings).
+    """
+    total = original_total = total_savings = 0
+    for item in items:
+        original_price = float(item['price'])
+        original_total += original_price
+
+        discount_percent = discounts.get(item['product_name'])
+        if discount_percent:
+            discounted_price = original_price * (1 - discount_percent / 100)
+            item['original_price'] = original_price
+            item['discounted_price'] = discounted_price
+            item['discount_percent'] = discount_percent
+            item['savings'] = original_price - discounted_price
+            item['price'] = discounted_price
+            total += discounted_price
+            total_savings += item['savings']
+        else:
+            total += original_price
+    return total, original_total, total_savings
@@ -0,0 +1,105 @@
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 25      # writes per flush; BatchWriteItem takes at most 25 items a request
+FLUSH_WINDOW = 0.5   # seconds a write may wait for others to share its flush
+
+class DynamoWriteBatch:
+    """Coalesces DynamoDB writes made by the cloud outbox sender.
+
+    Item puts are grouped per table and written with batch_writer, which
+    splits them into BatchWriteItem requests and resends unprocessed items.
+    Fraud events counted against a session are merged into one update_item
+    per session per flush instead of one per event. Like the serial handler's
+    WriteBatch, the batch is due once it holds `size` writes or its first
+    write is `window` seconds old.
+    """
+
+    def __init__(self, sessions_table, size=FLUSH_SIZE, window=FLUSH_WINDOW):
+        self.sessions_table = sessions_table
+        self.size = size
+        self.window = window
+        self._puts = {}        # table name -> (table, key attributes, items)
+        self._fraud_ids = {}   # session_id -> fraud event ids to count
+        self._writes = 0
+        self._started_at = None
+
+    @property
+    def pending(self):
+        return self._writes > 0
+
+    def put(self, table, item, pkeys):
+        """Queue a put. `pkeys` names the key attributes, so a repeated item replaces the earlier one."""
+        self._added()
+        self._puts.setdefault(table.name, (table, pkeys, []))[2].append(item)
+
+    def count_fraud_event(self, session_id, event_id):
+        """Queue one increment of the session's fraud_event_count."""
+        self._added()
+        self._fraud_ids.setdefault(session_id, {})[event_id] = True
+
+    def remaining(self):
+        """Seconds until the batch window closes."""
+        if self._started_at is None:
+            return self.window
+        return max(0, self._started_at + self.window - time.monotonic())
+
+    def due(self):
+        return self.pending and (self._writes >= self.size or self.remaining() == 0)
+
+    def flush(self):
+        """Write everything queued. Raises if any write failed; every write is
+        safe to repeat, so the caller can simply queue the lot again."""
+        puts, fraud_ids, writes = self._puts, self._fraud_ids, self._writes
+        self._puts, self._fraud_ids, self._writes, self._started_at = {}, {}, 0, None
+
+        for table, pkeys, items in puts.values():
+            with table.batch_writer(overwrite_by_pkeys=pkeys) as writer:
+                for item in items:
+                    writer.put_item(Item=item)
+
+        for session_id, event_ids in fraud_ids.items():
+            self._count_fraud_events(session_id, list(event_ids))
+
+        if writes > 1:
+            logger.debug(f"Flushed {writes} DynamoDB writes as {len(puts)} batch writes and {len(fraud_ids)} session updates")
+        return writes
+
+    def _added(self):
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        self._writes += 1
+
+    def _count_fraud_events(self, session_id, event_ids):
+        # fraud_event_ids remembers what has been counted, so a redelivered
+        # event is not counted twice
+        conditional_failed = self.sessions_table.meta.client.exceptions.ConditionalCheckFailedException
+        for _ in range(2):
+            ids = {f':id{i}': event_id for i, event_id in enumerate(event_ids)}
+            not_counted = ' AND '.join(f'NOT contains(fraud_event_ids, {name})' for name in ids)
+            try:
+                self.sessions_table.update_item(
+                    Key={'session_id': session_id},
+                    UpdateExpression='SET fraud_event_count = fraud_event_count + :inc, has_fraud_alerts = :has_fraud ADD fraud_event_ids :event_ids',
+                    ConditionExpression=f'attribute_not_exists(fraud_event_ids) OR ({not_counted})',
+                    ExpressionAttributeValues={
+                        ':inc': len(event_ids),
+                        ':has_fraud': True,
+                        ':event_ids': set(event_ids),
+                        **ids
+                    }
+                )
+                return
+            except conditional_failed:
+                # Some were counted by an earlier delivery - count only the rest
+                response = self.sessions_table.get_item(
+                    Key={'session_id': session_id},
+                    ProjectionExpression='fraud_event_ids'
+                )
+                counted = response.get('Item', {}).get('fraud_event_ids', set())
+                event_ids = [event_id for event_id in event_ids if event_id not in counted]
+                if not event_ids:
+                    return
+        raise RuntimeError(f"Fraud count for session {session_id} kept changing while updating it")
@@ -0,0 +1,69 @@
+import json
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+CLIENT_QUEUE_SIZE = 100   # events buffered per browser before the oldest are dropped
+HEARTBEAT_INTERVAL = 15.0 # seconds between keep-alive comments on an idle stream
+
+class EventHub:
+    """Fans cart events out to every connected browser.
+
+    Each stream gets its own bounded queue, so a slow or stalled client only
+    ever loses its own oldest events. Pages load their initial state from the
+    regular JSON routes and use the stream for what happens afterwards.
+    """
+
+    def __init__(self, queue_size=CLIENT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._clients = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        client = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self._clients.add(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def publish(self, event_type, data):
+        event = (event_type, data)
+        with self._lock:
+            clients = list(self._clients)
+
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                try:
+                    client.get_nowait()
+                except queue.Empty:
+                    pass
+                try:
+                    client.put_nowait(event)
+                except queue.Full:
+                    pass
+
+    def client_count(self):
+        with self._lock:
+            return len(self._clients)
+
+    def stream(self, client, heartbeat=HEARTBEAT_INTERVAL, encoder=None):
+        """Yield server-sent event frames for one client until it disconnects."""
+        try:
+            # Tell EventSource how quickly to reconnect after a dropped stream
+            yield "retry: 2000\n\n"
+            while True:
+                try:
+                    event_type, data = client.get(timeout=heartbeat)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: {event_type}\ndata: {json.dumps(data, cls=encoder, default=str)}\n\n"
+        finally:
+            self.unsubscribe(client)
@@ -0,0 +1,134 @@
+import re
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+WINDOW = 1024                  # most recent durations kept per series for the quantiles
+QUANTILES = (0.5, 0.95, 0.99)
+
+# metric -> help text; each is exported as <prefix>_<metric>_duration_seconds
+# (a summary) and <prefix>_<metric>_errors_total
+METRICS = {
+    'http_request': 'Time spent handling a Flask request, by route',
+    'db_query': 'Time spent executing a MySQL statement, by statement and table',
+    'aws_call': 'Time spent in a boto3 API call including retries, by service and operation'
+}
+
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|TABLE|UPDATE)\s+`?(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=512)
+def statement_label(statement):
+    """Reduce SQL to "<VERB> <table>", e.g. "SELECT scanned_items", so the
+    label doesn't grow with the parameters or whitespace of a query."""
+    words = statement.split(None, 1)
+    if not words:
+        return 'EMPTY'
+    verb = words[0].upper()
+    match = STATEMENT_TABLE.search(statement)
+    return f"{verb} {match.group(1)}" if match else verb
+
+class LatencySeries:
+    """Count, errors and total time since start, plus a window of recent durations."""
+
+    def __init__(self, window):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=window)
+
+class Metrics:
+    """Latency summaries for the cart app's routes, MySQL statements and AWS calls.
+
+    A series is a metric plus its labels. Quantiles are read from the most
+    recent `window` durations of the series, so they follow the current
+    load; counts and sums cover the whole process lifetime as Prometheus
+    expects. render() produces the Prometheus text format for /metrics.
+    """
+
+    def __init__(self, prefix='cart', window=WINDOW):
+        self.prefix = prefix
+        self.window = window
+        self._series = {}   # (metric, sorted label items) -> LatencySeries
+        self._lock = threading.Lock()
+
+    def observe(self, metric, labels, seconds, error=False):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = LatencySeries(self.window)
+            series.count += 1
+            series.total += seconds
+            series.samples.append(seconds)
+            if error:
+                series.errors += 1
+
+    def timer(self, metric, **labels):
+        return _Timer(self, metric, labels)
+
+    def record_query(self, statement, seconds, error=False):
+        """ConnectionPool on_query hook."""
+        self.observe('db_query', {'statement': statement_label(statement)}, seconds, error)
+
+    def record_aws_call(self, service, operation, seconds, error=False):
+        """AwsClientRegistry on_call hook."""
+        self.observe('aws_call', {'service': service, 'operation': operation}, seconds, error)
+
+    def render(self):
+        by_metric = {metric: [] for metric in METRICS}
+        for metric, *figures in self._collect():
+            by_metric.setdefault(metric, []).append(figures)
+
+        lines = []
+        for metric, series in by_metric.items():
+            name = f"{self.prefix}_{metric}"
+            lines.append(f"# HELP {name}_duration_seconds {METRICS.get(metric, metric)}")
+            lines.append(f"# TYPE {name}_duration_seconds summary")
+            for labels, count, errors, total, quantiles in series:
+                for q, value in quantiles.items():
+                    lines.append(f"{name}_duration_seconds{_labels(labels, quantile=q)} {value:.6f}")
+                lines.append(f"{name}_duration_seconds_sum{_labels(labels)} {total:.6f}")
+                lines.append(f"{name}_duration_seconds_count{_labels(labels)} {count}")
+            lines.append(f"# HELP {name}_errors_total Failed calls counted in {name}_duration_seconds")
+            lines.append(f"# TYPE {name}_errors_total counter")
+            for labels, count, errors, total, quantiles in series:
+                lines.append(f"{name}_errors_total{_labels(labels)} {errors}")
+        return '\n'.join(lines) + '\n'
+
+    def _collect(self):
+        with self._lock:
+            series = sorted((key, s.count, s.errors, s.total, list(s.samples))
+                            for key, s in self._series.items())
+        # Sorting the windows happens outside the lock
+        return [(metric, dict(labels), count, errors, total, _quantiles(samples))
+                for (metric, labels), count, errors, total, samples in series]
+
+class _Timer:
+    def __init__(self, metrics, metric, labels):
+        self.metrics = metrics
+        self.metric = metric
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.metric, self.labels, time.perf_counter() - self.started, exc_type is not None)
+
+def _quantiles(samples):
+    ordered = sorted(samples)
+    if not ordered:
+        return {q: 0.0 for q in QUANTILES}
+    return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    escaped = (f'{key}="{_escape(value)}"' for key, value in labels.items())
+    return '{' + ','.join(escaped) + '}'
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,203 @@
+import logging
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+# Named lock so app.py and serial_handler.py starting together don't both migrate
+MIGRATION_LOCK = 'automated_shopping_cart_schema'
+MIGRATION_LOCK_TIMEOUT = 30
+
+# The base tables (commands, scanned_items, product_data, transactions,
+# fraud_logs, ...) come from cart.sql. Migrations add what the code expects
+# on top of that. Append new migrations with the next version number; never
+# edit one that has shipped.
+
+def _column_exists(cursor, table, column):
+    # Schema introspection is fine here - it only runs while migrating
+    cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    """, (table, column))
+    return cursor.fetchone()[0] > 0
+
+def _create_session_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS customers (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            address TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_visit DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS shopping_sessions (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            customer_id INT,
+            cloud_session_id VARCHAR(100),
+            start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+            end_time DATETIME NULL,
+            total_amount DECIMAL(10, 2) DEFAULT 0.00,
+            fraud_alerts INT DEFAULT 0,
+            status ENUM('active', 'completed', 'abandoned') DEFAULT 'active',
+            FOREIGN KEY (customer_id) REFERENCES customers(id)
+        )
+    """)
+
+def _link_sessions(cursor):
+    for table in ('transactions', 'fraud_logs'):
+        if not _column_exists(cursor, table, 'session_id'):
+            cursor.execute(f"""
+                ALTER TABLE {table}
+                ADD COLUMN session_id INT,
+                ADD FOREIGN KEY (session_id) REFERENCES shopping_sessions(id)
+            """)
+            logger.info(f"Added session_id to {table} table")
+
+def _create_device_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS control_results (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            tag_id VARCHAR(100),
+            data TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS weight_readings (
+            id INT AUTO_INCREMENT PRIMARY KEY,
+            weight DECIMAL(10, 2) NOT NULL,
+            timestamp DATETIME NOT NULL,
+            processed BOOLEAN DEFAULT FALSE
+        )
+    """)
+
+def _track_fraud_sync(cursor):
+    if not _column_exists(cursor, 'fraud_logs', 'synced_to_cloud'):
+        cursor.execute("ALTER TABLE fraud_logs ADD COLUMN synced_to_cloud TINYINT(1) DEFAULT 0")
+        logger.info("Added synced_to_cloud to fraud_logs table")
+
+def _create_cloud_outbox(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cloud_outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            idempotency_key VARCHAR(64) NOT NULL UNIQUE,
+            operation VARCHAR(32) NOT NULL,
+            ordering_key VARCHAR(100) NULL,
+            payload TEXT NOT NULL,
+            status ENUM('pending', 'sent', 'failed') NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            last_error TEXT,
+            next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            INDEX idx_outbox_due (status, next_attempt_at),
+            INDEX idx_outbox_ordering (ordering_key, status)
+        )
+    """)
+
+def _create_temp_active_sessions(cursor):
+    # Same definition as cart.sql, for databases created before it was added
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS temp_active_sessions (
+            session_token VARCHAR(64) PRIMARY KEY,
+            cart_identifier VARCHAR(20) NOT NULL DEFAULT 'cart-001',
+            cloud_session_id VARCHAR(50) NOT NULL,
+            cloud_customer_id VARCHAR(50) NOT NULL,
+            customer_name VARCHAR(100),
+            customer_type ENUM('REGULAR', 'VIP', 'EMPLOYEE', 'ADMIN') DEFAULT 'REGULAR',
+            discount_percentage DECIMAL(5,2) DEFAULT 0.00,
+            items_in_cart INT DEFAULT 0,
+            running_total DECIMAL(10,2) DEFAULT 0.00,
+            fraud_alerts INT DEFAULT 0,
+            checkout_completed BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            last_activity TIMESTAMP DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+            INDEX idx_cart_identifier (cart_identifier),
+            INDEX idx_expires_at (expires_at),
+            INDEX idx_cloud_session (cloud_session_id)
+        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    """)
+
+def _claim_outbox_entries(cursor):
+    cursor.execute("""
+        ALTER TABLE cloud_outbox
+        MODIFY status ENUM('pending', 'sending', 'sent', 'failed') NOT NULL DEFAULT 'pending'
+    """)
+    if not _column_exists(cursor, 'cloud_outbox', 'claimed_by'):
+        cursor.execute("""
+            ALTER TABLE cloud_outbox
+            ADD COLUMN claimed_by VARCHAR(32) NULL,
+            ADD COLUMN claimed_at DATETIME NULL
+        """)
+        logger.info("Added claimed_by and claimed_at to cloud_outbox table")
+
+def _record_device(cursor):
+    # With several carts on one Pi, weights are matched to the items scanned
+    # on the same Arduino
+    for table in ('scanned_items', 'weight_readings'):
+        if not _column_exists(cursor, table, 'device'):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN device VARCHAR(64) NULL")
+            logger.info(f"Added device to {table} table")
+
+MIGRATIONS = [
+    (1, "Customer and shopping session tables", _create_session_tables),
+    (2, "Link transactions and fraud logs to sessions", _link_sessions),
+    (3, "Control page results and load cell readings", _create_device_tables),
+    (4, "Track which fraud events reached the cloud", _track_fraud_sync),
+    (5, "Outbox for cloud writes made off the request path", _create_cloud_outbox),
+    (6, "Cart state of active sessions", _create_temp_active_sessions),
+    (7, "Outbox entries claimed by one sender at a time", _claim_outbox_entries),
+    (8, "Record the Arduino of each scan and weight", _record_device),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(cursor):
+    """Return the recorded schema version (0 for a database never migrated)."""
+    cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cursor.fetchone()[0]
+
+def migrate(conn):
+    """Bring the database up to LATEST_VERSION. Safe to call on every startup.
+
+    Returns the schema version afterwards.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError("Timed out waiting for another process to finish migrating")
+
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+            version = current_version(cursor)
+            for number, description, apply in MIGRATIONS:
+                if number <= version:
+                    continue
+                logger.info(f"Applying schema migration {number}: {description}")
+                apply(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                    (number, description)
+                )
+                conn.commit()
+                version = number
+
+            return version
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+            cursor.fetchone()
+    except mysql.connector.Error:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 20      # messages published before waiting for their acknowledgements
+FLUSH_WINDOW = 0.5   # seconds a message may wait for others to share its flush
+ACK_TIMEOUT = 10     # seconds to wait for the broker to acknowledge a flush
+
+class MqttPublishBatch:
+    """Publishes the cloud outbox's MQTT messages over one long-lived connection.
+
+    Staged messages are published together with QoS 1 when the batch is
+    flushed, and the flush returns once the broker has acknowledged all of
+    them. Otherwise it raises, and the outbox keeps the entries and retries
+    them. cloud_outbox is the offline spool; the MQTT client queues nothing
+    itself, so at most `size` messages are held in memory. Like
+    DynamoWriteBatch, the batch is due once it holds `size` messages or its
+    first message is `window` seconds old.
+    """
+
+    def __init__(self, mqtt, size=FLUSH_SIZE, window=FLUSH_WINDOW, ack_timeout=ACK_TIMEOUT):
+        self.mqtt = mqtt
+        self.size = size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self._messages = []   # (topic, JSON payload)
+        self._started_at = None
+        self._lock = threading.Lock()
+        self._stats = {'published': 0, 'bytes': 0, 'flushes': 0, 'failed_flushes': 0, 'last_flush_ms': None}
+
+    @property
+    def pending(self):
+        return bool(self._messages)
+
+    def publish(self, topic, message):
+        """Queue a message. It is sent as compact JSON, leaving out None values."""
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        payload = json.dumps({key: value for key, value in message.items() if value is not None},
+                             separators=(',', ':'), default=str)
+        self._messages.append((topic, payload))
+
+    def remaining(self):
+        """Seconds until the batch window closes."""
+        if self._started_at is None:
+            return self.window
+        return max(0, self._started_at + self.window - time.monotonic())
+
+    def due(self):
+        return self.pending and (len(self._messages) >= self.size or self.remaining() == 0)
+
+    def flush(self):
+        """Publish everything queued and wait for the acknowledgements. Raises
+        if the client is offline or the broker doesn't acknowledge them all in
+        time; QoS 1 may deliver twice anyway, so receivers dedupe."""
+        messages = self._messages
+        self._messages, self._started_at = [], None
+        if not messages:
+            return 0
+
+        started = time.monotonic()
+        acked = []
+        done = threading.Condition()
+
+        def on_ack(mid):
+            with done:
+                acked.append(mid)
+                done.notify()
+
+        try:
+            if not self.mqtt.connect():
+                raise ConnectionError("Not connected to AWS IoT Core")
+            for topic, payload in messages:
+                self.mqtt.publish_async(topic, payload, on_ack)
+            with done:
+                if not done.wait_for(lambda: len(acked) >= len(messages), self.ack_timeout):
+                    raise TimeoutError(f"Broker acknowledged {len(acked)} of {len(messages)} messages")
+        except Exception:
+            with self._lock:
+                self._stats['failed_flushes'] += 1
+            raise
+
+        with self._lock:
+            self._stats['published'] += len(messages)
+            self._stats['bytes'] += sum(len(payload) for _, payload in messages)
+            self._stats['flushes'] += 1
+            self._stats['last_flush_ms'] = round((time.monotonic() - started) * 1000, 1)
+        if len(messages) > 1:
+            logger.debug(f"Published {len(messages)} MQTT messages in {self._stats['last_flush_ms']} ms")
+        return len(messages)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, connected=self.mqtt.connected, staged=len(self._messages))
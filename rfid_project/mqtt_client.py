@@ -1,17 +1,23 @@
+import os
 import json
 import time
 import logging
 from datetime import datetime
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+from cart_state import CART_ID
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class SmartCartMQTT:
-    def __init__(self):
+    def __init__(self, client_id=None):
         self.endpoint = "a2amimoaybc420-ats.iot.us-east-1.amazonaws.com"
-        self.client_id = "basicPubSub"  # or "smart-convenience-store-cart-001"
+        # IoT Core drops the older connection when a second client connects
+        # with the same id, so every cart needs its own. The device policy
+        # only lets iot-convenience-store-*-production ids connect
+        self.client_id = (client_id or os.environ.get('CART_MQTT_CLIENT_ID')
+                          or f"iot-convenience-store-{CART_ID}-production")
         self.thing_name = "iot-convenience-store-door-001-production"
         
         # Updated certificate paths to match your files
@@ -19,15 +25,21 @@ class SmartCartMQTT:
         self.certificate = "./iot-convenience-store-door-001-production.cert.pem"
         self.private_key = "./iot-convenience-store-door-001-production.private.key"
         
-        # MQTT topic
+        # MQTT topics; the IoT rule sends checkout messages to the session processor
         self.session_topic = f"store/cart/{self.thing_name}/session/complete"
+        self.checkout_topic = f"store/cart/{self.thing_name}/checkout"
         
         # MQTT client
         self.mqtt_client = None
         self.connected = False
     
+    def has_credentials(self):
+        return all(os.path.exists(path) for path in (self.root_ca, self.certificate, self.private_key))
+    
     def connect(self):
-        """Connect to AWS IoT Core"""
+        """Connect to AWS IoT Core (a no-op once connected; the client reconnects by itself)"""
+        if self.connected:
+            return True
         try:
             logger.info("🔌 Connecting to AWS IoT Core...")
             
@@ -38,7 +50,9 @@ class SmartCartMQTT:
             
             # Configure connection
             self.mqtt_client.configureAutoReconnectBackoffTime(1, 32, 20)
-            self.mqtt_client.configureOfflinePublishQueueing(-1)
+            # No in-memory queue while offline: publishing fails instead, and
+            # callers that must not lose messages keep them on disk
+            self.mqtt_client.configureOfflinePublishQueueing(0)
             self.mqtt_client.configureDrainingFrequency(2)
             self.mqtt_client.configureConnectDisconnectTimeout(10)
             self.mqtt_client.configureMQTTOperationTimeout(5)
@@ -56,6 +70,14 @@ class SmartCartMQTT:
             logger.error(f"❌ Connection error: {str(e)}")
             return False
     
+    def session_complete_message(self, session_data):
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "event_type": "session_complete",
+            "cart_id": self.thing_name,
+            **session_data
+        }
+    
     def publish_session_complete(self, session_data):
         """Publish session completion data"""
         if not self.connected:
@@ -63,13 +85,7 @@ class SmartCartMQTT:
             return False
             
         try:
-            # Add timestamp
-            message = {
-                "timestamp": datetime.now().isoformat(),
-                "event_type": "session_complete",
-                "cart_id": self.thing_name,
-                **session_data
-            }
+            message = self.session_complete_message(session_data)
             
             # Publish message
             self.mqtt_client.publish(self.session_topic, json.dumps(message), 1)
@@ -80,6 +96,10 @@ class SmartCartMQTT:
             logger.error(f"❌ Publish error: {str(e)}")
             return False
     
+    def publish_async(self, topic, payload, ack_callback):
+        """Publish with QoS 1 without waiting; ack_callback(mid) runs on the broker's PUBACK."""
+        return self.mqtt_client.publishAsync(topic, payload, 1, ackCallback=ack_callback)
+    
     def disconnect(self):
         """Disconnect from AWS IoT Core"""
         if self.mqtt_client and self.connected:
@@ -0,0 +1,139 @@
+import threading
+import time
+import logging
+from collections import namedtuple
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
+
+# expected_weight is the cloud catalogue's weight_per_unit in grams, when known
+Product = namedtuple('Product', ['id', 'name', 'price', 'is_grocery', 'expected_weight'])
+
+def _price(value):
+    # One type for prices whether they come from MySQL, DynamoDB or a tag
+    return Decimal(str(value)).quantize(Decimal('0.01'))
+
+class ProductCatalog:
+    """In-memory copy of product_data, keyed by id, by (name, price) and by RFID tag.
+
+    Loaded once at startup and kept current by the process that changes a
+    product: the serial handler's scan events carry the product they resolved
+    to, and the web app sends the serial handler products it edits. A lookup
+    miss is not an error - callers fall back to the database.
+    """
+
+    def __init__(self):
+        self._by_id = {}
+        self._by_key = {}
+        self._by_tag = {}
+        self._cloud_by_tag = {}   # product_rfid -> DynamoDB product item
+        self._cloud_by_name = {}
+        self._cloud_by_id = {}
+        self._lock = threading.Lock()
+        self.loaded_at = None
+
+    def load(self, cursor, products_table=None):
+        """Replace the catalogue from product_data, plus the DynamoDB products
+        table when one is given (for expected weights). Takes a tuple cursor."""
+        cursor.execute("SELECT id, product_name, price, is_grocery FROM product_data")
+        rows = cursor.fetchall()
+        # The product each physical tag was last read as
+        cursor.execute("""
+            SELECT tag_id, product_id FROM scanned_items
+            WHERE product_id IS NOT NULL
+            ORDER BY id
+        """)
+        tags = cursor.fetchall()
+
+        cloud = self._load_cloud(products_table)
+
+        with self._lock:
+            if cloud is not None:
+                self._cloud_by_tag, self._cloud_by_name, self._cloud_by_id = cloud
+            by_id = {}
+            for product_id, name, price, is_grocery in rows:
+                by_id[product_id] = Product(product_id, name, _price(price), bool(is_grocery),
+                                            self._expected_weight(None, name))
+            self._by_id = by_id
+            self._by_key = {(p.name, p.price): p for p in by_id.values()}
+            self._by_tag = {tag_id: by_id[product_id] for tag_id, product_id in tags if product_id in by_id}
+            self.loaded_at = time.time()
+
+        logger.info(f"Product catalogue loaded: {len(rows)} products, {len(self._by_tag)} tags")
+
+    def get(self, product_id):
+        with self._lock:
+            return self._by_id.get(product_id)
+
+    def find(self, name, price):
+        with self._lock:
+            return self._by_key.get((name, _price(price)))
+
+    def for_tag(self, tag_id):
+        with self._lock:
+            return self._by_tag.get(tag_id)
+
+    def put(self, product_id, product_name, price, is_grocery, tag_id=None):
+        """Add or update one product (and remember which tag carried it)."""
+        with self._lock:
+            old = self._by_id.get(product_id)
+            if old is not None:
+                self._by_key.pop((old.name, old.price), None)
+            product = Product(product_id, product_name, _price(price), bool(is_grocery),
+                              self._expected_weight(tag_id, product_name))
+            self._by_id[product_id] = product
+            self._by_key[(product.name, product.price)] = product
+            if tag_id is not None:
+                self._by_tag[tag_id] = product
+        return product
+
+    def cloud_product_name(self, cloud_product_id):
+        """Name of a DynamoDB product, for records that only carry its product_id."""
+        with self._lock:
+            item = self._cloud_by_id.get(cloud_product_id)
+        return item.get('product_name') if item else None
+
+    def forget_tags(self):
+        """Drop the tag map after a tag has been rewritten; which tag it was isn't known."""
+        with self._lock:
+            self._by_tag.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'products': len(self._by_id),
+                'tags': len(self._by_tag),
+                'cloud_products': len(self._cloud_by_tag),
+                'loaded_at': self.loaded_at
+            }
+
+    def _expected_weight(self, tag_id, name):
+        item = self._cloud_by_tag.get(tag_id) if tag_id else None
+        if item is None:
+            item = self._cloud_by_name.get(name)
+        if item is None or not item.get('weight_per_unit'):
+            return None
+        return float(item['weight_per_unit'])
+
+    def _load_cloud(self, products_table):
+        if products_table is None:
+            return None
+        by_tag, by_name, by_id = {}, {}, {}
+        try:
+            kwargs = {}
+            while True:
+                response = products_table.scan(**kwargs)
+                for item in response.get('Items', []):
+                    if item.get('product_rfid'):
+                        by_tag[item['product_rfid']] = item
+                    if item.get('product_name'):
+                        by_name[item['product_name']] = item
+                    if item.get('product_id'):
+                        by_id[item['product_id']] = item
+                if 'LastEvaluatedKey' not in response:
+                    break
+                kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        except Exception as e:
+            logger.warning(f"Could not load cloud products, keeping the previous copy: {e}")
+            return None
+        return by_tag, by_name, by_id
@@ -1,11 +1,22 @@
 import serial
+import os
 import time
 import mysql.connector
 import json
+import queue
+import threading
+import statistics
+from collections import deque, namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from datetime import datetime
 import logging
+from command_bus import CommandBusServer
+from migrations import migrate
+from product_catalog import ProductCatalog
+from serial_protocol import FrameParser, encode_command, negotiate
 
 CONTROL_COMMANDS = {'BUZZER', 'LED', 'OPEN_LID', 'CLOSE_LID'}
+DEVICELESS_COMMANDS = {'product_changed'}  # run even when no Arduino is attached
 
 # Set up logging
 logging.basicConfig(
@@ -26,172 +37,604 @@ DB_CONFIG = {
 }
 
 # Serial configuration
-SERIAL_PORT = '/dev/ttyACM0'
+SERIAL_PORT = '/dev/ttyACM0'   # the main cart; commands that don't name a device go here
+SERIAL_PORTS = (SERIAL_PORT,)  # the cart Arduinos on this Pi. Only these are opened: opening a
+                               # port resets the board, so never list the door Arduino (/dev/ttyUSB0)
+DISCOVERY_INTERVAL = 10.0      # seconds between checks for configured ports that (re)appeared
 BAUD_RATE = 9600
+SERIAL_PROTOCOL = 'text'       # 'binary' negotiates framed mode at connect (falls back to text)
+BINARY_BAUD_RATE = 115200      # baud rate both sides switch to in framed mode
+SERIAL_READ_SIZE = 256         # most bytes read at once in framed mode
+
+# Event loop configuration
+COMMAND_POLL_INTERVAL = 30.0   # seconds between checks of the fallback commands table, which
+                               # only holds commands the web app persisted while the bus was down
+RESPONSE_TIMEOUT = 5.0         # default seconds to wait for a command's DATA:/OK:/ERR:
+COMMAND_RESPONSE_TIMEOUT = 1.0 # seconds to wait for OK:/ERR: after a direct command
+TAG_WRITE_TIMEOUT = 12.0       # WRITE/RESET wait up to 10 s on the Arduino for a card
+CONTROL_MODE_TIMEOUT = 30      # seconds a control read flag stays armed
+WRITE_BATCH_WINDOW = 0.02      # seconds of events grouped into one transaction
+WRITE_BATCH_SIZE = 50          # events that close a batch before the window ends
+
+# Load cell filtering
+WEIGHT_MEDIAN_WINDOW = 3       # raw samples in the moving median (rejects single spikes)
+WEIGHT_SETTLE_SAMPLES = 3      # consecutive medians that must agree before a weight is stable
+WEIGHT_SETTLE_TOLERANCE = 2.0  # grams those medians may spread
+WEIGHT_CHANGE_THRESHOLD = 5.0  # grams a stable weight must move before it is reported again
+TARE_DRIFT_BAND = 5.0          # settled readings this close to zero are the empty scale drifting
+TARE_DRIFT_RATE = 0.1          # how quickly the zero offset follows that drift
+RAW_WEIGHT_SAMPLES = 500       # raw readings kept for debugging
+MIN_ITEM_WEIGHT = 10.0         # grams; lighter stable weights are never assigned to an item
+
+# A single parsed line from an Arduino, tagged with the port it came from.
+# kind is one of CARD, DATA, FRAUD, WEIGHT, OK, ERR, INFO, ATTACHED or
+# DISCONNECTED, plus COMMAND for commands arriving over the command bus.
+SerialEvent = namedtuple('SerialEvent', ['kind', 'payload', 'raw', 'received_at', 'device'], defaults=(None,))
+
+# Event kinds that can answer a command sent to the Arduino
+RESPONSE_KINDS = {'DATA', 'OK', 'ERR'}
+
+# Commands that wait seconds on an Arduino response; like card scans they run
+# on the device's worker thread instead of the main loop
+BLOCKING_COMMANDS = CONTROL_COMMANDS | {'write_tag', 'reset_tag', 'READC'}
+
+# Products by id, name/price and tag - loaded in main(), kept current as tags are read
+product_catalog = ProductCatalog()
 
 def connect_to_database():
-    """Connect to the MySQL database and return the connection."""
+    """Connect to the MySQL database, bring its schema up to date and return the connection."""
     try:
         conn = mysql.connector.connect(**DB_CONFIG)
         logging.info("Successfully connected to the database")
+        logging.info(f"Database schema at version {migrate(conn)}")
         return conn
     except mysql.connector.Error as err:
         logging.error(f"Database connection error: {err}")
         exit(1)
 
-def connect_to_arduino():
-    """Connect to the Arduino via serial port and return the connection."""
-    try:
-        ser = serial.Serial(SERIAL_PORT, BAUD_RATE, timeout=1)
-        logging.info(f"Connected to Arduino on {SERIAL_PORT}")
-        time.sleep(2)  # Allow time for Arduino to reset
-        return ser
-    except serial.SerialException as err:
-        logging.error(f"Serial connection error: {err}")
-        exit(1)
+def parse_serial_line(line, device=None):
+    """Parse one line from the Arduino into a SerialEvent."""
+    received_at = time.time()
+    
+    if line.startswith("CARD:"):
+        return SerialEvent('CARD', line[5:].strip(), line, received_at, device)
+    if line.startswith("DATA:"):
+        return SerialEvent('DATA', line[5:].strip(), line, received_at, device)
+    if line.startswith("FRAUD:"):
+        return SerialEvent('FRAUD', line[6:].strip(), line, received_at, device)
+    if line.startswith("OK:"):
+        return SerialEvent('OK', line[3:].strip(), line, received_at, device)
+    if line.startswith("ERR:"):
+        return SerialEvent('ERR', line[4:].strip(), line, received_at, device)
+    if line.startswith("Weight:"):
+        try:
+            weight = float(line.split(':', 1)[1].strip())
+            return SerialEvent('WEIGHT', weight, line, received_at, device)
+        except ValueError as e:
+            logging.error(f"Invalid weight format: {e}")
+    
+    # Chatter such as "Place your card..." or an unparsable weight
+    return SerialEvent('INFO', line, line, received_at, device)
 
-def process_card_scan(cursor, tag_id, serial_conn):
-    """Process a card scan event and update the database."""
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+class CommandChannel:
+    """Sends commands to the Arduino and matches its responses to them.
     
-    # Check if we're in control mode
-    cursor.execute(
-        "SELECT id FROM commands WHERE command_type = '_control_read_flag' AND status = 'pending' LIMIT 1"
-    )
-    control_flag = cursor.fetchone()
+    Every command that expects an answer gets a Future. The reader thread hands
+    each DATA:/OK:/ERR: line to resolve(), which completes the oldest pending
+    command waiting for that kind of line. The Arduino answers in order, so
+    several commands can be in flight at once.
+    """
     
-    if control_flag:
-        # We're in control mode - handle differently
-        logging.info(f"Processing card scan in CONTROL MODE for tag ID: {tag_id}")
-        
-        # Mark the control flag as complete
-        cursor.execute(
-            "UPDATE commands SET status = 'complete' WHERE id = %s",
-            (control_flag[0],)
-        )
+    def __init__(self, serial_conn, response_timeout=RESPONSE_TIMEOUT, binary=False):
+        self.serial_conn = serial_conn
+        self.response_timeout = response_timeout
+        self.binary = binary
+        self._pending = deque()
+        self._lock = threading.Lock()
+    
+    def send(self, command, expect=()):
+        """Write a command; return a Future for the response if expect is given."""
+        future = None
+        if expect:
+            future = Future()
+            with self._lock:
+                self._pending.append((command, frozenset(expect), future))
+        self.serial_conn.write(encode_command(command) if self.binary else f"{command}\n".encode())
+        return future
+    
+    def request(self, command, expect, timeout=None):
+        """Send a command and wait for its response event, or None on timeout."""
+        future = self.send(command, expect)
+        try:
+            return future.result(timeout=timeout or self.response_timeout)
+        except FutureTimeoutError:
+            self._discard(future)
+            logging.warning(f"Timed out waiting for response to {command}")
+            return None
+    
+    def resolve(self, event):
+        """Complete the oldest pending command that expects this event.
         
-        # Send READ command to Arduino directly
-        logging.info("Sending READ command to Arduino (control mode)")
-        serial_conn.write(b"READ\n")
-        
-        # Wait for Arduino to respond with DATA:
-        max_attempts = 10
-        data_received = False
-        
-        for _ in range(max_attempts):
-            time.sleep(0.5)
-            if serial_conn.in_waiting > 0:
-                response = serial_conn.readline().decode('utf-8').strip()
-                logging.info(f"Received from Arduino (control mode): {response}")
-                
-                if response.startswith("DATA:"):
-                    data = response[5:].strip()
-                    
-                    # Store result in control_results table without normal processing
-                    try:
-                        cursor.execute("""
-                            CREATE TABLE IF NOT EXISTS control_results (
-                                id INT AUTO_INCREMENT PRIMARY KEY,
-                                tag_id VARCHAR(100),
-                                data TEXT,
-                                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                            )
-                        """)
-                        cursor.execute(
-                            "INSERT INTO control_results (tag_id, data) VALUES (%s, %s)",
-                            (tag_id, data)
-                        )
-                        logging.info(f"Stored control read result: {data}")
-                    except Exception as e:
-                        logging.error(f"Error storing control result: {e}")
-                    
-                    data_received = True
+        Returns False when no command was waiting for it.
+        """
+        with self._lock:
+            for entry in self._pending:
+                if event.kind in entry[1]:
+                    self._pending.remove(entry)
+                    entry[2].set_result(event)
+                    return True
+        return False
+    
+    def fail_all(self, reason):
+        """Fail every pending command, e.g. when the port goes away."""
+        with self._lock:
+            while self._pending:
+                command, _, future = self._pending.popleft()
+                future.set_exception(serial.SerialException(f"{command}: {reason}"))
+    
+    def _discard(self, future):
+        with self._lock:
+            for entry in self._pending:
+                if entry[2] is future:
+                    self._pending.remove(entry)
                     break
-                
-                # If Arduino says "Place your card..." keep waiting
-                if response == "Place your card...":
-                    continue
-                
-                # If we get an error, log it
-                if response.startswith("ERR:"):
-                    logging.error(f"Arduino error in control mode: {response}")
+
+class SerialReader(threading.Thread):
+    """Blocks on the serial port and routes every parsed line or frame.
+    
+    Responses to pending commands complete their futures; everything else is
+    pushed onto the event queue for the main loop. With a FrameParser the port
+    is read in chunks and decoded as binary frames instead of lines.
+    """
+    
+    def __init__(self, serial_conn, events, channel, parser=None, device=None):
+        super().__init__(name=f"serial-reader {device}", daemon=True)
+        self.serial_conn = serial_conn
+        self.events = events
+        self.channel = channel
+        self.parser = parser
+        self.device = device
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                if self.parser is not None:
+                    # read() blocks until a byte arrives or the port timeout expires
+                    data = self.serial_conn.read(min(max(self.serial_conn.in_waiting, 1), SERIAL_READ_SIZE))
+                else:
+                    # readline() blocks until a full line arrives or the port timeout expires
+                    raw = self.serial_conn.readline()
+            except (serial.SerialException, OSError) as e:
+                if not self._stop_event.is_set():
+                    logging.error(f"Serial read error: {e}")
+                    self.channel.fail_all(str(e))
+                    self.events.put(SerialEvent('DISCONNECTED', str(e), '', time.time(), self.device))
+                return
+            
+            if self.parser is not None:
+                received_at = time.time()
+                for kind, payload, line in self.parser.feed(data):
+                    logging.info(f"Received from Arduino on {self.device}: {line}")
+                    self.route(SerialEvent(kind, payload, line, received_at, self.device))
+                continue
+            
+            line = raw.decode('utf-8', errors='replace').strip()
+            if not line:
+                continue
+            
+            logging.info(f"Received from Arduino on {self.device}: {line}")
+            self.route(parse_serial_line(line, self.device))
+    
+    def route(self, event):
+        if event.kind in RESPONSE_KINDS and self.channel.resolve(event):
+            return
+        self.events.put(event)
+    
+    def stop(self):
+        self._stop_event.set()
+
+class DeviceWorker(threading.Thread):
+    """Runs one device's blocking work - card scans and commands that wait on
+    the Arduino - in order, on its own thread.
+    
+    A READ waits up to RESPONSE_TIMEOUT and a WRITE up to TAG_WRITE_TIMEOUT;
+    on the main loop that would stall every other cart, the command bus and
+    the write batch. The worker has its own database connection and commits
+    after each job, then publishes the job's notification.
+    """
+    
+    def __init__(self, name, publish):
+        super().__init__(name=f"device-worker {name}", daemon=True)
+        self.device_name = name
+        self.publish = publish
+        self._jobs = queue.Queue()
+        self._db_conn = None
+    
+    def submit(self, job, on_error=None):
+        """Queue job(cursor), which returns a notification or None.
+        on_error(exc) is called if the job could not run or commit."""
+        self._jobs.put((job, on_error))
+    
+    def run(self):
+        while True:
+            entry = self._jobs.get()
+            if entry is None:
+                break
+            job, on_error = entry
+            notification = None
+            try:
+                if self._db_conn is None or not self._db_conn.is_connected():
+                    self._db_conn = mysql.connector.connect(**DB_CONFIG)
+                cursor = self._db_conn.cursor()
+                try:
+                    notification = job(cursor)
+                    self._db_conn.commit()
+                finally:
+                    cursor.close()
+            except Exception as e:
+                logging.error(f"Error on the worker for {self.device_name}: {e}")
+                logging.exception("Exception details:")
+                notification = None
+                try:
+                    self._db_conn.rollback()
+                except Exception:
+                    pass
+                if on_error is not None:
+                    on_error(e)
+            
+            # Only push after the commit so the web app can already see the rows
+            if notification:
+                notification[1]['device'] = self.device_name
+                self.publish(*notification)
+        
+        if self._db_conn is not None:
+            self._db_conn.close()
+    
+    def stop(self):
+        self._jobs.put(None)
+
+class Device:
+    """One Arduino: its port, command channel, reader thread, worker and cart state."""
+    
+    def __init__(self, name, serial_conn, channel, reader):
+        self.name = name
+        self.serial_conn = serial_conn
+        self.channel = channel
+        self.reader = reader
+        self.worker = None
+        self.control = ControlMode()
+        self.scale = WeightFilter()
+    
+    def start_worker(self, publish):
+        self.worker = DeviceWorker(self.name, publish)
+        self.worker.start()
+    
+    def close(self):
+        self.reader.stop()
+        self.channel.fail_all("device closed")
+        if self.worker is not None:
+            self.worker.stop()
+        try:
+            if self.serial_conn.is_open:
+                self.serial_conn.close()
+        except (serial.SerialException, OSError):
+            pass
+
+class DeviceSupervisor(threading.Thread):
+    """Connects the configured cart Arduinos as their ports appear.
+    
+    Opening a port waits for the Arduino to reset and for protocol
+    negotiation, so it happens on this thread. A connected device is handed to
+    the main loop as an ATTACHED event, and its own SerialReader then feeds the
+    same event queue, so every cart shares the main loop's database
+    connection and write batch for non-blocking events. The ports are checked
+    every DISCOVERY_INTERVAL seconds, which also reconnects a cart that was
+    unplugged.
+    """
+    
+    def __init__(self, events, ports=SERIAL_PORTS, interval=DISCOVERY_INTERVAL):
+        super().__init__(name="device-supervisor", daemon=True)
+        self.events = events
+        self.ports = ports
+        self.interval = interval
+        self._attached = set()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+    
+    def run(self):
+        while not self._stop_event.is_set():
+            for port in self.discover():
+                if self._stop_event.is_set():
                     break
+                self.attach(port)
+            self._stop_event.wait(self.interval)
+    
+    def discover(self):
+        """Configured ports that are present and have no device yet."""
+        with self._lock:
+            return [port for port in self.ports if port not in self._attached and os.path.exists(port)]
+    
+    def attach(self, port):
+        try:
+            # exclusive: fail instead of sharing a port another process has open
+            serial_conn = serial.Serial(port, BAUD_RATE, timeout=1, exclusive=True)
+        except (serial.SerialException, OSError) as err:
+            logging.error(f"Serial connection error on {port}: {err}")
+            return
         
-        if not data_received:
-            logging.warning(f"Failed to get product data for tag {tag_id} in control mode")
+        try:
+            time.sleep(2)  # Allow time for Arduino to reset
+            # Switch to framed binary mode if configured and the firmware supports it
+            binary, early_lines = False, []
+            if SERIAL_PROTOCOL == 'binary':
+                binary, early_lines = negotiate(serial_conn, BINARY_BAUD_RATE)
+        except (serial.SerialException, OSError) as err:
+            logging.error(f"Serial connection error on {port}: {err}")
+            serial_conn.close()
+            return
         
-        # Exit early - don't proceed with normal cart flow
+        channel = CommandChannel(serial_conn, binary=binary)
+        reader = SerialReader(serial_conn, self.events, channel, FrameParser() if binary else None, port)
+        with self._lock:
+            self._attached.add(port)
+        self.events.put(SerialEvent('ATTACHED', Device(port, serial_conn, channel, reader), '', time.time(), port))
+        # Lines that arrived while negotiating are handled like any other
+        for line in early_lines:
+            self.events.put(parse_serial_line(line, port))
+        reader.start()
+        logging.info(f"Connected to Arduino on {port}")
+    
+    def detach(self, port):
+        """Forget a port that went away so the next scan reconnects it."""
+        with self._lock:
+            self._attached.discard(port)
+    
+    def stop(self):
+        self._stop_event.set()
+
+def select_device(devices, name=None):
+    """The device a command is for: the named one, else SERIAL_PORT, else the only one attached."""
+    if name:
+        return devices.get(name)
+    if SERIAL_PORT in devices:
+        return devices[SERIAL_PORT]
+    if len(devices) == 1:
+        return next(iter(devices.values()))
+    return None
+
+class ControlMode:
+    """Tracks whether the next card scan belongs to the control page."""
+    
+    def __init__(self, timeout=CONTROL_MODE_TIMEOUT):
+        self.timeout = timeout
+        self.expires_at = None
+    
+    def activate(self):
+        self.expires_at = time.time() + self.timeout
+        logging.info("★★★ Control mode ACTIVATED for next RFID read ★★★")
+    
+    def deactivate(self, reason):
+        self.expires_at = None
+        logging.info(f"Control mode DEACTIVATED {reason}")
+    
+    @property
+    def active(self):
+        if self.expires_at is not None and time.time() > self.expires_at:
+            self.deactivate("due to timeout")
+        return self.expires_at is not None
+
+class WeightFilter:
+    """Turns the noisy load cell stream into stable weight readings.
+    
+    Raw samples go through a moving median; a weight is stable once several
+    consecutive medians agree. While the empty scale drifts around zero the
+    drift is tracked and subtracted. add() only returns a weight when a new
+    stable value is reached, so a resting item produces a single reading.
+    """
+    
+    def __init__(self):
+        self.raw = deque(maxlen=RAW_WEIGHT_SAMPLES)  # (received_at, grams)
+        self._window = deque(maxlen=WEIGHT_MEDIAN_WINDOW)
+        self._medians = deque(maxlen=WEIGHT_SETTLE_SAMPLES)
+        self.zero_offset = 0.0
+        self.last_stable = None
+    
+    def add(self, weight, received_at):
+        """Feed one raw sample; returns the new stable net weight or None."""
+        self.raw.append((received_at, weight))
+        self._window.append(weight)
+        self._medians.append(statistics.median(self._window))
+        
+        if len(self._medians) < WEIGHT_SETTLE_SAMPLES:
+            return None
+        if max(self._medians) - min(self._medians) > WEIGHT_SETTLE_TOLERANCE:
+            return None
+        
+        settled = statistics.median(self._medians)
+        if abs(settled) <= TARE_DRIFT_BAND:
+            # Nothing on the scale - follow the zero point as it drifts
+            self.zero_offset += TARE_DRIFT_RATE * (settled - self.zero_offset)
+        
+        net = round(settled - self.zero_offset, 1)
+        if self.last_stable is not None and abs(net - self.last_stable) < WEIGHT_CHANGE_THRESHOLD:
+            return None
+        
+        self.last_stable = net
+        logging.debug(f"Stable weight {net}g from samples {[w for _, w in list(self.raw)[-WEIGHT_MEDIAN_WINDOW:]]}")
+        return net
+    
+    def report_next(self):
+        """Report the next stable weight even if it has not changed (a weigh request)."""
+        self.last_stable = None
+    
+    def reset(self):
+        """Forget filter state after the scale has been tared."""
+        self._window.clear()
+        self._medians.clear()
+        self.zero_offset = 0.0
+        self.last_stable = None
+
+class WriteBatch:
+    """Groups the database work of consecutive events into one transaction.
+    
+    Statements whose results are needed straight away (lastrowid, SELECTs)
+    still run immediately inside the open transaction. Append-only rows are
+    deferred and written with one executemany per statement. flush() commits
+    once for the whole batch and only then hands back the notifications, so
+    the web app is never told about rows that could still be rolled back.
+    """
+    
+    def __init__(self, window=WRITE_BATCH_WINDOW, size=WRITE_BATCH_SIZE):
+        self.window = window
+        self.size = size
+        self._rows = {}
+        self._notifications = []
+        self._events = 0
+        self._started_at = None
+    
+    @property
+    def pending(self):
+        return self._events > 0
+    
+    def defer(self, sql, params):
+        self._rows.setdefault(sql, []).append(params)
+    
+    def add(self, notification):
+        """Count one handled event and keep its notification until the commit."""
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+        self._events += 1
+        if notification:
+            self._notifications.append(notification)
+    
+    def remaining(self):
+        """Seconds until the batch window closes."""
+        if self._started_at is None:
+            return self.window
+        return max(0, self._started_at + self.window - time.monotonic())
+    
+    def due(self):
+        return self.pending and (self._events >= self.size or self.remaining() == 0)
+    
+    def flush(self, db_conn, cursor):
+        """Write deferred rows and commit. Returns the notifications to publish."""
+        rows, notifications, events = self._rows, self._notifications, self._events
+        self._rows, self._notifications, self._events, self._started_at = {}, [], 0, None
+        
+        try:
+            for sql, params in rows.items():
+                cursor.executemany(sql, params)
+            db_conn.commit()
+        except mysql.connector.Error as err:
+            logging.error(f"Failed to commit batch of {events} events: {err}")
+            try:
+                db_conn.rollback()
+            except mysql.connector.Error:
+                pass
+            return []
+        
+        if events > 1:
+            logging.debug(f"Committed batch of {events} events")
+        return notifications
+
+def store_control_result(cursor, tag_id, data):
+    """Store a tag read for the control page in control_results."""
+    try:
+        cursor.execute(
+            "INSERT INTO control_results (tag_id, data) VALUES (%s, %s)",
+            (tag_id, data)
+        )
+        return True
+    except Exception as e:
+        logging.error(f"Error storing control result: {e}")
+        return False
+
+def process_control_scan(cursor, tag_id, channel):
+    """Read a card for the control page without touching the cart."""
+    logging.info(f"★★★ Processing CONTROL RFID scan for tag: {tag_id} ★★★")
+    
+    # Direct READ command for control mode
+    logging.info("Sent READ command for control mode")
+    response = channel.request("READ", ('DATA', 'ERR'))
+    
+    if response is None or response.kind == 'ERR':
+        logging.warning(f"Failed to get product data for tag {tag_id} in control mode")
         return
     
-    # REGULAR MODE - Normal card scan processing begins here
+    # Store in control_results table only
+    if store_control_result(cursor, tag_id, response.payload):
+        logging.info(f"✓✓✓ Stored control read result: {response.payload}")
+
+def process_card_scan(cursor, tag_id, channel, device=None):
+    """Process a card scan event from a device and update the database.
+    
+    Returns the scanned item in the shape /get_recent_scan uses, or None.
+    """
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
     logging.info(f"Processing card scan with tag ID: {tag_id} (regular mode)")
     
-    # First, store the scanned tag in the database
+    # Immediately send READ command to Arduino and wait for its DATA: (or ERR:),
+    # before this scan writes anything, so no transaction is open meanwhile
+    logging.info("Sending READ command to Arduino")
+    response = channel.request("READ", ('DATA', 'ERR'))
+    
+    # A scan without product data would sit in the cart as an unknown item
+    if response is None:
+        logging.warning(f"Failed to get product data for tag {tag_id}, scan not recorded")
+        return None
+    
+    if response.kind == 'ERR':
+        logging.error(f"Arduino error: {response.raw}, scan not recorded")
+        return None
+    
+    if response.payload == "NoData#0":
+        logging.info(f"No data stored on RFID tag {tag_id}, scan not recorded")
+        store_control_result(cursor, tag_id, response.payload)
+        return None
+    
+    # Then store the scanned tag in the database
     cursor.execute(
-        "INSERT INTO scanned_items (tag_id, timestamp, product_id, is_validated) VALUES (%s, %s, %s, %s)",
-        (tag_id, timestamp, None, False)
+        "INSERT INTO scanned_items (tag_id, timestamp, product_id, is_validated, device) VALUES (%s, %s, %s, %s, %s)",
+        (tag_id, timestamp, None, False, device)
     )
     
     # Get the ID of the inserted record
     scanned_item_id = cursor.lastrowid
     
-    # Immediately send READ command to Arduino
-    logging.info("Sending READ command to Arduino")
-    serial_conn.write(b"READ\n")
+    data = response.payload
+    product = process_tag_data(cursor, data, scanned_item_id, tag_id)
     
-    # Wait for Arduino to respond with DATA:
-    max_attempts = 10
-    data_received = False
+    # Also store this data in control_results for the control page
+    store_control_result(cursor, tag_id, data)
     
-    for _ in range(max_attempts):
-        time.sleep(0.5)
-        if serial_conn.in_waiting > 0:
-            response = serial_conn.readline().decode('utf-8').strip()
-            logging.info(f"Received from Arduino: {response}")
-            
-            if response.startswith("DATA:"):
-                data = response[5:].strip()
-                process_tag_data(cursor, data, scanned_item_id, tag_id)
-                
-                # Also store this data in control_results for the control page
-                try:
-                    cursor.execute("""
-                        CREATE TABLE IF NOT EXISTS control_results (
-                            id INT AUTO_INCREMENT PRIMARY KEY,
-                            tag_id VARCHAR(100),
-                            data TEXT,
-                            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                        )
-                    """)
-                    cursor.execute(
-                        "INSERT INTO control_results (tag_id, data) VALUES (%s, %s)",
-                        (tag_id, data)
-                    )
-                except Exception as e:
-                    logging.error(f"Error storing control result: {e}")
-                
-                data_received = True
-                break
-            
-            # If Arduino says "Place your card..." keep waiting
-            if response == "Place your card...":
-                continue
-            
-            # If we get an error, log it
-            if response.startswith("ERR:"):
-                logging.error(f"Arduino error: {response}")
-                break
+    if product is None:
+        return None
     
-    if not data_received:
-        logging.warning(f"Failed to get product data for tag {tag_id}")
+    return {
+        'id': scanned_item_id,
+        'tag_id': tag_id,
+        'timestamp': timestamp,
+        'weight': None,
+        'is_validated': False,
+        'product_id': product['product_id'],
+        'product_name': product['product_name'],
+        'price': product['price'],
+        'is_grocery': product['is_grocery'],
+        'expected_weight': product['expected_weight']
+    }
 
 def process_tag_data(cursor, data, scanned_item_id, tag_id):
-    """Process data read from RFID tag and update the database."""
+    """Process data read from RFID tag and update the database.
+    
+    Returns the product fields for the scan event, or None if the tag held no product.
+    """
     logging.info(f"Processing tag data: {data}")
     
     if data == "NoData#0":
         logging.info("No data stored on RFID tag")
-        return
+        return None
     
     try:
         # Parse the data - could be in format "product_name#price" or "product_name,price,is_grocery"
@@ -210,15 +653,19 @@ def process_tag_data(cursor, data, scanned_item_id, tag_id):
         
         logging.info(f"Parsed product data: {product_name}, ${price}, Grocery: {is_grocery}")
         
-        # Check if product exists in database
-        cursor.execute(
-            "SELECT id FROM product_data WHERE product_name = %s AND price = %s",
-            (product_name, price)
-        )
-        product_row = cursor.fetchone()
+        # Known products are a dictionary hit; the database is only asked on a miss
+        product = product_catalog.find(product_name, price)
+        if product:
+            product_row = (product.id, product.is_grocery)
+        else:
+            cursor.execute(
+                "SELECT id, is_grocery FROM product_data WHERE product_name = %s AND price = %s",
+                (product_name, price)
+            )
+            product_row = cursor.fetchone()
         
         if product_row:
-            product_id = product_row[0]
+            product_id, is_grocery = product_row
             logging.info(f"Found existing product: {product_name}, ID: {product_id}")
         else:
             # Insert the product into product_data
@@ -229,6 +676,8 @@ def process_tag_data(cursor, data, scanned_item_id, tag_id):
             product_id = cursor.lastrowid
             logging.info(f"Added new product: {product_name}, ID: {product_id}, Price: ${price}")
         
+        product = product_catalog.put(product_id, product_name, price, is_grocery, tag_id)
+        
         # Update the scanned item with the product_id
         cursor.execute(
             "UPDATE scanned_items SET product_id = %s WHERE id = %s",
@@ -236,16 +685,26 @@ def process_tag_data(cursor, data, scanned_item_id, tag_id):
         )
         logging.info(f"Updated scanned item {scanned_item_id} with product ID {product_id}")
         
-        # Add 'open_lid' command (simulating lid opening as in the original design)
-        cursor.execute(
-            "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-            ('open_lid', json.dumps({'product_id': product_id}), 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-        )
+        # The lid opening after a scan is simulated as in the original design;
+        # nothing is sent to the Arduino, so no command is queued for it
+        logging.info(f"Simulating open lid for product ID {product_id}")
+        
+        return {
+            'product_id': product_id,
+            'product_name': product_name,
+            'price': price,
+            'is_grocery': product.is_grocery,
+            'expected_weight': product.expected_weight
+        }
     except Exception as e:
         logging.error(f"Error processing RFID data: {e}")
         logging.exception("Exception details:")
+        return None
 def process_fraud_alert(cursor, reason):
-    """Log fraud detection events to the database."""
+    """Log fraud detection events to the database.
+    
+    Returns the logged fraud event, or None if it could not be stored.
+    """
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     
     # Map Arduino fraud messages to database ENUM values
@@ -275,57 +734,49 @@ def process_fraud_alert(cursor, reason):
         
         logging.warning(f"Fraud detected: {reason} -> mapped to event_type: {event_type}")
         
+        return {
+            'id': cursor.lastrowid,
+            'event_type': event_type,
+            'details': reason,
+            'timestamp': timestamp
+        }
     except Exception as e:
         logging.error(f"Error logging fraud event: {e}")
         logging.error(f"Attempted to insert event_type: '{event_type}', original reason: '{reason}'")
+        return None
 
-def process_weight_data(cursor, weight):
-    """Process weight data from load cell and update the database."""
+def process_weight_data(cursor, batch, weight, device=None):
+    """Record a stable weight from a device's load cell and update the database.
+    
+    Returns the weight event, including the scanned item the weight was assigned to.
+    """
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    reading = {'weight': weight, 'timestamp': timestamp, 'stable': True, 'item_id': None}
     
-    # Always record the weight in the weight_readings table (create if it doesn't exist)
-    try:
-        # Check if weight_readings table exists
-        cursor.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_schema = DATABASE() 
-            AND table_name = 'weight_readings'
-        """)
-        
-        table_exists = cursor.fetchone()[0] > 0
-        
-        if not table_exists:
-            # Create the table if it doesn't exist
-            cursor.execute("""
-                CREATE TABLE weight_readings (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    weight DECIMAL(10, 2) NOT NULL,
-                    timestamp DATETIME NOT NULL,
-                    processed BOOLEAN DEFAULT FALSE
-                )
-            """)
-            logging.info("Created weight_readings table")
-        
-        # Store the weight reading
-        cursor.execute(
-            "INSERT INTO weight_readings (weight, timestamp, processed) VALUES (%s, %s, %s)",
-            (weight, timestamp, False)
-        )
-        logging.info(f"Recorded weight reading: {weight}g")
-    except Exception as e:
-        logging.error(f"Error recording weight reading: {e}")
+    # Always record the weight in the weight_readings table; the row is
+    # written with the rest of the batch
+    batch.defer(
+        "INSERT INTO weight_readings (weight, timestamp, processed, device) VALUES (%s, %s, %s, %s)",
+        (weight, timestamp, False, device)
+    )
+    logging.info(f"Recorded weight reading: {weight}g")
     
-    # Try to find a grocery item that needs weighing (for the original RFID flow)
+    if weight < MIN_ITEM_WEIGHT:
+        # Scale is empty - nothing to weigh
+        return reading
+    
+    # Try to find a grocery item scanned on this cart that needs weighing
+    # (for the original RFID flow)
     try:
         cursor.execute("""
             SELECT s.id 
             FROM scanned_items s
             JOIN product_data p ON s.product_id = p.id
             WHERE s.weight IS NULL AND p.is_grocery = TRUE AND s.is_validated = FALSE
+            AND s.device <=> %s
             ORDER BY s.timestamp DESC 
             LIMIT 1
-        """)
+        """, (device,))
         item = cursor.fetchone()
         
         if item:
@@ -335,17 +786,165 @@ def process_weight_data(cursor, weight):
                 (weight, item_id)
             )
             logging.info(f"Updated weight for item ID {item_id}: {weight}g")
+            reading['item_id'] = item_id
         else:
             logging.info(f"Weight reading ({weight}g) stored in weight_readings table")
     except Exception as e:
         logging.error(f"Error processing weight for scanned items: {e}")
+    
+    return reading
 
-def check_commands(cursor, ser):
-    """Check for pending commands in the database and send them to Arduino."""
+def execute_command(cursor, device, cmd_type, params):
+    """Carry out one command from the web app on a device (None if none is attached).
+    
+    Returns the Arduino's response event, or None for commands that don't get one.
+    """
+    if device is None and cmd_type not in DEVICELESS_COMMANDS:
+        raise serial.SerialException(f"No Arduino attached for {cmd_type}")
+    channel, control, scale = (device.channel, device.control, device.scale) if device else (None, None, None)
+    
+    response = None
+    is_control = params.get('control_mode', False)
+    
+    logging.info(f"Processing command: {cmd_type}, control mode: {is_control}")
+    
+    # Handle special control commands with better logging
+    if cmd_type in CONTROL_COMMANDS:
+        # These are direct Arduino commands
+        logging.info(f"★★★ Sending direct command to Arduino: {cmd_type} ★★★")
+        response = channel.request(cmd_type, ('OK', 'ERR'), COMMAND_RESPONSE_TIMEOUT)
+        if response:
+            logging.info(f"Arduino response to {cmd_type}: {response.raw}")
+        else:
+            logging.warning(f"No response from Arduino for command: {cmd_type}")
+    
+    elif cmd_type == '_control_read_flag':
+        # The next card scan goes to the control page instead of the cart
+        control.activate()
+        
+    elif cmd_type == 'write_tag':
+        # Get the data from parameters
+        data_params = params.get('data', '')
+        
+        # Check if it's in the format "product_name,price,is_grocery"
+        if ',' in data_params:
+            parts = data_params.split(',')
+            if len(parts) >= 2:
+                product_name = parts[0]
+                price = parts[1]
+                # Format to product_name#price for Arduino
+                data = f"{product_name}#{price}"
+            else:
+                data = data_params
+        else:
+            data = data_params
+        
+        logging.info(f"Sending WRITE command: {data}")
+        response = channel.request(f"WRITE:{data}", ('OK', 'ERR'), TAG_WRITE_TIMEOUT)
+        # Whichever tag was on the reader now carries a different product
+        product_catalog.forget_tags()
+        response_text = response.raw if response else ""
+        logging.info(f"Arduino response: {response_text}")
+        
+        if "OK:Write successful" in response_text:
+            logging.info("Tag write successful")
+        else:
+            logging.warning(f"Tag write may have failed or no response: {response_text}")
+        
+    elif cmd_type == 'reset_tag':
+        logging.info("Sending RESET command")
+        response = channel.request("RESET", ('OK', 'ERR'), TAG_WRITE_TIMEOUT)
+        product_catalog.forget_tags()
+        response_text = response.raw if response else ""
+        logging.info(f"Arduino response: {response_text}")
+        
+        if "OK:Write successful" in response_text:  # Reset also returns this
+            logging.info("Tag reset successful")
+        else:
+            logging.warning(f"Tag reset may have failed or no response: {response_text}")
+    
+    elif cmd_type == 'product_changed':
+        # The web app edited a product; only sent over the bus
+        product_catalog.put(params['product_id'], params['product_name'], params['price'], params['is_grocery'])
+        logging.info(f"Product catalogue updated: {params['product_name']}")
+    
+    elif cmd_type == 'READC':
+        # This is a control-only read command that won't trigger normal flow
+        logging.info("Sending READC command to Arduino (control-only read)")
+        tag_id = params.get('tag_id', 'unknown')
+        response = channel.request("READ", ('DATA', 'ERR'))  # We still send READ to Arduino
+        
+        # Store in control_results table only
+        if response and response.kind == 'DATA' and store_control_result(cursor, tag_id, response.payload):
+            logging.info(f"Stored control-only read result: {response.payload}")
+        else:
+            logging.warning(f"Failed to get data for control-only read")
+        
+    elif cmd_type == 'read_tag':
+        # Check if this is for control mode
+        if is_control:
+            logging.info("Processing read_tag command for CONTROL MODE")
+            # Arm control mode for the next card read
+            control.activate()
+        
+        # Don't send READ command here - it will be sent when a card is detected
+        logging.info(f"Read tag command registered (control mode: {is_control})")
+        
+    elif cmd_type == 'weigh_item':
+        is_control = params.get('control_mode', False)
+        
+        # Send the weigh command to Arduino; the Weight: line arrives as an event
+        # and the next stable weight is reported even if the item was already resting
+        scale.report_next()
+        channel.send("w")
+        logging.info(f"Sent weigh_item command (control mode: {is_control})")
+        
+    elif cmd_type == 'tare':
+        channel.send("t")
+        scale.reset()
+        logging.info("Sent tare command")
+        
+    elif cmd_type == 'open_lid':
+        # For regular cart operations, this is simulated
+        # But for control page, send actual command to Arduino
+        if is_control:
+            channel.send("OPEN_LID")
+            logging.info("Sent OPEN_LID command to Arduino")
+        else:
+            logging.info(f"Simulating open lid command (no actual command sent to Arduino)")
+    
+    return response
+
+def run_table_command(cursor, device, cmd_id, cmd_type, params):
+    """Execute a command from the commands table and record its outcome."""
+    try:
+        execute_command(cursor, device, cmd_type, params)
+        
+        # Mark command as completed
+        cursor.execute(
+            "UPDATE commands SET status = 'complete' WHERE id = %s",
+            (cmd_id,)
+        )
+        
+    except Exception as e:
+        logging.error(f"Error sending command {cmd_type} to Arduino: {e}")
+        logging.exception("Exception details:")
+        # Mark command as failed
+        cursor.execute(
+            "UPDATE commands SET status = 'failed' WHERE id = %s",
+            (cmd_id,)
+        )
+
+def check_commands(cursor, devices, in_flight):
+    """Check for pending commands in the database and send them to the Arduinos.
+    
+    Commands that wait on an Arduino go to the device's worker; their ids stay
+    in in_flight until it has run them, so a later check doesn't queue them again.
+    """
     cursor.execute(
         "SELECT id, command_type, parameters FROM commands WHERE status = 'pending' ORDER BY timestamp ASC LIMIT 5"
     )
-    commands = cursor.fetchall()
+    commands = [command for command in cursor.fetchall() if command[0] not in in_flight]
     
     for cmd_id, cmd_type, parameters in commands:
         # Enhanced logging for debugging
@@ -360,307 +959,176 @@ def check_commands(cursor, ser):
             logging.warning(f"Deleted empty command with ID {cmd_id}, Type: {type(cmd_type)}")
             continue
             
+        # Parse parameters safely
         try:
-            # Parse parameters safely
-            try:
-                params = json.loads(parameters) if parameters and parameters.strip() else {}
-            except json.JSONDecodeError:
-                params = {}
-                logging.warning(f"Could not parse parameters for command {cmd_type}, using empty dict")
-                
-            is_control = params.get('control_mode', False)
-            
-            logging.info(f"Processing command: {cmd_type}, control mode: {is_control}")
-            
-            # Handle special control commands with better logging
-            if cmd_type in ['BUZZER', 'LED', 'OPEN_LID', 'CLOSE_LID']:
-                # These are direct Arduino commands
-                command_string = f"{cmd_type}\n"
-                ser.write(command_string.encode())
-                logging.info(f"★★★ Sent direct command to Arduino: {cmd_type} ★★★")
-                
-                # Wait for a response
-                time.sleep(1)
-                if ser.in_waiting > 0:
-                    response = ser.readline().decode('utf-8').strip()
-                    logging.info(f"Arduino response to {cmd_type}: {response}")
-                else:
-                    logging.warning(f"No response from Arduino for command: {cmd_type}")
-            
-            elif cmd_type == '_control_read_flag':
-                # This is just a flag, no need to send to Arduino
-                logging.info("Processed control read flag")
-                
-            elif cmd_type == 'write_tag':
-                # Get the data from parameters
-                data_params = params.get('data', '')
-                
-                # Check if it's in the format "product_name,price,is_grocery"
-                if ',' in data_params:
-                    parts = data_params.split(',')
-                    if len(parts) >= 2:
-                        product_name = parts[0]
-                        price = parts[1]
-                        # Format to product_name#price for Arduino
-                        data = f"{product_name}#{price}"
-                    else:
-                        data = data_params
-                else:
-                    data = data_params
-                
-                ser.write(f"WRITE:{data}\n".encode())
-                logging.info(f"Sent WRITE command: {data}")
-                
-                # Wait for Arduino to respond
-                time.sleep(1)
-                response = ""
-                if ser.in_waiting > 0:
-                    response = ser.readline().decode('utf-8').strip()
-                    logging.info(f"Arduino response: {response}")
-                
-                if "OK:Write successful" in response:
-                    logging.info("Tag write successful")
-                else:
-                    logging.warning(f"Tag write may have failed or no response: {response}")
-                
-            elif cmd_type == 'reset_tag':
-                ser.write(b"RESET\n")
-                logging.info("Sent RESET command")
-                
-                # Wait for Arduino to respond
-                time.sleep(1)
-                response = ""
-                if ser.in_waiting > 0:
-                    response = ser.readline().decode('utf-8').strip()
-                    logging.info(f"Arduino response: {response}")
-                
-                if "OK:Write successful" in response:  # Reset also returns this
-                    logging.info("Tag reset successful")
-                else:
-                    logging.warning(f"Tag reset may have failed or no response: {response}")
-            
-            elif cmd_type == 'READC':
-                # This is a control-only read command that won't trigger normal flow
-                logging.info("Sending READC command to Arduino (control-only read)")
-                ser.write(b"READ\n")  # We still send READ to Arduino
-                
-                # Wait for Arduino to respond with DATA:
-                data_received = False
-                read_data = None
-                tag_id = params.get('tag_id', 'unknown')
-                
-                for _ in range(10):  # Try up to 10 times
-                    time.sleep(0.5)
-                    if ser.in_waiting > 0:
-                        response = ser.readline().decode('utf-8').strip()
-                        logging.info(f"Control-only read response: {response}")
-                        
-                        if response.startswith("DATA:"):
-                            read_data = response[5:].strip()
-                            # Store in control_results table only
-                            try:
-                                cursor.execute("""
-                                    CREATE TABLE IF NOT EXISTS control_results (
-                                        id INT AUTO_INCREMENT PRIMARY KEY,
-                                        tag_id VARCHAR(100),
-                                        data TEXT,
-                                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                                    )
-                                """)
-                                cursor.execute(
-                                    "INSERT INTO control_results (tag_id, data) VALUES (%s, %s)",
-                                    (tag_id, read_data)
-                                )
-                                logging.info(f"Stored control-only read result: {read_data}")
-                                data_received = True
-                                break
-                            except Exception as e:
-                                logging.error(f"Error storing control result: {e}")
-                
-                        # Log result
-                        if not data_received:
-                            logging.warning(f"Failed to get data for control-only read")
-                
-            elif cmd_type == 'read_tag':
-                # Check if this is for control mode
-                if is_control:
-                    logging.info("Processing read_tag command for CONTROL MODE")
-                    # Set a flag to indicate control mode for next card read
-                    cursor.execute(
-                        "INSERT INTO commands (command_type, parameters, status, timestamp) VALUES (%s, %s, %s, %s)",
-                        ('_control_read_flag', '{}', 'pending', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
-                    )
-                    logging.info("★★★ Set control flag for next RFID read ★★★")
-                
-                # Don't send READ command here - it will be sent when a card is detected
-                logging.info(f"Read tag command registered (control mode: {is_control})")
-                
-            elif cmd_type == 'weigh_item':
-                is_control = params.get('control_mode', False)
-                
-                # Send the weigh command to Arduino
-                ser.write(b"w\n")
-                logging.info(f"Sent weigh_item command (control mode: {is_control})")
-                
-                # Wait for Arduino to respond with Weight:
-                time.sleep(1)
-                
-            elif cmd_type == 'tare':
-                ser.write(b"t\n")
-                logging.info("Sent tare command")
-                
-                # Wait for Arduino to respond
-                time.sleep(1)
-                
-            elif cmd_type == 'open_lid':
-                # For regular cart operations, this is simulated
-                # But for control page, send actual command to Arduino
-                if is_control:
-                    ser.write(b"OPEN_LID\n")
-                    logging.info("Sent OPEN_LID command to Arduino")
-                else:
-                    logging.info(f"Simulating open lid command (no actual command sent to Arduino)")
-            
-            # Mark command as completed
-            cursor.execute(
-                "UPDATE commands SET status = 'complete' WHERE id = %s",
-                (cmd_id,)
-            )
-            
-        except Exception as e:
-            logging.error(f"Error sending command {cmd_type} to Arduino: {e}")
-            logging.exception("Exception details:")
-            # Mark command as failed
-            cursor.execute(
-                "UPDATE commands SET status = 'failed' WHERE id = %s",
-                (cmd_id,)
+            params = json.loads(parameters) if parameters and parameters.strip() else {}
+        except json.JSONDecodeError:
+            params = {}
+            logging.warning(f"Could not parse parameters for command {cmd_type}, using empty dict")
+        
+        device = select_device(devices, params.get('device'))
+        if device is not None and cmd_type in BLOCKING_COMMANDS:
+            def job(worker_cursor, cmd_id=cmd_id, device=device, cmd_type=cmd_type, params=params):
+                try:
+                    run_table_command(worker_cursor, device, cmd_id, cmd_type, params)
+                finally:
+                    in_flight.discard(cmd_id)
+            in_flight.add(cmd_id)
+            device.worker.submit(job, on_error=lambda e, cmd_id=cmd_id: in_flight.discard(cmd_id))
+        else:
+            run_table_command(cursor, device, cmd_id, cmd_type, params)
+
+def run_bus_command(cursor, device, command):
+    """Execute a command received over the command bus and acknowledge it."""
+    cmd_type, params, future = command
+    logging.info(f"Processing bus command: '{cmd_type}', Parameters: {params}")
+    
+    try:
+        response = execute_command(cursor, device, cmd_type, params)
+        status = 'failed' if response is not None and response.kind == 'ERR' else 'complete'
+        future.set_result({'status': status, 'response': response.raw if response else None})
+    except Exception as e:
+        logging.error(f"Error sending bus command {cmd_type} to Arduino: {e}")
+        logging.exception("Exception details:")
+        future.set_result({'status': 'failed', 'response': str(e)})
+
+def handle_card(cursor, device, tag_id):
+    """Handle a card scan on the device's worker. Returns the scan notification or None."""
+    # Check if we're in control mode
+    if device.control.active:
+        process_control_scan(cursor, tag_id, device.channel)
+        # Reset control mode after the read
+        device.control.deactivate("after read")
+        return None
+    
+    # Normal shopping cart flow
+    item = process_card_scan(cursor, tag_id, device.channel, device.name)
+    if item:
+        return ('scan', item)
+    return None
+
+def handle_event(cursor, batch, event, devices):
+    """Run the database work for one event from an Arduino or the command bus.
+    
+    Card scans and commands that wait on an Arduino are handed to the
+    device's worker. Returns an (event_type, data) pair to push to the web
+    app once the batch is committed, or None.
+    """
+    if event.kind == 'COMMAND':
+        cmd_type, params, future = event.payload
+        device = select_device(devices, params.get('device'))
+        if device is not None and cmd_type in BLOCKING_COMMANDS:
+            device.worker.submit(
+                lambda worker_cursor: run_bus_command(worker_cursor, device, event.payload),
+                on_error=lambda e: future.done() or future.set_result({'status': 'failed', 'response': str(e)})
             )
+        else:
+            run_bus_command(cursor, device, event.payload)
+        return None
+    
+    device = devices.get(event.device)
+    if device is None:
+        # Left in the queue by a device that has since gone away
+        return None
+    scale = device.scale
+    
+    if event.kind == 'CARD':
+        device.worker.submit(lambda worker_cursor: handle_card(worker_cursor, device, event.payload))
+    elif event.kind == 'FRAUD':
+        fraud = process_fraud_alert(cursor, event.payload)
+        if fraud:
+            return ('fraud', fraud)
+    elif event.kind == 'WEIGHT':
+        # Only settled weights reach the database and the web app
+        weight = scale.add(event.payload, event.received_at)
+        if weight is not None:
+            return ('weight', process_weight_data(cursor, batch, weight, device.name))
+    elif event.kind == 'DATA':
+        # DATA: normally answers a pending READ; this one arrived late or unasked
+        logging.info(f"Received DATA outside of processing: {event.raw}")
+    elif event.kind in ('OK', 'ERR'):
+        # Responses nobody was waiting for (e.g. after a timeout)
+        logging.info(f"Arduino response: {event.raw}")
+    return None
 
 def main():
-    # Connect to database and Arduino
+    # One database connection and one event loop serve every Arduino, with a
+    # worker per Arduino for scans and commands that wait on it; the
+    # supervisor connects them as they are found
     db_conn = connect_to_database()
-    serial_conn = connect_to_arduino()
     
-    # Track control mode state
-    control_mode_active = False
-    control_timeout = 0
+    events = queue.Queue()
+    devices = {}   # port -> Device, only touched on this thread
+    supervisor = DeviceSupervisor(events, SERIAL_PORTS)
+    
+    def submit_bus_command(command_type, parameters):
+        # Bus commands run on this thread, in order with the serial events
+        future = Future()
+        events.put(SerialEvent('COMMAND', (command_type, parameters, future), '', time.time()))
+        return future
+    
+    command_bus = CommandBusServer(submit_bus_command)
+    batch = WriteBatch()
+    cursor = None
+    in_flight = set()   # ids of table commands queued on a device worker
+    
+    def flush_batch():
+        # Only push after the commit so the web app can already see the rows
+        for notification in batch.flush(db_conn, cursor):
+            command_bus.publish(*notification)
     
     try:
         cursor = db_conn.cursor()
+        product_catalog.load(cursor)
+        db_conn.commit()
         
+        supervisor.start()
+        command_bus.start()
         logging.info("Serial handler started. Listening for Arduino data...")
         
+        last_command_check = 0
+        
         while True:
-            # First, check for control_mode flags
+            # Block until the Arduino or the web app says something, the open
+            # batch is due, or it's time to drain commands persisted while the
+            # bus was down
+            timeout = max(0, last_command_check + COMMAND_POLL_INTERVAL - time.time())
+            if batch.pending:
+                timeout = min(timeout, batch.remaining())
             try:
-                cursor.execute(
-                    "SELECT id FROM commands WHERE command_type = '_control_read_flag' AND status = 'pending' LIMIT 1"
-                )
-                control_flag = cursor.fetchone()
-                if control_flag:
-                    control_mode_active = True
-                    control_timeout = time.time() + 30  # 30 seconds timeout
-                    cursor.execute(
-                        "UPDATE commands SET status = 'complete' WHERE id = %s",
-                        (control_flag[0],)
-                    )
-                    logging.info("★★★ Control mode ACTIVATED for next RFID read ★★★")
-            except Exception as e:
-                logging.error(f"Error checking control mode: {e}")
-            
-            # Reset control mode if timeout is exceeded
-            if control_mode_active and time.time() > control_timeout:
-                control_mode_active = False
-                logging.info("Control mode DEACTIVATED due to timeout")
+                event = events.get(timeout=timeout)
+            except queue.Empty:
+                event = None
             
-            # Process pending commands
-            check_commands(cursor, serial_conn)
-            db_conn.commit()
+            if event is not None:
+                if event.kind == 'ATTACHED':
+                    event.payload.start_worker(command_bus.publish)
+                    devices[event.device] = event.payload
+                    logging.info(f"Serving {len(devices)} Arduino(s): {', '.join(sorted(devices))}")
+                elif event.kind == 'DISCONNECTED':
+                    logging.error(f"Lost connection to Arduino on {event.device}")
+                    device = devices.pop(event.device, None)
+                    if device is not None:
+                        device.close()
+                    supervisor.detach(event.device)
+                else:
+                    notification = handle_event(cursor, batch, event, devices)
+                    if notification and event.device:
+                        notification[1]['device'] = event.device
+                    batch.add(notification)
             
-            # Check if there's data available from Arduino
-            if serial_conn.in_waiting > 0:
-                line = serial_conn.readline().decode('utf-8').strip()
-                
-                if line:
-                    logging.info(f"Received from Arduino: {line}")
-                    
-                    if line.startswith("CARD:"):
-                        tag_id = line[5:].strip()
-                        
-                        # Check if we're in control mode
-                        if control_mode_active:
-                            logging.info(f"★★★ Processing CONTROL RFID scan for tag: {tag_id} ★★★")
-                            
-                            # Direct READ command for control mode
-                            serial_conn.write(b"READ\n")
-                            logging.info("Sent READ command for control mode")
-                            
-                            # Wait for response
-                            read_data = None
-                            for _ in range(10):  # Try up to 10 times
-                                time.sleep(0.5)
-                                if serial_conn.in_waiting > 0:
-                                    response = serial_conn.readline().decode('utf-8').strip()
-                                    logging.info(f"Control read response: {response}")
-                                    
-                                    if response.startswith("DATA:"):
-                                        read_data = response[5:].strip()
-                                        break
-                            
-                            # Store in control_results table only
-                            if read_data:
-                                # Create table if it doesn't exist
-                                cursor.execute("""
-                                    CREATE TABLE IF NOT EXISTS control_results (
-                                        id INT AUTO_INCREMENT PRIMARY KEY,
-                                        tag_id VARCHAR(100),
-                                        data TEXT,
-                                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                                    )
-                                """)
-                                
-                                # Store the data
-                                cursor.execute(
-                                    "INSERT INTO control_results (tag_id, data) VALUES (%s, %s)",
-                                    (tag_id, read_data)
-                                )
-                                db_conn.commit()
-                                logging.info(f"✓✓✓ Stored control read result: {read_data}")
-                            
-                            # Reset control mode after successful read
-                            control_mode_active = False
-                            logging.info("Control mode DEACTIVATED after read")
-                        else:
-                            # Normal shopping cart flow
-                            process_card_scan(cursor, tag_id, serial_conn)
-                            db_conn.commit()
-                    elif line.startswith("FRAUD:"):
-                        reason = line[6:].strip()
-                        process_fraud_alert(cursor, reason)
-                        db_conn.commit()
-                    elif line.startswith("Weight:"):
-                        try:
-                            # Extract the weight value
-                            weight_parts = line.split(':')
-                            if len(weight_parts) > 1:
-                                weight_str = weight_parts[1].strip()
-                                weight = float(weight_str)
-                                process_weight_data(cursor, weight)
-                                db_conn.commit()
-                            else:
-                                logging.warning(f"Invalid weight format: {line}")
-                        except ValueError as e:
-                            logging.error(f"Invalid weight format: {e}")
-                    elif line.startswith("DATA:"):
-                        # This is handled directly in process_card_scan when we send READ command
-                        # But we'll still log it for debugging
-                        logging.info(f"Received DATA outside of processing: {line}")
-                    elif line.startswith("OK:") or line.startswith("ERR:"):
-                        # Log Arduino responses to commands
-                        logging.info(f"Arduino response: {line}")
+            # Commit once the window closes, the batch is full or things go quiet
+            if batch.pending and (event is None or batch.due()):
+                flush_batch()
             
-            # Sleep to avoid overloading the CPU
-            time.sleep(0.1)
+            # Process commands left in the table by the fallback path
+            if time.time() - last_command_check >= COMMAND_POLL_INTERVAL:
+                if batch.pending:
+                    flush_batch()
+                check_commands(cursor, devices, in_flight)
+                # Commit also refreshes the snapshot so new commands become visible
+                db_conn.commit()
+                last_command_check = time.time()
             
     except KeyboardInterrupt:
         logging.info("Serial handler stopped by user")
@@ -668,11 +1136,16 @@ def main():
         logging.error(f"Error in serial handler: {e}")
         logging.exception("Exception details:")
     finally:
-        if serial_conn.is_open:
-            serial_conn.close()
-        cursor.close()
+        if batch.pending:
+            flush_batch()
+        command_bus.stop()
+        supervisor.stop()
+        for device in devices.values():
+            device.close()
+        if cursor is not None:
+            cursor.close()
         db_conn.close()
         logging.info("Connections closed")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,144 @@
+import time
+import struct
+import binascii
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Framed binary protocol between the Pi and the cart Arduino.
+#
+#   0xA5 | type (1) | length (1) | payload (length) | CRC-16/CCITT-FALSE (2, little-endian)
+#
+# The CRC covers type, length and payload. Arduino -> Pi frames carry the same
+# events as the text lines; Pi -> Arduino frames carry the text command as
+# their payload. The mode is negotiated at connect: the Pi sends
+# "PROTO:BIN[:<baud>]" as a text command and firmware that supports frames
+# answers "OK:PROTO BIN", after which both sides switch (and change baud rate
+# if one was given). Older firmware answers "ERR:Unknown command" and the
+# handler stays on text lines.
+
+SYNC = 0xA5
+HEADER_SIZE = 3     # sync, type, length
+CRC_SIZE = 2
+MAX_PAYLOAD = 255
+
+FRAME_KINDS = {
+    0x01: 'CARD',     # raw UID bytes
+    0x02: 'DATA',     # "name#price"
+    0x03: 'FRAUD',    # reason
+    0x04: 'WEIGHT',   # int32 little-endian, hundredths of a gram
+    0x05: 'OK',
+    0x06: 'ERR',
+    0x07: 'INFO',     # chatter such as "Place your card..."
+}
+COMMAND_FRAME = 0x10
+
+NEGOTIATE_COMMAND = "PROTO:BIN"
+NEGOTIATE_REPLY = "OK:PROTO BIN"
+NEGOTIATE_TIMEOUT = 3.0   # seconds to wait for the Arduino's answer
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+def encode_frame(frame_type, payload):
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError(f"Frame payload of {len(payload)} bytes is too long")
+    body = bytes((frame_type, len(payload))) + payload
+    return bytes((SYNC,)) + body + struct.pack('<H', crc16(body))
+
+def encode_command(command):
+    return encode_frame(COMMAND_FRAME, command.encode())
+
+class FrameParser:
+    """Splits the byte stream from the Arduino into frames.
+
+    Bytes are appended to one bytearray and frames are located and checked in
+    place through a memoryview; only the decoded values (a UID string, a
+    weight, a message) are created. Bytes that don't start a valid frame are
+    skipped until the next sync byte, so a corrupted or partial frame costs
+    only that frame.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.discarded = 0   # bytes skipped while resynchronising
+
+    def feed(self, data):
+        """Add bytes read from the port. Returns (kind, payload, raw) for each
+        complete frame, where raw is the equivalent text line."""
+        buffer = self._buffer
+        buffer += data
+        decoded = []
+        pos = 0
+        with memoryview(buffer) as view:
+            while True:
+                start = buffer.find(SYNC, pos)
+                if start < 0:
+                    self.discarded += len(buffer) - pos
+                    pos = len(buffer)
+                    break
+                self.discarded += start - pos
+                pos = start
+
+                end = start + HEADER_SIZE
+                if len(buffer) < end + CRC_SIZE:
+                    break
+                end += buffer[start + 2]
+                if len(buffer) < end + CRC_SIZE:
+                    break
+
+                if crc16(view[start + 1:end]) != struct.unpack_from('<H', buffer, end)[0]:
+                    self.crc_errors += 1
+                    self.discarded += 1
+                    pos = start + 1
+                    continue
+
+                decoded.append(self._decode(buffer[start + 1], view[start + HEADER_SIZE:end]))
+                self.frames += 1
+                pos = end + CRC_SIZE
+        del buffer[:pos]
+        return decoded
+
+    @staticmethod
+    def _decode(frame_type, payload):
+        kind = FRAME_KINDS.get(frame_type)
+        if kind == 'CARD':
+            tag_id = payload.hex().upper()
+            return kind, tag_id, f"CARD:{tag_id}"
+        if kind == 'WEIGHT' and len(payload) == 4:
+            weight = struct.unpack_from('<i', payload)[0] / 100
+            return kind, weight, f"Weight: {weight}"
+
+        text = str(payload, 'utf-8', 'replace')
+        if kind in ('DATA', 'FRAUD', 'OK', 'ERR'):
+            return kind, text, f"{kind}:{text}"
+        return 'INFO', text, text
+
+def negotiate(serial_conn, baud_rate=None, timeout=NEGOTIATE_TIMEOUT):
+    """Ask the Arduino to switch to framed mode.
+
+    Returns (enabled, lines) where lines are the other text lines that
+    arrived while waiting for the answer, for the caller to handle.
+    """
+    command = NEGOTIATE_COMMAND if baud_rate is None else f"{NEGOTIATE_COMMAND}:{baud_rate}"
+    serial_conn.write(f"{command}\n".encode())
+
+    lines = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        line = serial_conn.readline().decode('utf-8', errors='replace').strip()
+        if not line:
+            continue
+        if line.startswith(NEGOTIATE_REPLY):
+            if baud_rate is not None:
+                serial_conn.baudrate = baud_rate
+            logger.info(f"Arduino switched to framed binary protocol at {serial_conn.baudrate} baud")
+            return True, lines
+        if line.startswith("ERR:Unknown command"):
+            break
+        lines.append(line)
+
+    logger.info("Arduino firmware doesn't support the framed protocol, using text lines")
+    return False, lines
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import deque, namedtuple
+
+BUFFER_SIZE = 256        # readings kept, roughly four minutes at the scale's 1 Hz rate
+STABLE_SAMPLES = 3       # consecutive readings that must agree for a stable weight
+STABLE_TOLERANCE = 2.0   # grams the agreeing readings may differ by
+
+# received_at is a time.time() timestamp taken when the reading reached this process;
+# item_id is the scanned item the serial handler assigned the weight to, if any
+WeightReading = namedtuple('WeightReading', ['weight', 'received_at', 'stable', 'item_id'])
+
+class WeightBuffer:
+    """Ring buffer of recent load cell readings shared across request threads.
+
+    Readings are pushed in from the serial handler's event stream. Callers can
+    read the latest reading straight away or block until a stable one arrives,
+    so routes never have to sleep and re-query the database.
+    """
+
+    def __init__(self, size=BUFFER_SIZE, stable_samples=STABLE_SAMPLES, stable_tolerance=STABLE_TOLERANCE):
+        self.stable_samples = stable_samples
+        self.stable_tolerance = stable_tolerance
+        self._readings = deque(maxlen=size)
+        self._cond = threading.Condition()
+
+    def add(self, weight, stable=None, item_id=None):
+        """Record a reading. If the sender did not say whether it is stable,
+        it is stable when the last few readings agree within the tolerance."""
+        weight = float(weight)
+        with self._cond:
+            if stable is None:
+                recent = [r.weight for r in list(self._readings)[-(self.stable_samples - 1):]] + [weight]
+                stable = (len(recent) >= self.stable_samples
+                          and max(recent) - min(recent) <= self.stable_tolerance)
+            reading = WeightReading(weight, time.time(), bool(stable), item_id)
+            self._readings.append(reading)
+            self._cond.notify_all()
+        return reading
+
+    def latest(self, max_age=None, stable_only=False, min_weight=None, since=None):
+        """Return the newest reading if it passes the filters, otherwise None."""
+        with self._cond:
+            return self._find(max_age, stable_only, min_weight, since)
+
+    def wait_for(self, timeout, max_age=None, stable_only=True, min_weight=None, since=None):
+        """Return a matching reading, waiting up to `timeout` seconds for one to
+        arrive. With `since` (a time.time() timestamp) only readings received
+        after it match."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                reading = self._find(max_age, stable_only, min_weight, since)
+                remaining = deadline - time.monotonic()
+                if reading is not None or remaining <= 0:
+                    return reading
+                self._cond.wait(remaining)
+
+    def wait_for_item(self, item_id, timeout):
+        """Return the reading assigned to a scanned item, waiting up to `timeout` seconds."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                reading = next((r for r in reversed(self._readings) if r.item_id == item_id), None)
+                remaining = deadline - time.monotonic()
+                if reading is not None or remaining <= 0:
+                    return reading
+                self._cond.wait(remaining)
+
+    def snapshot(self):
+        with self._cond:
+            return list(self._readings)
+
+    def _find(self, max_age, stable_only, min_weight, since=None):
+        # Only the newest reading counts - an older stable weight no longer
+        # describes what is on the scale once a newer reading has arrived
+        if not self._readings:
+            return None
+        reading = self._readings[-1]
+        if max_age is not None and time.time() - reading.received_at > max_age:
+            return None
+        if since is not None and reading.received_at < since:
+            return None
+        if stable_only and not reading.stable:
+            return None
+        if min_weight is not None and reading.weight <= min_weight:
+            return None
+        return reading
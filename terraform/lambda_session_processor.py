@@ -72,21 +72,66 @@ def process_session_message(message_data):
 
     print(f"Processing session {session_id} for customer {customer_id}")
 
-    # Update session status
-    update_session_status(session_data)
-
-    # Create transaction records
-    create_transaction_records(session_data)
+    # A session is processed once: MQTT QoS 1 and the cart's outbox may both
+    # deliver the same session end again
+    processing_key = claim_session(session_data)
+    if processing_key is None:
+        print(f"Session {session_id} already processed, skipping duplicate")
+        return
 
-    # Update customer statistics
-    update_customer_stats(session_data)
+    try:
+        # Update session status
+        update_session_status(session_data)
+
+        # Create transaction records
+        create_transaction_records(session_data, processing_key)
+    except Exception:
+        # Nothing non-repeatable has run yet; let a redelivery try again
+        release_session(session_id, processing_key)
+        raise
 
     # Process any fraud events
     process_fraud_events(session_data)
 
+    # Update customer statistics (adds to the totals, so it runs last)
+    update_customer_stats(session_data)
+
     print(f"Successfully processed session {session_id}")
 
 
+def claim_session(session_data):
+    """Mark the session as being processed; returns the key it was claimed
+    with, or None if a delivery of it was processed already"""
+
+    sessions_table = dynamodb.Table(SESSIONS_TABLE)
+    processing_key = session_data.get('idempotency_key') or session_data['session_id']
+
+    try:
+        sessions_table.update_item(
+            Key={'session_id': session_data['session_id']},
+            UpdateExpression="SET processing_key = :key",
+            ConditionExpression="attribute_not_exists(processing_key)",
+            ExpressionAttributeValues={':key': processing_key}
+        )
+        return processing_key
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return None
+
+
+def release_session(session_id, processing_key):
+    """Undo claim_session() after a failure"""
+
+    try:
+        dynamodb.Table(SESSIONS_TABLE).update_item(
+            Key={'session_id': session_id},
+            UpdateExpression="REMOVE processing_key",
+            ConditionExpression="processing_key = :key",
+            ExpressionAttributeValues={':key': processing_key}
+        )
+    except Exception as e:
+        print(f"Error releasing session {session_id}: {str(e)}")
+
+
 def extract_from_iot_message(message_data):
     """Extract session data from IoT Core message"""
 
@@ -187,7 +232,7 @@ def update_session_status(session_data):
         raise
 
 
-def create_transaction_records(session_data):
+def create_transaction_records(session_data, processing_key):
     """Create transaction records from session data"""
 
     try:
@@ -196,8 +241,9 @@ def create_transaction_records(session_data):
         session_id = session_data['session_id']
         customer_id = session_data.get('customer_id')
 
-        # Create main transaction record
-        transaction_id = f"trans_{uuid.uuid4().hex[:8]}"
+        # Create main transaction record; the id is derived from the
+        # session's processing key, so a retried delivery overwrites it
+        transaction_id = f"trans_{uuid.uuid5(uuid.NAMESPACE_OID, processing_key).hex[:8]}"
 
         transaction_record = {
             'transaction_id': transaction_id,
@@ -141,6 +141,11 @@ resource "aws_dynamodb_table" "customers" {
     type = "S"
   }
 
+  attribute {
+    name = "rfid_uid_canonical"
+    type = "S"
+  }
+
   # GSI for RFID lookups
   global_secondary_index {
     name               = "rfid-lookup-index"
@@ -148,6 +153,14 @@ resource "aws_dynamodb_table" "customers" {
     projection_type    = "ALL"
   }
 
+  # GSI for RFID lookups by normalized UID (uppercase hex, no separators),
+  # so any format the reader reports is found with one query
+  global_secondary_index {
+    name               = "rfid-canonical-index"
+    hash_key           = "rfid_uid_canonical"
+    projection_type    = "ALL"
+  }
+
   tags = {
     Name    = "Customers Table"
     Purpose = "Customer profiles and RFID authentication"
@@ -492,6 +505,35 @@ resource "aws_dynamodb_table" "shelf_displays" {
   }
 }
 
+# Discount Effectiveness Table - Discounts shown to customers by smart shelves
+resource "aws_dynamodb_table" "discount_effectiveness" {
+  name           = "${var.project_name}-discount-effectiveness-${var.environment}"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "discount_id"
+
+  attribute {
+    name = "discount_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "customer_id"
+    type = "S"
+  }
+
+  # GSI for a customer's discounts, read by the cart at session start
+  global_secondary_index {
+    name               = "customer-index"
+    hash_key           = "customer_id"
+    projection_type    = "ALL"
+  }
+
+  tags = {
+    Name    = "Discount Effectiveness Table"
+    Purpose = "Personalised discounts and customer responses"
+  }
+}
+
 # System Nodes Table - IoT device registry
 resource "aws_dynamodb_table" "system_nodes" {
   name           = "${var.project_name}-system-nodes-${var.environment}"
@@ -703,6 +745,7 @@ resource "aws_iam_policy" "lambda_dynamodb_policy" {
           aws_dynamodb_table.fraud_events.arn,
           aws_dynamodb_table.access_logs.arn,
           aws_dynamodb_table.shelf_displays.arn,
+          aws_dynamodb_table.discount_effectiveness.arn,
           aws_dynamodb_table.system_nodes.arn,
           "${aws_dynamodb_table.customers.arn}/index/*",
           "${aws_dynamodb_table.products.arn}/index/*",
@@ -712,6 +755,7 @@ resource "aws_iam_policy" "lambda_dynamodb_policy" {
           "${aws_dynamodb_table.fraud_events.arn}/index/*",
           "${aws_dynamodb_table.access_logs.arn}/index/*",
           "${aws_dynamodb_table.shelf_displays.arn}/index/*",
+          "${aws_dynamodb_table.discount_effectiveness.arn}/index/*",
           "${aws_dynamodb_table.system_nodes.arn}/index/*"
         ]
       }
@@ -783,6 +827,7 @@ resource "aws_iam_policy" "admin_ui_dynamodb_policy" {
           aws_dynamodb_table.fraud_events.arn,
           aws_dynamodb_table.access_logs.arn,
           aws_dynamodb_table.shelf_displays.arn,
+          aws_dynamodb_table.discount_effectiveness.arn,
           aws_dynamodb_table.system_nodes.arn,
           "${aws_dynamodb_table.customers.arn}/index/*",
           "${aws_dynamodb_table.products.arn}/index/*",
@@ -792,6 +837,7 @@ resource "aws_iam_policy" "admin_ui_dynamodb_policy" {
           "${aws_dynamodb_table.fraud_events.arn}/index/*",
           "${aws_dynamodb_table.access_logs.arn}/index/*",
           "${aws_dynamodb_table.shelf_displays.arn}/index/*",
+          "${aws_dynamodb_table.discount_effectiveness.arn}/index/*",
           "${aws_dynamodb_table.system_nodes.arn}/index/*"
         ]
       }
@@ -1107,6 +1153,7 @@ output "dynamodb_tables" {
     fraud_events         = aws_dynamodb_table.fraud_events.name
     access_logs          = aws_dynamodb_table.access_logs.name
     shelf_displays       = aws_dynamodb_table.shelf_displays.name
+    discount_effectiveness = aws_dynamodb_table.discount_effectiveness.name
     system_nodes         = aws_dynamodb_table.system_nodes.name
     sensor_data          = aws_dynamodb_table.sensor_data.name          # NEW
     inventory_transactions = aws_dynamodb_table.inventory_transactions.name # NEW